@@ -1,50 +1,180 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+import threading
 
 class ACSLog:
+    """
+
+    Logging for the ACS CLI. Messages go to the console, to
+    `~/.acs/logs/all.log` and (errors only) to `~/.acs/logs/error.log`.
+
+    The level is taken from the `ACS_LOG_LEVEL` environment variable
+    or the `--log-level` option, and defaults to INFO. Messages below
+    it cost almost nothing: arguments are only %-formatted into the
+    message if it is going to be written, and a message may be a
+    callable that is only called if needed, e.g.
+
+        self.log.debug("NIC: %s", nic)
+        self.log.debug(lambda: json.dumps(nics, indent=True))
+
+    Records are handed to a background thread for writing so that
+    logging never blocks the calling thread on I/O. The log files are
+    appended to and rotated, so concurrent runs do not clobber each
+    other's logs.
+
+    """
+    output_dir = os.path.expanduser('~/.acs/logs')
+    log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    max_bytes = 5 * 1024 * 1024
+    backup_count = 3
+
+    level = None
+    _handler = None
+    _listener = None
+    _listener_pid = None
+    _names = set()
+    _lock = threading.Lock()
+
     def __init__(self, name = u"acs"):
-        output_dir = os.path.expanduser('~/.acs/logs')
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+        handler, created = ACSLog._queueHandler()
 
         self.logger = logging.getLogger(name)
-        self.logger.setLevel(logging.DEBUG)
-        
-        if (not self.logger.handlers):
-            # create console handler and set level to info
-            handler = logging.StreamHandler()
-            handler.setLevel(logging.DEBUG)
-            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-            handler.setFormatter(formatter)
+        self.logger.setLevel(ACSLog.getLevel())
+        if handler not in self.logger.handlers:
             self.logger.addHandler(handler)
-            
+        with ACSLog._lock:
+            ACSLog._names.add(name)
+
+        if created:
+            self.debug("Logs being written to %s", ACSLog.output_dir)
+
+    @classmethod
+    def getLevel(cls):
+        if cls.level is None:
+            cls.level = cls._parseLevel(os.environ.get("ACS_LOG_LEVEL", "INFO"))
+        return cls.level
+
+    @classmethod
+    def setLevel(cls, level):
+        """
+        Set the level, by name or number, of all ACS loggers.
+        """
+        cls.level = cls._parseLevel(level)
+        with cls._lock:
+            names = list(cls._names)
+        for name in names:
+            logging.getLogger(name).setLevel(cls.level)
+
+    @classmethod
+    def _parseLevel(cls, level):
+        if isinstance(level, int):
+            return level
+        value = logging.getLevelName(str(level).upper())
+        if not isinstance(value, int):
+            raise ValueError("Unknown log level: " + str(level))
+        return value
+
+    @classmethod
+    def _queueHandler(cls):
+        """
+        Get the handler shared by all ACS loggers, creating it and
+        the background thread that writes its records if necessary.
+        Returns a tuple of (handler, created).
+        """
+        with cls._lock:
+            if cls._handler is not None:
+                return cls._handler, False
+
+            if not os.path.exists(cls.output_dir):
+                os.makedirs(cls.output_dir, exist_ok=True)
+            formatter = logging.Formatter(cls.log_format)
+
+            # create console handler
+            console = logging.StreamHandler()
+            console.setFormatter(formatter)
+
             # create error file handler and set level to error
-            handler = logging.FileHandler(os.path.join(output_dir, "error.log"),"w", encoding=None, delay="true")
-            handler.setLevel(logging.ERROR)
-            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-            handler.setFormatter(formatter)
-            self.logger.addHandler(handler)
-            
-            # create debug file handler and set level to debug
-            handler = logging.FileHandler(os.path.join(output_dir, "all.log"),"w")
-            handler.setLevel(logging.DEBUG)
-            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-            handler.setFormatter(formatter)
-            self.logger.addHandler(handler)
+            errors = logging.handlers.RotatingFileHandler(os.path.join(cls.output_dir, "error.log"), "a",
+                                                          cls.max_bytes, cls.backup_count, delay=True)
+            errors.setLevel(logging.ERROR)
+            errors.setFormatter(formatter)
+
+            # create file handler for everything that is logged
+            everything = logging.handlers.RotatingFileHandler(os.path.join(cls.output_dir, "all.log"), "a",
+                                                              cls.max_bytes, cls.backup_count, delay=True)
+            everything.setFormatter(formatter)
 
-            self.debug("Logs being written to " + output_dir)
+            records = queue.Queue(-1)
+            cls._listener = logging.handlers.QueueListener(records, console, errors, everything,
+                                                           respect_handler_level=True)
+            cls._listener.start()
+            cls._listener_pid = os.getpid()
+            atexit.register(cls._stop)
+            cls._handler = logging.handlers.QueueHandler(records)
+            return cls._handler, True
 
-    def info(self, msg):
-        self.logger.info(msg)
+    @classmethod
+    def flush(cls):
+        """
+        Wait for all queued records to be written.
+        """
+        with cls._lock:
+            if cls._listener is not None:
+                cls._listener.stop()
+                cls._listener.start()
 
-    def debug(self, msg):
-        self.logger.debug(msg)
+    @classmethod
+    def afterFork(cls):
+        """
+        The thread writing records does not survive a fork, so start a
+        new listener, on a new queue, in the child (e.g. the SSH tunnel
+        process). This is done automatically where Python supports
+        `os.register_at_fork` (3.7 and later); code that forks should
+        call it in the child anyway. Calling it again in the same
+        process does nothing.
+        """
+        cls._lock = threading.Lock()
+        with cls._lock:
+            if cls._listener is None or cls._listener_pid == os.getpid():
+                return
+            records = queue.Queue(-1)
+            cls._listener = logging.handlers.QueueListener(records, *cls._listener.handlers,
+                                                           respect_handler_level=cls._listener.respect_handler_level)
+            cls._handler.queue = records
+            cls._listener.start()
+            cls._listener_pid = os.getpid()
 
-    def warning(self, msg):
-        self.logger.warning(msg)
+    @classmethod
+    def _stop(cls):
+        with cls._lock:
+            if cls._listener is not None:
+                cls._listener.stop()
+                cls._listener = None
 
-    def error(self, msg):
-        self.logger.error(msg)
+    def _log(self, level, msg, args):
+        if not self.logger.isEnabledFor(level):
+            return
+        if callable(msg):
+            msg = msg()
+        self.logger.log(level, msg, *args)
+
+    def info(self, msg, *args):
+        self._log(logging.INFO, msg, args)
+
+    def debug(self, msg, *args):
+        self._log(logging.DEBUG, msg, args)
+
+    def warning(self, msg, *args):
+        self._log(logging.WARNING, msg, args)
+
+    def error(self, msg, *args):
+        self._log(logging.ERROR, msg, args)
 
     def exception(self, err):
         self.logger.exception(err)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child = ACSLog.afterFork)
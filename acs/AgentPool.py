@@ -1,7 +1,8 @@
 from .ACSLogs import *
+from .AzureCLI import AzureCLI
 
 import json
-import subprocess
+import time
 
 class AgentPool:
     """
@@ -11,6 +12,11 @@ class AgentPool:
     (VMSS).
 
     """
+    # seconds to wait for a scale operation to complete
+    scale_timeout = 1800
+    poll_interval = 2
+    max_poll_interval = 30
+
     def __init__(self, config):
         self.log = ACSLog("AgentPool")
         defaults = {"orchestratorType": "Mesos"}
@@ -21,10 +27,9 @@ class AgentPool:
         Get a list of all the agent pools in this resource group
         """
         rg_name = self.config.get('Group', 'name')
-        cmd = "azure vmss list " + rg_name + " --json"
-        vmss_list = json.loads(subprocess.check_output(cmd, shell=True).decode("utf-8"))
+        vmss_list = AzureCLI.json(["vmss", "list", rg_name])
 
-        self.log.debug("List of VMSS: " + json.dumps(vmss_list, indent=True))
+        self.log.debug(lambda: "List of VMSS: " + json.dumps(vmss_list, indent=True))
         return vmss_list
 
     def getNICs(self):
@@ -33,12 +38,11 @@ class AgentPool:
         """
         rg_name = self.config.get('Group', 'name')
         nics = []
-        cmd = "azure network nic list " + rg_name + " --json"
-        nic_list = json.loads(subprocess.check_output(cmd, shell=True).decode("utf-8"))
+        nic_list = AzureCLI.json(["network", "nic", "list", rg_name])
             
         for nic in nic_list:
             if "agent" in nic["name"]:
-                self.log.debug("Adding NIC to list of Agent NICs:\n" + json.dumps(nic, indent=True))
+                self.log.debug(lambda: "Adding NIC to list of Agent NICs:\n" + json.dumps(nic, indent=True))
                 nics.append(nic)
             
         return nics
@@ -52,12 +56,83 @@ class AgentPool:
         vmss_list = self.getPools()
         for vmss in vmss_list:
             vmss_name = vmss['name']
-            self.log.debug("Looking up VMs in VMSS called " + vmss_name)
+            self.log.debug("Looking up VMs in VMSS called %s", vmss_name)
 
-            cmd = "azure vmssvm list " + rg_name + " " + vmss_name + " --json"
-            vmssvms = json.loads(subprocess.check_output(cmd, shell=True).decode("utf-8"))
+            vmssvms = AzureCLI.json(["vmssvm", "list", rg_name, vmss_name])
             for vm in vmssvms:
                 vms.append(vm)
 
         return vms
 
+    def getPrimaryPool(self):
+        """
+        Get the name of the pool whose size is the `agentCount` in the
+        config, the private agents.
+        """
+        names = [vmss["name"] for vmss in self.getPools()]
+        for name in names:
+            if "agent" in name and "public" not in name:
+                return name
+        if not names:
+            raise RuntimeError("There are no agent pools in " + self.config.get('Group', 'name'))
+        return names[0]
+
+    def getPool(self, pool):
+        """
+        Get the current state of a pool, without using cached results.
+        """
+        rg_name = self.config.get('Group', 'name')
+        return AzureCLI.json(["vmss", "show", rg_name, pool], cached = False)
+
+    def scale(self, pool, capacity):
+        """
+        Set the number of agents in a pool (the primary pool if `pool`
+        is None) to `capacity`, up or down. Only the capacity of the
+        scale set is changed, the rest of the deployment is left
+        alone. Waits for the scale set to finish provisioning and, if
+        the primary pool was scaled, records the new `agentCount` in
+        the config file. Returns the name of the pool scaled.
+        """
+        capacity = int(capacity)
+        if capacity < 0:
+            raise ValueError("Capacity must not be negative, got " + str(capacity))
+        primary = self.getPrimaryPool()
+        if pool is None:
+            pool = primary
+
+        rg_name = self.config.get('Group', 'name')
+        self.log.info("Scaling %s to %d agents", pool, capacity)
+        output, errors = AzureCLI.execute(["vmss", "scale", "--resource-group", rg_name, "--name", pool,
+                                           "--new-capacity", str(capacity)])
+        if errors:
+            msg = "Unable to scale " + pool + ": " + errors
+            self.log.error(msg)
+            raise RuntimeError(msg)
+
+        vmss = self.waitForProvisioning(pool)
+        if vmss.get("provisioningState") != "Succeeded":
+            msg = "Scaling " + pool + " finished in state " + str(vmss.get("provisioningState"))
+            self.log.error(msg)
+            raise RuntimeError(msg)
+
+        if pool == primary:
+            self.config.set('ACS', 'agentCount', capacity)
+        return pool
+
+    def waitForProvisioning(self, pool):
+        """
+        Poll the state of a pool, backing off exponentially, until it
+        is no longer being provisioned. Returns the final state.
+        """
+        deadline = time.time() + self.scale_timeout
+        interval = self.poll_interval
+        while True:
+            vmss = self.getPool(pool)
+            state = vmss.get("provisioningState")
+            self.log.debug("Provisioning state of %s is %s", pool, state)
+            if state in ("Succeeded", "Failed", "Canceled"):
+                return vmss
+            if time.time() + interval > deadline:
+                raise RuntimeError("Timed out waiting for " + pool + " to scale, it is " + str(state))
+            time.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
@@ -0,0 +1,143 @@
+"""Per-agent results of commands that fan out across the cluster.
+
+Commands such as `acs docker` and the feature installers run the same
+work on every agent. Each agent's outcome is recorded as an
+`AgentResult` and reported by a `ResultWriter` in one of these formats:
+
+  text      each agent's output in turn, under a heading naming it
+  compact   agents with identical results are grouped under a single
+            heading, like `clush -b`, so the odd one out stands out
+  json      a JSON array of records
+  ndjson    one JSON record per line
+
+The JSON formats are written as each agent finishes, rather than once
+all of them have, so they can be piped into other tools as the command
+progresses.
+
+"""
+from collections import OrderedDict
+import json
+import sys
+import threading
+
+class AgentResult:
+    """
+
+    The outcome of running a command on an agent. `status` is the
+    exit status, None if the command could not be run at all, and
+    `duration` is in seconds.
+
+    """
+    def __init__(self, ip, status, stdout, stderr, duration):
+        self.ip = ip
+        self.status = status
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+
+    def succeeded(self):
+        return self.status == 0
+
+    def toDict(self):
+        return OrderedDict([
+            ("host", self.ip),
+            ("status", self.status),
+            ("stdout", self.stdout),
+            ("stderr", self.stderr),
+            ("duration", round(self.duration, 3))
+        ])
+
+    def __repr__(self):
+        return "AgentResult(" + repr(self.ip) + ", status=" + str(self.status) + ", duration=" + str(self.duration) + ")"
+
+class ResultWriter:
+    """
+
+    Reports `AgentResult`s in one of `formats`. Call `add()` with each
+    result as it becomes available, from any thread, then `close()`
+    once all have been added. Only the first result for each agent is
+    reported, and results added after `close()` are ignored (a command
+    cancelled at a deadline may finish late). JSON formats are
+    written to `out` by `add()`; `close()` returns the text to display
+    for the text formats, and an empty string for the JSON formats.
+
+    `title`, if given, is included in the text headings (for example
+    the command that was run).
+
+    """
+    formats = ("text", "compact", "json", "ndjson")
+
+    def __init__(self, format = "text", title = None, out = None):
+        if format not in self.formats:
+            raise ValueError("Output format must be one of " + ", ".join(self.formats) + ", got '" + str(format) + "'")
+        self.format = format
+        self.title = title
+        self.out = out if out is not None else sys.stdout
+        self.results = []
+        self.closed = False
+        self._hosts = set()
+        self._lock = threading.Lock()
+
+    def add(self, result):
+        with self._lock:
+            if self.closed or result.ip in self._hosts:
+                return
+            self._hosts.add(result.ip)
+            self.results.append(result)
+            if self.format == "ndjson":
+                self.out.write(json.dumps(result.toDict()) + "\n")
+                self.out.flush()
+            elif self.format == "json":
+                self.out.write(("[\n" if len(self.results) == 1 else ",\n") + json.dumps(result.toDict()))
+                self.out.flush()
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            if self.format == "json":
+                self.out.write("\n]\n" if self.results else "[]\n")
+                self.out.flush()
+                return ""
+            if self.format == "ndjson":
+                return ""
+            results = sorted(self.results, key = lambda result: self._sortKey(result.ip))
+            if self.format == "compact":
+                return self._compact(results)
+            return "".join(self._heading(result.ip) + self._body(result) for result in results)
+
+    def _compact(self, results):
+        groups = OrderedDict()
+        for result in results:
+            key = (result.status, result.stdout, result.stderr)
+            groups.setdefault(key, []).append(result.ip)
+
+        output = ""
+        for (status, stdout, stderr), ips in groups.items():
+            heading = ",".join(ips) + " (" + str(len(ips)) + ")"
+            if status != 0:
+                heading = heading + " [status " + str(status) + "]"
+            rule = "-" * min(len(heading), 79)
+            output = output + rule + "\n" + heading + "\n" + rule + "\n"
+            output = output + self._body(AgentResult(None, status, stdout, stderr, 0))
+        return output
+
+    def _heading(self, ip):
+        if self.title:
+            return ip + ": " + self.title + "\n"
+        return ip + ":\n"
+
+    def _body(self, result):
+        output = result.stdout
+        if output and not output.endswith("\n"):
+            output = output + "\n"
+        if not result.succeeded() and result.stderr:
+            output = output + result.stderr
+            if not output.endswith("\n"):
+                output = output + "\n"
+        return output
+
+    def _sortKey(self, ip):
+        try:
+            return (0, tuple(int(part) for part in ip.split(".")))
+        except ValueError:
+            return (1, ip)
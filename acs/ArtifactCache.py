@@ -0,0 +1,149 @@
+"""A local cache of the files we install on clusters.
+
+Installing a feature used to have every agent download the same
+driver or bundle from GitHub. Instead each artifact is downloaded once
+to `~/.acs/artifacts` on the client and pushed to the agents over SSH,
+so agents don't need internet access and GitHub is asked once.
+
+Files are stored by the SHA-256 of their content, with an index from
+(URL, version) to that hash. A cached file is checked against its hash
+before it is used, and a download is checked against the expected hash
+if one is known. Content published at a URL that changes (e.g. a
+branch) is fetched with a `ttl`, after which it is downloaded again.
+
+"""
+from .ACSLogs import *
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+class Artifact:
+    """
+    A file in the cache. `path` is its location on the client and
+    `filename` the name it was published under.
+    """
+    def __init__(self, url, version, sha256, path):
+        self.url = url
+        self.version = version
+        self.sha256 = sha256
+        self.path = path
+        self.filename = url.rstrip("/").split("/")[-1]
+
+class ArtifactCache:
+    """
+
+    Content addressed cache of downloaded artifacts.
+
+    """
+    cache_dir = os.path.expanduser("~/.acs/artifacts")
+    chunk_size = 65536
+
+    _lock = threading.Lock()
+    log = ACSLog("ArtifactCache")
+
+    @classmethod
+    def fetch(cls, url, version = None, sha256 = None, ttl = None):
+        """
+        Get an artifact, downloading it if it is not already cached.
+        `version` distinguishes different content published at the
+        same URL. If `sha256` is given the content must have that hash.
+        If `ttl` is given the cached copy is downloaded again once it
+        is that many seconds old, the old copy being used if that
+        fails. Raises `IOError` if the content does not match its hash.
+        """
+        with cls._lock:
+            entry = cls._readIndex(url, version)
+            cached = None
+            if entry is not None and (sha256 is None or entry["sha256"] == sha256):
+                path = cls._blobPath(entry["sha256"])
+                if os.path.isfile(path) and cls.checksum(path) == entry["sha256"]:
+                    cached = Artifact(url, version, entry["sha256"], path)
+                    if ttl is None or time.time() - entry.get("fetched", 0) < ttl:
+                        cls.log.debug("Using cached %s", url)
+                        return cached
+                    cls.log.debug("Cached copy of %s has expired, downloading it again", url)
+                else:
+                    cls.log.warning("Cached copy of %s is missing or corrupt, downloading it again", url)
+
+            try:
+                digest = cls._download(url, sha256)
+            except OSError as e:
+                if cached is None:
+                    raise
+                cls.log.warning("Unable to download %s again (%s), using the cached copy", url, e)
+                return cached
+            cls._writeIndex(url, version, digest)
+            return Artifact(url, version, digest, cls._blobPath(digest))
+
+    @classmethod
+    def forFile(cls, path):
+        """
+        Get an artifact for a local file, without caching it.
+        """
+        path = os.path.abspath(os.path.expanduser(path))
+        return Artifact(path, None, cls.checksum(path), path)
+
+    @classmethod
+    def checksum(cls, path):
+        """
+        Get the SHA-256 of a file.
+        """
+        digest = hashlib.sha256()
+        with open(path, "rb") as artifact_file:
+            for chunk in iter(lambda: artifact_file.read(cls.chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @classmethod
+    def _download(cls, url, sha256):
+        # imported here as it is slow to import and most runs never download
+        import urllib.request
+
+        cls.log.info("Downloading %s", url)
+        os.makedirs(os.path.join(cls.cache_dir, "blobs"), exist_ok=True)
+        tmp_path = os.path.join(cls.cache_dir, "blobs", "download." + str(os.getpid()) + ".tmp")
+        digest = hashlib.sha256()
+        try:
+            with urllib.request.urlopen(url) as response, open(tmp_path, "wb") as artifact_file:
+                for chunk in iter(lambda: response.read(cls.chunk_size), b""):
+                    digest.update(chunk)
+                    artifact_file.write(chunk)
+            if sha256 is not None and digest.hexdigest() != sha256:
+                raise IOError("Checksum of " + url + " is " + digest.hexdigest() + ", expected " + sha256)
+            os.replace(tmp_path, cls._blobPath(digest.hexdigest()))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return digest.hexdigest()
+
+    @classmethod
+    def _blobPath(cls, sha256):
+        return os.path.join(cls.cache_dir, "blobs", sha256)
+
+    @classmethod
+    def _indexPath(cls, url, version):
+        key = hashlib.sha256(json.dumps([url, version]).encode("utf-8")).hexdigest()
+        return os.path.join(cls.cache_dir, "index", key + ".json")
+
+    @classmethod
+    def _readIndex(cls, url, version):
+        try:
+            with open(cls._indexPath(url, version)) as index_file:
+                entry = json.load(index_file)
+        except (OSError, ValueError):
+            return None
+        if entry.get("url") != url or entry.get("version") != version:
+            return None
+        return entry
+
+    @classmethod
+    def _writeIndex(cls, url, version, sha256):
+        path = cls._indexPath(url, version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_path, "w") as index_file:
+            json.dump({"url": url, "version": version, "sha256": sha256, "fetched": time.time()}, index_file)
+        os.replace(tmp_path, path)
@@ -0,0 +1,395 @@
+"""Invocation of the `azure` command line tool.
+
+The `azure` CLI is a Node application and each invocation costs
+seconds of startup time. Commands frequently ask it for the same
+information (the NICs in the resource group, the storage account keys,
+etc.) many times in a single run. All invocations of the CLI should go
+through `AzureCLI` so that read only commands can be memoized.
+
+Read only commands (those whose verb is `list` or `show`) are cached
+for the rest of the process. If the `ACS_CACHE_TTL` environment
+variable is set to a number of seconds they are also cached on disk in
+`~/.acs/cache/azure` for that long, keyed by the default subscription
+as well as the arguments, so that subsequent runs against the same
+subscription can reuse them. Concurrent identical calls are collapsed into a single
+invocation. Any other command is assumed to modify the resources and
+clears the cache, both before it runs and once it has completed, so
+that results read while it was running are not kept.
+
+Before the first invocation in a process we make sure the user is
+logged in. A successful check is recorded in `~/.acs/session`, keyed
+by subscription, and trusted for `ACS_LOGIN_TTL` seconds (default one
+hour) or until the Azure CLI profile changes, so that most runs never
+need to spawn `azure account show`.
+
+"""
+from .ACSLogs import *
+from .Trace import Trace
+
+import hashlib
+import json
+import os
+import subprocess
+import threading
+import time
+
+class _Flight:
+    """A CLI invocation that other threads are waiting on."""
+    def __init__(self):
+        self.event = threading.Event()
+        self.output = None
+        self.error = None
+
+class AzureCLI:
+    """
+
+    Memoizing wrapper around the `azure` command line tool. All
+    methods take the CLI arguments, excluding `azure` itself, as a
+    list.
+
+    """
+    cache_dir = os.path.expanduser("~/.acs/cache/azure")
+    session_dir = os.path.expanduser("~/.acs/session")
+    profile_path = os.path.expanduser("~/.azure/azureProfile.json")
+    read_only_verbs = ("list", "show")
+    mutating_verbs = ("create", "delete", "set", "update", "scale", "start", "stop",
+                      "restart", "deallocate", "reimage", "login", "logout")
+    secret_options = ("--account-key", "--password", "--secret")
+
+    _memo = {}
+    _inflight = {}
+    _generation = 0
+    _lock = threading.Lock()
+    _logged_in = False
+    _login_lock = threading.Lock()
+    log = ACSLog("AzureCLI")
+
+    @classmethod
+    def ttl(cls):
+        """
+        The number of seconds read only results are cached on disk
+        for, 0 if they should only be cached in memory.
+        """
+        try:
+            return max(0, int(os.environ.get("ACS_CACHE_TTL", 0)))
+        except ValueError:
+            cls.log.warning("ACS_CACHE_TTL must be a number of seconds, ignoring it")
+            return 0
+
+    @classmethod
+    def login(cls, force = False):
+        """
+        Ensure the user is logged in to Azure, logging in
+        interactively if necessary. Unless `force` is True a recent
+        successful check for the current subscription is trusted
+        without running the CLI. Returns a message describing the
+        result.
+        """
+        with cls._login_lock:
+            if cls._logged_in and not force:
+                return "Logged in to Azure"
+            if not force and cls._hasSession():
+                cls.log.debug("Using cached Azure login session")
+                cls._logged_in = True
+                return "Logged in to Azure"
+
+            output, errors = cls._accountShow()
+            if errors:
+                # Not currently logged in
+                with cls._span(["login"]):
+                    p = subprocess.Popen(["azure", "login"], stderr=subprocess.PIPE)
+                    output, errors = p.communicate()
+                if errors:
+                    return "Failed to login: " + errors.decode("utf-8")
+                output, errors = cls._accountShow()
+
+            if not errors:
+                cls._recordSessions(output)
+            cls._logged_in = True
+            return "Logged in to Azure"
+
+    @classmethod
+    def _accountShow(cls):
+        with cls._span(["account", "show", "--json"]):
+            p = subprocess.Popen(["azure", "account", "show", "--json"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            return p.communicate()
+
+    @classmethod
+    def _recordSessions(cls, output):
+        """
+        Record a session for each subscription in the output of
+        `azure account show --json`.
+        """
+        try:
+            accounts = json.loads(output.decode("utf-8"))
+            for account in accounts:
+                cls._writeSession(account["id"])
+        except (ValueError, KeyError, TypeError) as e:
+            cls.log.debug("Unable to record Azure login session: " + str(e))
+
+    @classmethod
+    def loginTTL(cls):
+        try:
+            return max(0, int(os.environ.get("ACS_LOGIN_TTL", 3600)))
+        except ValueError:
+            cls.log.warning("ACS_LOGIN_TTL must be a number of seconds, ignoring it")
+            return 3600
+
+    @classmethod
+    def _defaultSubscription(cls):
+        """
+        Read the default subscription ID from the Azure CLI profile,
+        without running the CLI. Returns None if there isn't one.
+        """
+        try:
+            with open(cls.profile_path, encoding="utf-8-sig") as profile_file:
+                profile = json.load(profile_file)
+        except (OSError, ValueError):
+            return None
+        for subscription in profile.get("subscriptions", []):
+            if subscription.get("isDefault"):
+                return subscription.get("id")
+        return None
+
+    @classmethod
+    def _hasSession(cls):
+        subscription = cls._defaultSubscription()
+        if subscription is None:
+            return False
+        path = os.path.join(cls.session_dir, subscription)
+        try:
+            modified = os.path.getmtime(path)
+            if modified < os.path.getmtime(cls.profile_path):
+                return False
+        except OSError:
+            return False
+        return time.time() - modified < cls.loginTTL()
+
+    @classmethod
+    def _writeSession(cls, subscription):
+        os.makedirs(cls.session_dir, exist_ok=True)
+        with open(os.path.join(cls.session_dir, subscription), "w") as session_file:
+            session_file.write(str(time.time()))
+
+    @classmethod
+    def isReadOnly(cls, args):
+        """
+        True if the command only reads resources. This is decided by
+        the first verb in the arguments, so that a resource named
+        "list" does not make `group create list` look read only.
+        """
+        for arg in args:
+            if arg in cls.read_only_verbs:
+                return True
+            if arg in cls.mutating_verbs:
+                return False
+        return False
+
+    @classmethod
+    def json(cls, args, persist = True, cached = True):
+        """
+        Run a CLI command with `--json` and return the parsed output.
+        """
+        return json.loads(cls.check_output(list(args) + ["--json"], persist, cached))
+
+    @classmethod
+    def check_output(cls, args, persist = True, cached = True):
+        """
+        Run a CLI command and return its output as a string, raising
+        `subprocess.CalledProcessError` if it fails. Read only commands
+        are memoized, if `persist` is False the result is never written
+        to disk (use this for results containing secrets). If `cached`
+        is False the command is always run, for example when polling
+        for a change of state, and the result is not memoized.
+        """
+        args = list(args)
+        cls.login()
+        if not cls.isReadOnly(args):
+            cls.invalidate()
+            try:
+                return cls._check_output(args)
+            finally:
+                cls.invalidate()
+        if not cached:
+            return cls._check_output(args)
+
+        key = tuple(args)
+        with cls._lock:
+            if key in cls._memo:
+                cls.log.debug("Using memoized result of: azure %s", cls._redact(args))
+                return cls._memo[key]
+            flight = cls._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                cls._inflight[key] = flight
+            generation = cls._generation
+
+        if not leader:
+            cls.log.debug("Waiting for in flight call of: azure %s", cls._redact(args))
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.output
+
+        try:
+            output = cls._readDisk(args) if persist else None
+            read = output is None
+            if read:
+                output = cls._check_output(args)
+            flight.output = output
+            # unless the resources were modified while we were reading them
+            with cls._lock:
+                if generation == cls._generation:
+                    cls._memo[key] = output
+                    if read and persist:
+                        cls._writeDisk(args, output)
+            return output
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with cls._lock:
+                del cls._inflight[key]
+            flight.event.set()
+
+    @classmethod
+    def execute(cls, args):
+        """
+        Run a CLI command that modifies resources and return a tuple
+        of (output, errors) as strings. The cache is cleared before and
+        after.
+        """
+        cls.login()
+        cls.invalidate()
+        cls.log.debug("Executing: azure %s", cls._redact(args))
+        try:
+            with cls._span(args):
+                p = subprocess.Popen(["azure"] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                output, errors = p.communicate()
+        finally:
+            cls.invalidate()
+        return output.decode("utf-8"), errors.decode("utf-8")
+
+    @classmethod
+    def start(cls, args):
+        """
+        Start a CLI command that modifies resources without waiting
+        for it to complete. The cache is cleared, and the caller must
+        `invalidate()` it again once the command has completed. Returns
+        the `subprocess.Popen`, with its output and errors piped.
+        """
+        cls.login()
+        cls.invalidate()
+        cls.log.debug("Starting: azure %s", cls._redact(args))
+        # only the time taken to spawn it is traced, it runs on in the background
+        with cls._span(args):
+            return subprocess.Popen(["azure"] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    @classmethod
+    def system(cls, command):
+        """
+        Run a CLI command line, as a string starting with `azure`,
+        attached to the terminal so the user can see its progress and
+        respond to prompts. The cache is cleared before and after.
+        Returns the exit status as `os.system` does.
+        """
+        cls.login()
+        cls.invalidate()
+        cls.log.debug("Executing: %s", cls._redact(command.split()))
+        try:
+            with cls._span(command.split()[1:]):
+                return os.system(command)
+        finally:
+            cls.invalidate()
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Forget all memoized results, in memory and on disk.
+        """
+        with cls._lock:
+            cls._memo.clear()
+            cls._generation = cls._generation + 1
+        if os.path.isdir(cls.cache_dir):
+            for filename in os.listdir(cls.cache_dir):
+                try:
+                    os.remove(os.path.join(cls.cache_dir, filename))
+                except OSError:
+                    pass
+
+    @classmethod
+    def _check_output(cls, args):
+        cls.log.debug("Executing: azure %s", cls._redact(args))
+        with cls._span(args):
+            return subprocess.check_output(["azure"] + args).decode("utf-8")
+
+    @classmethod
+    def _span(cls, args):
+        """
+        The trace span of an invocation of the CLI, named after the
+        command (e.g. "azure network nic list"). The values of
+        `secret_options` are not written to the trace.
+        """
+        if not Trace.enabled:
+            return Trace.span("azure", "azure")
+        words = []
+        for arg in args[:4]:
+            if arg.startswith("-"):
+                break
+            words.append(arg)
+            if arg in cls.read_only_verbs or arg in cls.mutating_verbs:
+                break
+        return Trace.span(" ".join(["azure"] + words), "azure", args = cls._redact(args))
+
+    @classmethod
+    def _redact(cls, args):
+        """
+        The arguments as a string for logs and traces, with the values
+        of `secret_options` replaced by "***".
+        """
+        shown = list(args)
+        for i in range(1, len(shown)):
+            if shown[i - 1] in cls.secret_options:
+                shown[i] = "***"
+        return " ".join(shown)
+
+    @classmethod
+    def _cachePath(cls, args):
+        """
+        The file caching the output of `args`. The default subscription
+        is part of the key, as the same arguments (e.g. `group list`)
+        give different results after `azure account set`.
+        """
+        key = [cls._defaultSubscription(), args]
+        digest = hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+        return os.path.join(cls.cache_dir, digest + ".json")
+
+    @classmethod
+    def _readDisk(cls, args):
+        ttl = cls.ttl()
+        if not ttl:
+            return None
+        path = cls._cachePath(args)
+        try:
+            if time.time() - os.path.getmtime(path) > ttl:
+                return None
+            with open(path) as cache_file:
+                entry = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+        if entry.get("args") != args:
+            return None
+        cls.log.debug("Using cached result of: azure %s", cls._redact(args))
+        return entry["output"]
+
+    @classmethod
+    def _writeDisk(cls, args, output):
+        if not cls.ttl():
+            return
+        os.makedirs(cls.cache_dir, exist_ok=True)
+        path = cls._cachePath(args)
+        tmp_path = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_path, "w") as cache_file:
+            json.dump({"args": args, "output": output}, cache_file)
+        os.replace(tmp_path, path)
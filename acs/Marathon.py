@@ -0,0 +1,369 @@
+"""A minimal client for the Marathon REST API.
+
+Talks to `/marathon/v2` on the DC/OS master through the SSH tunnel
+opened by `acs service connect`, reusing a single keep-alive HTTP
+connection for all requests rather than spawning `dcos` or `curl` for
+each one.
+
+"""
+from .ACSLogs import *
+
+import http.client
+import json
+import socket
+import time
+import urllib.parse
+
+class MarathonError(RuntimeError):
+    """
+    An error response from Marathon. `status` is the HTTP status code.
+    """
+    def __init__(self, status, message):
+        RuntimeError.__init__(self, "Marathon returned " + str(status) + ": " + message)
+        self.status = status
+        self.message = message
+
+class Marathon:
+    """
+
+    Client for the Marathon REST API. Methods return the decoded JSON
+    response and raise `MarathonError` on an error response.
+
+    """
+    def __init__(self, host = "localhost", port = 80, base_path = "/marathon/v2", timeout = 30):
+        self.log = ACSLog("Marathon")
+        self.host = host
+        self.port = port
+        self.base_path = base_path
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, method, path, body = None, params = None):
+        """
+        Make a request to the API, `path` being relative to the base
+        path (e.g. "apps"). `body` is encoded as JSON. If the server
+        has closed the keep-alive connection the request is retried
+        once on a new connection.
+        """
+        url = self.base_path + "/" + path.lstrip("/")
+        if params:
+            url = url + "?" + urllib.parse.urlencode(params)
+        headers = {"Accept": "application/json"}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+
+        self.log.debug("Marathon request: %s %s", method, url)
+        try:
+            response = self._send(method, url, data, headers)
+        except (http.client.RemoteDisconnected, http.client.CannotSendRequest, ConnectionResetError, BrokenPipeError):
+            self.close()
+            response = self._send(method, url, data, headers)
+
+        content = response.read().decode("utf-8")
+        if response.status >= 400:
+            try:
+                message = json.loads(content).get("message", content)
+            except (ValueError, AttributeError):
+                message = content
+            raise MarathonError(response.status, message)
+        if not content:
+            return None
+        return json.loads(content)
+
+    def _send(self, method, url, data, headers):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout = self.timeout)
+        self.connection.request(method, url, data, headers)
+        return self.connection.getresponse()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _id(self, app_id):
+        return urllib.parse.quote(app_id.strip("/"))
+
+    # Apps
+
+    def getApps(self):
+        return self.request("GET", "apps")["apps"]
+
+    def getApp(self, app_id):
+        return self.request("GET", "apps/" + self._id(app_id))["app"]
+
+    def createApp(self, app):
+        return self.request("POST", "apps", app)
+
+    def updateApp(self, app_id, app, force = False):
+        """
+        Update (or create) an app. Returns the deployment started.
+        """
+        return self.request("PUT", "apps/" + self._id(app_id), app, {"force": "true"} if force else None)
+
+    def deleteApp(self, app_id):
+        return self.request("DELETE", "apps/" + self._id(app_id))
+
+    def restartApp(self, app_id):
+        return self.request("POST", "apps/" + self._id(app_id) + "/restart")
+
+    def getAppTasks(self, app_id):
+        return self.request("GET", "apps/" + self._id(app_id) + "/tasks")["tasks"]
+
+    # Groups
+
+    def getGroups(self):
+        return self.request("GET", "groups")
+
+    def getGroup(self, group_id):
+        return self.request("GET", "groups/" + self._id(group_id))
+
+    def createGroup(self, group):
+        return self.request("POST", "groups", group)
+
+    def updateGroup(self, group_id, group, force = False):
+        return self.request("PUT", "groups/" + self._id(group_id), group, {"force": "true"} if force else None)
+
+    def deleteGroup(self, group_id):
+        return self.request("DELETE", "groups/" + self._id(group_id))
+
+    # Deployments
+
+    def getDeployments(self):
+        return self.request("GET", "deployments")
+
+    def deleteDeployment(self, deployment_id):
+        return self.request("DELETE", "deployments/" + self._id(deployment_id))
+
+    def deploymentIds(self, result):
+        """
+        Get the IDs of the deployments started by a request, from the
+        response to it.
+        """
+        if not isinstance(result, dict):
+            return []
+        if "deploymentId" in result:
+            return [result["deploymentId"]]
+        return [deployment["id"] for deployment in result.get("deployments", [])]
+
+    def deploymentTargets(self, result, app_id = None, group_id = None, removed = False):
+        """
+        Get what the deployments started by a request should achieve,
+        for `waitForDeployments()`, from the response to it: a
+        dictionary mapping each deployment ID to the app (or group)
+        and either the version it should be running or, if `removed`,
+        that it should no longer exist.
+        """
+        target = {"removed": removed}
+        if group_id is not None:
+            target["group"] = group_id
+        else:
+            target["app"] = app_id
+        if not removed and isinstance(result, dict):
+            target["version"] = result.get("version")
+        return dict((deployment_id, target) for deployment_id in self.deploymentIds(result))
+
+    def waitForDeployments(self, deployment_ids, timeout = 600, targets = None):
+        """
+        Wait for deployments to finish. Returns a dictionary mapping
+        each deployment ID to "succeeded", "failed", "timed out" or
+        "unknown".
+
+        Completion is learnt from the event stream as it happens. If
+        a deployment finishes without us seeing its event (because it
+        finished before we subscribed, or the event stream is
+        unavailable and we are polling the running deployments) its
+        outcome is worked out from the state of its target, given in
+        `targets` (see `deploymentTargets()`), by
+        `deploymentOutcome()`.
+        """
+        pending = set(deployment_ids)
+        targets = targets or {}
+        results = {}
+        deadline = time.time() + timeout
+        if not pending:
+            return results
+
+        try:
+            # Subscribe before checking what is still running so that
+            # no completion can be missed in between
+            events = self.events(["deployment_success", "deployment_failed"], deadline = deadline)
+        except (MarathonError, http.client.HTTPException, OSError) as e:
+            self.log.debug("Marathon event stream unavailable (%s), polling deployments", e)
+            return self._pollDeployments(pending, deadline, results, targets)
+
+        try:
+            self._checkDeployments(pending, results, targets)
+            while pending and time.time() < deadline:
+                event_type, data = next(events)
+                deployment_id = data.get("id") if isinstance(data, dict) else None
+                if deployment_id in pending:
+                    pending.discard(deployment_id)
+                    results[deployment_id] = "succeeded" if event_type == "deployment_success" else "failed"
+        except (StopIteration, http.client.HTTPException, ConnectionError) as e:
+            self.log.debug("Marathon event stream closed (%s), polling deployments", e)
+            return self._pollDeployments(pending, deadline, results, targets)
+        except OSError:
+            # socket timeout, we've waited long enough
+            pass
+        finally:
+            events.close()
+
+        for deployment_id in pending:
+            results[deployment_id] = "timed out"
+        return results
+
+    def deploymentOutcome(self, target):
+        """
+        Work out whether a deployment that has finished succeeded, from
+        the state of its `target` (see `deploymentTargets()`). Returns
+        "succeeded", "failed" or, if that can't be told, "unknown".
+
+        An app (or group) that should have been removed must be gone.
+        Otherwise it must still be at the version deployed (if not the
+        deployment was rolled back or superseded) with all of its
+        instances running and healthy, and a task failure at that
+        version means the deployment failed.
+        """
+        if not target:
+            return "unknown"
+        try:
+            if "group" in target:
+                current = self.getGroup(target["group"])
+            else:
+                current = self.getApp(target["app"])
+        except MarathonError as e:
+            if e.status != 404:
+                self.log.debug("Unable to get the state of %s: %s", target, e)
+                return "unknown"
+            return "succeeded" if target["removed"] else "failed"
+        if target["removed"]:
+            return "failed"
+        if target.get("version") is None:
+            return "unknown"
+        if current.get("version") != target["version"]:
+            return "failed"
+
+        if "group" not in target:
+            return self._appOutcome(current)
+        outcomes = set()
+        for app in current.get("apps", []):
+            # only the apps changed by the deployment have its version
+            if app.get("version") == target["version"]:
+                outcomes.add(self._appOutcome(self.getApp(app["id"])))
+        for outcome in ("failed", "unknown"):
+            if outcome in outcomes:
+                return outcome
+        return "succeeded"
+
+    def _appOutcome(self, app):
+        instances = app.get("instances", 1)
+        running = app.get("tasksRunning")
+        healthy = app.get("tasksHealthy", 0) if app.get("healthChecks") else running
+        if running is not None and running >= instances and healthy >= instances:
+            return "succeeded"
+        failure = app.get("lastTaskFailure")
+        if failure and failure.get("version") == app.get("version"):
+            return "failed"
+        return "unknown"
+
+    def _checkDeployments(self, pending, results, targets):
+        running = set(deployment["id"] for deployment in self.getDeployments())
+        for deployment_id in list(pending):
+            if deployment_id not in running:
+                pending.discard(deployment_id)
+                results[deployment_id] = self.deploymentOutcome(targets.get(deployment_id))
+                self.log.debug("Deployment %s finished without an event, it %s", deployment_id, results[deployment_id])
+
+    def _pollDeployments(self, pending, deadline, results, targets):
+        delay = 0.25
+        self._checkDeployments(pending, results, targets)
+        while pending and time.time() < deadline:
+            time.sleep(min(delay, max(0, deadline - time.time())))
+            delay = min(delay * 2, 5)
+            self._checkDeployments(pending, results, targets)
+        for deployment_id in pending:
+            results[deployment_id] = "timed out"
+        return results
+
+    # Events
+
+    def events(self, event_types = None, timeout = None, deadline = None):
+        """
+        Subscribe to the server sent event stream, on a connection of
+        its own. Returns a generator of (event_type, data) tuples, data
+        being the decoded JSON. If no event arrives within `timeout`
+        seconds, or by the `deadline` (a `time.time()`), reading raises
+        `socket.timeout`. Raises `MarathonError` if the event stream is
+        not available.
+        """
+        url = self.base_path + "/events"
+        if event_types:
+            url = url + "?" + urllib.parse.urlencode([("event_type", event_type) for event_type in event_types])
+        timeout = timeout or self.timeout
+        if deadline is not None:
+            timeout = min(timeout, max(0.001, deadline - time.time()))
+        connection = http.client.HTTPConnection(self.host, self.port, timeout = timeout)
+        try:
+            connection.request("GET", url, headers = {"Accept": "text/event-stream"})
+            # the connection lets go of its socket once it is handed to
+            # the response, we need it to shorten the timeout
+            sock = connection.sock
+            response = connection.getresponse()
+            if response.status >= 400:
+                raise MarathonError(response.status, response.read().decode("utf-8"))
+            if not response.getheader("Content-Type", "").startswith("text/event-stream"):
+                raise MarathonError(response.status, "the response is not an event stream")
+        except:
+            connection.close()
+            raise
+        return self._readEvents(connection, response, sock, timeout, deadline)
+
+    def _readEvents(self, connection, response, sock, timeout, deadline):
+        event_type = None
+        data = []
+        try:
+            while True:
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise socket.timeout("deadline passed waiting for events")
+                    sock.settimeout(min(timeout, remaining))
+                line = response.readline()
+                if not line:
+                    return
+                line = line.decode("utf-8").rstrip("\r\n")
+                if not line:
+                    if data:
+                        try:
+                            value = json.loads("\n".join(data))
+                        except ValueError:
+                            self.log.debug("Ignoring %s event with undecodable data: %s", event_type, "\n".join(data))
+                        else:
+                            yield event_type or "message", value
+                    event_type = None
+                    data = []
+                elif not line.startswith(":"):
+                    field, sep, value = line.partition(":")
+                    if value.startswith(" "):
+                        value = value[1:]
+                    if field == "event":
+                        event_type = value
+                    elif field == "data":
+                        data.append(value)
+        finally:
+            response.close()
+            connection.close()
+
+    # Tasks
+
+    def getTasks(self):
+        return self.request("GET", "tasks")["tasks"]
@@ -0,0 +1,95 @@
+"""Run an ordered list of commands on a remote host as a single script.
+
+Each command executed over SSH costs at least one network round trip,
+which adds up quickly when installing a feature needs a dozen or more
+commands per agent. A `RemoteScript` renders the commands into one
+bash script that is fed to `bash -s` over a single channel. Each step
+records its own exit status, output and duration, and the script stops
+at the first step that fails.
+
+"""
+
+import base64
+import shlex
+import uuid
+
+class StepResult:
+    """
+
+    The outcome of a single step in a `RemoteScript`.
+
+    """
+    def __init__(self, cmd, status, stdout, stderr, duration):
+        self.cmd = cmd
+        self.status = status
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+
+    def succeeded(self):
+        return self.status == 0
+
+    def __repr__(self):
+        return "StepResult(" + repr(self.cmd) + ", status=" + str(self.status) + ", duration=" + str(self.duration) + ")"
+
+class RemoteScript:
+    """
+
+    An ordered list of shell commands to be executed as one script.
+    Use `render()` to get the script to send to `bash -s` and
+    `parse()` to turn the script's output into a list of `StepResult`.
+
+    """
+    def __init__(self, steps):
+        self.steps = list(steps)
+        self.boundary = "ACS-STEP-" + uuid.uuid4().hex
+
+    def render(self):
+        """
+        Get the text of the script. Each step runs in its own `bash -c`
+        so that it behaves as it would if executed on its own. The
+        output of a step is base64 encoded so that it can never be
+        confused with the markers between steps.
+        """
+        lines = [
+            'acs_dir=$(mktemp -d)',
+            'trap \'rm -rf "$acs_dir"\' EXIT',
+            'acs_step() {',
+            '  acs_start=$(date +%s%N)',
+            '  bash -c "$2" > "$acs_dir/out" 2> "$acs_dir/err" < /dev/null',
+            '  acs_status=$?',
+            '  acs_end=$(date +%s%N)',
+            '  echo "' + self.boundary + ' $1 $acs_status $acs_start $acs_end"',
+            '  base64 -w0 < "$acs_dir/out"; echo',
+            '  base64 -w0 < "$acs_dir/err"; echo',
+            '  return $acs_status',
+            '}',
+        ]
+        for index, step in enumerate(self.steps):
+            lines.append('acs_step ' + str(index) + ' ' + shlex.quote(step) + ' || exit $?')
+        return "\n".join(lines) + "\n"
+
+    def parse(self, output):
+        """
+        Parse the output of the rendered script into a list of
+        `StepResult`, one for each step that was executed. If a step
+        failed it will be the last in the list.
+        """
+        results = []
+        lines = output.splitlines()
+        i = 0
+        while i < len(lines):
+            fields = lines[i].split()
+            if len(fields) == 5 and fields[0] == self.boundary:
+                index, status, start, end = [int(field) for field in fields[1:]]
+                stdout = self._decode(lines[i + 1] if i + 1 < len(lines) else "")
+                stderr = self._decode(lines[i + 2] if i + 2 < len(lines) else "")
+                duration = (end - start) / 1e9
+                results.append(StepResult(self.steps[index], status, stdout, stderr, duration))
+                i = i + 3
+            else:
+                i = i + 1
+        return results
+
+    def _decode(self, data):
+        return base64.b64decode(data.strip()).decode("utf-8", "replace")
@@ -0,0 +1,537 @@
+"""Persistent, pooled SSH connections to cluster hosts.
+
+Opening an SSH connection costs a TCP connect, a key exchange and an
+authentication round trip. Rather than paying that for every command
+we keep one authenticated transport per host alive for the life of the
+process and open a new channel on it for each command.
+
+Connecting is bounded by a timeout and retried, with a jittered
+exponential backoff, when it fails for a reason that may be transient
+(such as the connection being reset during the handshake). A command
+may be given a timeout after which its channel is closed, and all the
+commands in flight on a connection can be cancelled at once, so that a
+single hung host can't stall us forever. A `Cancellation` groups the
+commands and copies of one piece of work, such as a run over the
+agents, so that they can be cancelled together and nothing more is
+started for it afterwards.
+
+"""
+from .ACSLogs import *
+from .Trace import Trace
+
+import atexit
+import codecs
+import random
+import select
+import socket
+import threading
+import time
+
+import paramiko
+from paramiko.agent import AgentRequestHandler
+
+class CommandTimeout(RuntimeError):
+    """
+    A command did not complete within its timeout.
+    """
+
+class CommandCancelled(RuntimeError):
+    """
+    A command was cancelled before it completed.
+    """
+
+class Cancellation:
+    """
+
+    Cancels a group of operations together, e.g. those of one run of
+    `Base.forEach`. Commands and copies in progress are registered
+    with it. `cancel()` stops them and from then on `check()` raises
+    `CommandCancelled`, so that no more work is started for the group.
+
+    """
+    def __init__(self):
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._operations = set()
+
+    def check(self):
+        if self.cancelled:
+            raise CommandCancelled("Command cancelled")
+
+    def add(self, operation):
+        """
+        Register an operation in progress, an object with a `cancel()`
+        method. If we are already cancelled the operation is cancelled
+        and `CommandCancelled` raised.
+        """
+        with self._lock:
+            if not self.cancelled:
+                self._operations.add(operation)
+                return
+        operation.cancel()
+        self.check()
+
+    def discard(self, operation):
+        with self._lock:
+            self._operations.discard(operation)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            operations = list(self._operations)
+            self._operations.clear()
+        for operation in operations:
+            operation.cancel()
+
+class SSHConnection:
+    """
+
+    A single authenticated SSH transport to a host. Each command
+    executed is run on a new channel over the same transport. If the
+    transport dies (for example the master rebooted or the network
+    dropped) it is transparently re-established on the next use.
+
+    If `via` is another SSHConnection the host is reached through a
+    `direct-tcpip` channel on that connection's transport, as `ssh -J`
+    would do. This is how agents, which are only reachable from within
+    the cluster, are connected to via the master.
+
+    Each attempt to connect must complete within `connect_timeout`
+    seconds, and up to `connect_attempts` attempts are made. An SFTP
+    copy fails if it makes no progress for `connect_timeout` seconds.
+
+    The methods that start work take an optional `Cancellation`, which
+    is checked before starting and can stop the work in progress.
+
+    """
+    connect_timeout = 15
+    connect_attempts = 3
+    retry_delay = 0.5
+    max_retry_delay = 8
+
+    def __init__(self, host, port, username, key_filename, via = None, connect_timeout = None):
+        self.log = ACSLog("SSHConnection")
+        self.host = host
+        self.port = port
+        self.username = username
+        self.key_filename = key_filename
+        self.via = via
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        self.client = None
+        self.handshakes = 0
+        self._lock = threading.Lock()
+        self._streams = set()
+        self._streams_lock = threading.Lock()
+
+    def isActive(self):
+        """
+        True if we have an authenticated transport that is still alive.
+        """
+        if self.client is None:
+            return False
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def connect(self, attempts = None, cancellation = None):
+        """
+        Return an active transport to the host, connecting (or
+        reconnecting) if necessary. Failures other than authentication
+        and host key errors are retried after a random delay of up to
+        `retry_delay` seconds, the limit doubling after each attempt,
+        making up to `attempts` (by default `connect_attempts`)
+        attempts in all. No attempt is made once `cancellation` has
+        been cancelled.
+        """
+        if attempts is None:
+            attempts = self.connect_attempts
+        with self._lock:
+            if self.isActive():
+                return self.client.get_transport()
+
+            with Trace.span("ssh connect", "ssh", host = self.host, port = self.port):
+                delay = self.retry_delay
+                attempt = 1
+                while True:
+                    if cancellation is not None:
+                        cancellation.check()
+                    self._close()
+                    try:
+                        return self._connect()
+                    except (paramiko.AuthenticationException, paramiko.BadHostKeyException):
+                        raise
+                    except (paramiko.SSHException, EOFError, socket.error) as e:
+                        if attempt >= attempts:
+                            raise
+                        wait = random.uniform(0, delay)
+                        self.log.warning("Unable to connect to %s (%s), retrying in %.1f seconds", self.host, e, wait)
+                        time.sleep(wait)
+                        delay = min(delay * 2, self.max_retry_delay)
+                        attempt = attempt + 1
+
+    def _connect(self):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        if self.via is None:
+            self.log.debug("Opening SSH connection to %s:%d", self.host, self.port)
+            client.load_system_host_keys()
+            sock = None
+        else:
+            # Hosts behind the master have private addresses that are
+            # reused across clusters, so we don't check their host keys
+            # against known_hosts (as `ssh -o StrictHostKeyChecking=no`)
+            self.log.debug("Opening SSH connection to %s:%d via %s", self.host, self.port, self.via.host)
+            sock = self.via.connect().open_channel("direct-tcpip", (self.host, self.port), ("127.0.0.1", 0), timeout = self.connect_timeout)
+        try:
+            client.connect(
+                self.host,
+                port = self.port,
+                username = self.username,
+                key_filename = self.key_filename,
+                sock = sock,
+                timeout = self.connect_timeout,
+                banner_timeout = self.connect_timeout,
+                auth_timeout = self.connect_timeout)
+        except:
+            client.close()
+            raise
+        self.client = client
+        self.handshakes = self.handshakes + 1
+        return client.get_transport()
+
+    def openSession(self, cancellation = None):
+        """
+        Open a new session channel on the transport. If the transport
+        turns out to be dead we make a single attempt to reconnect and
+        try again. Failing to connect in the first place is not retried
+        here, `connect()` has already retried it.
+        """
+        transport = self.connect(cancellation = cancellation)
+        try:
+            return transport.open_session(timeout = self.connect_timeout)
+        except (paramiko.SSHException, EOFError, socket.error) as e:
+            self.log.debug("SSH transport to " + self.host + " failed (" + str(e) + "), reconnecting")
+            self.close()
+            return self.connect(attempts = 1, cancellation = cancellation).open_session(timeout = self.connect_timeout)
+
+    def execute(self, cmd, forward_agent = False, stdin = None, timeout = None, cancellation = None):
+        """
+        Execute a command on a new channel and wait for it to
+        complete. If `stdin` is provided it is sent to the command as
+        its standard input. Returns a tuple of (exit_status, stdout,
+        stderr), the output being decoded strings.
+
+        If `timeout` is given and the command has not completed after
+        that many seconds its channel is closed and `CommandTimeout`
+        is raised. `CommandCancelled` is raised if `cancel()` is
+        called, or `cancellation` is cancelled, while the command is
+        running.
+        """
+        stdout = []
+        stderr = []
+        with self.stream(cmd, forward_agent, stdin, timeout, cancellation) as stream:
+            for name, chunk in stream.chunks():
+                if name == "stdout":
+                    stdout.append(chunk)
+                else:
+                    stderr.append(chunk)
+            status = stream.wait()
+
+        return status, b"".join(stdout).decode("utf-8", "replace"), b"".join(stderr).decode("utf-8", "replace")
+
+    def stream(self, cmd, forward_agent = False, stdin = None, timeout = None, cancellation = None):
+        """
+        Start executing a command on a new channel and return a
+        `CommandStream` from which its output can be read as it
+        arrives. The command is cancelled if it has not completed
+        within `timeout` seconds, or when `cancellation` is cancelled.
+        """
+        if cancellation is not None:
+            cancellation.check()
+        deadline = None if timeout is None else time.time() + timeout
+        channel = self.openSession(cancellation = cancellation)
+
+        def release(stream):
+            self._release(stream)
+            if cancellation is not None:
+                cancellation.discard(stream)
+        stream = CommandStream(channel, deadline = deadline, release = release)
+        with self._streams_lock:
+            self._streams.add(stream)
+        try:
+            if cancellation is not None:
+                cancellation.add(stream)
+            if forward_agent:
+                AgentRequestHandler(channel)
+            channel.exec_command(cmd)
+            if stdin is not None:
+                channel.sendall(stdin.encode("utf-8"))
+            channel.shutdown_write()
+        except:
+            stream.close()
+            raise
+        return stream
+
+    def cancel(self):
+        """
+        Cancel every command and copy in flight on this connection,
+        closing their channels. The transport itself is left open.
+        """
+        with self._streams_lock:
+            streams = list(self._streams)
+        if streams:
+            self.log.debug("Cancelling %d commands running on %s", len(streams), self.host)
+        for stream in streams:
+            stream.cancel()
+
+    def _release(self, stream):
+        with self._streams_lock:
+            self._streams.discard(stream)
+
+    def put(self, local_path, remote_path, cancellation = None):
+        """
+        Copy a local file to the host over SFTP on the same transport
+        as commands. Paths relative to the user's home directory are
+        allowed for `remote_path`. The copy can be cancelled, like a
+        command, and fails if it stalls for `connect_timeout` seconds.
+        """
+        if cancellation is not None:
+            cancellation.check()
+        try:
+            sftp = paramiko.SFTPClient.from_transport(self.connect(cancellation = cancellation))
+        except (paramiko.SSHException, EOFError, socket.error) as e:
+            self.log.debug("SSH transport to " + self.host + " failed (" + str(e) + "), reconnecting")
+            self.close()
+            sftp = paramiko.SFTPClient.from_transport(self.connect(attempts = 1, cancellation = cancellation))
+        sftp.get_channel().settimeout(self.connect_timeout)
+        copy = _SFTPCopy(sftp)
+        with self._streams_lock:
+            self._streams.add(copy)
+        try:
+            if cancellation is not None:
+                cancellation.add(copy)
+            self.log.debug("Copying %s to %s:%s", local_path, self.host, remote_path)
+            sftp.put(local_path, remote_path)
+            if copy.cancelled:
+                raise CommandCancelled("Copy cancelled")
+        except (paramiko.SSHException, EOFError, socket.error):
+            if copy.cancelled:
+                raise CommandCancelled("Copy cancelled")
+            raise
+        finally:
+            with self._streams_lock:
+                self._streams.discard(copy)
+            if cancellation is not None:
+                cancellation.discard(copy)
+            sftp.close()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self.client is not None:
+            self.log.debug("Closing SSH connection to %s", self.host)
+            self.client.close()
+            self.client = None
+
+class _SFTPCopy:
+    """An SFTP copy in progress, cancelled by closing its channel."""
+
+    def __init__(self, sftp):
+        self.sftp = sftp
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        self.sftp.close()
+
+class CommandStream:
+    """
+
+    The output of a command executing on an SSH channel. Standard
+    output and standard error are read concurrently, as they arrive,
+    so that a command producing a lot of output on one of them can
+    never block waiting for us to read the other. Use `chunks()` for
+    raw bytes, `lines()` for decoded lines or `copyTo()` to write the
+    output straight to a file. Output is not retained, so a stream can
+    only be read once.
+
+    If the stream has a `deadline` (a `time.time()` value) reading
+    from or waiting for it after then closes the channel and raises
+    `CommandTimeout`. After `cancel()` it raises `CommandCancelled`.
+
+    """
+    def __init__(self, channel, chunk_size = 32768, deadline = None, release = None):
+        self.channel = channel
+        self.chunk_size = chunk_size
+        self.deadline = deadline
+        self.cancelled = False
+        self._release = release
+
+    def chunks(self):
+        """
+        Yield ("stdout" | "stderr", bytes) tuples as output arrives,
+        until the channel reaches EOF. The exit status may arrive
+        before the last of the output, so it does not end the output.
+        """
+        channel = self.channel
+        while True:
+            received = False
+            if channel.recv_ready():
+                yield "stdout", channel.recv(self.chunk_size)
+                received = True
+            if channel.recv_stderr_ready():
+                yield "stderr", channel.recv_stderr(self.chunk_size)
+                received = True
+            if received:
+                continue
+            self._check()
+            if channel.eof_received or channel.closed:
+                if not channel.recv_ready() and not channel.recv_stderr_ready():
+                    return
+            elif channel.exit_status_ready() and self.deadline is not None and time.time() >= self.deadline:
+                # the command has exited but its output was not closed in time
+                return
+            else:
+                select.select([channel], [], [], self._timeout(1.0))
+
+    def lines(self):
+        """
+        Yield ("stdout" | "stderr", line) tuples as each line of output
+        is completed. Lines are decoded as UTF-8 and do not include the
+        line ending.
+        """
+        decoders = {
+            "stdout": codecs.getincrementaldecoder("utf-8")("replace"),
+            "stderr": codecs.getincrementaldecoder("utf-8")("replace")
+        }
+        partial = {"stdout": "", "stderr": ""}
+        for name, chunk in self.chunks():
+            text = partial[name] + decoders[name].decode(chunk)
+            lines = text.split("\n")
+            partial[name] = lines.pop()
+            for line in lines:
+                yield name, line
+        for name in ("stdout", "stderr"):
+            text = partial[name] + decoders[name].decode(b"", True)
+            if text:
+                yield name, text
+
+    def copyTo(self, out, err = None):
+        """
+        Write standard output to the text file `out` and standard
+        error to `err` (or `out` if not provided) as it arrives.
+        Returns the exit status of the command.
+        """
+        if err is None:
+            err = out
+        decoders = {
+            "stdout": codecs.getincrementaldecoder("utf-8")("replace"),
+            "stderr": codecs.getincrementaldecoder("utf-8")("replace")
+        }
+        files = {"stdout": out, "stderr": err}
+        for name, chunk in self.chunks():
+            files[name].write(decoders[name].decode(chunk))
+            files[name].flush()
+        return self.wait()
+
+    def wait(self):
+        """
+        Wait for the command to complete and return its exit status.
+        """
+        while not self.channel.exit_status_ready():
+            self._check()
+            self.channel.status_event.wait(self._timeout(1.0))
+        self._check()
+        return self.channel.recv_exit_status()
+
+    def cancel(self):
+        """
+        Stop the command, closing its channel. Anything reading from
+        or waiting for the stream raises `CommandCancelled`.
+        """
+        self.cancelled = True
+        self.close()
+
+    def close(self):
+        self.channel.close()
+        if self._release is not None:
+            self._release(self)
+
+    def _timeout(self, interval):
+        if self.deadline is None:
+            return interval
+        return max(0, min(interval, self.deadline - time.time()))
+
+    def _check(self):
+        if self.cancelled:
+            raise CommandCancelled("Command cancelled")
+        if self.deadline is not None and time.time() >= self.deadline and not self.channel.exit_status_ready():
+            self.close()
+            raise CommandTimeout("Command did not complete in time")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class SSHPool:
+    """
+
+    A process wide pool of SSH connections, one per (host, port,
+    username, key, jump host) combination. Since the host is part of
+    the key each cluster gets its own connection and multiple clusters
+    can be used from the same process.
+
+    """
+    _connections = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, host, port, username, key_filename, via = None, connect_timeout = None):
+        """
+        Get the pooled connection for the given host, creating it if
+        necessary. If `via` is provided the host is reached through
+        that connection. The connection is not opened until it is used.
+        """
+        if via is None:
+            key = (host, port, username, key_filename, None)
+        else:
+            key = (host, port, username, key_filename, (via.host, via.port))
+        with cls._lock:
+            connection = cls._connections.get(key)
+            if connection is None:
+                connection = SSHConnection(host, port, username, key_filename, via, connect_timeout)
+                cls._connections[key] = connection
+            elif connect_timeout is not None:
+                connection.connect_timeout = connect_timeout
+        return connection
+
+    @classmethod
+    def connections(cls):
+        with cls._lock:
+            return list(cls._connections.values())
+
+    @classmethod
+    def cancelAll(cls):
+        """
+        Cancel the commands and copies in flight on every pooled
+        connection.
+        """
+        for connection in cls.connections():
+            connection.cancel()
+
+    @classmethod
+    def closeAll(cls):
+        """
+        Close every pooled connection and empty the pool.
+        """
+        with cls._lock:
+            connections = list(cls._connections.values())
+            cls._connections.clear()
+        for connection in connections:
+            connection.close()
+
+atexit.register(SSHPool.closeAll)
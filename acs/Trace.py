@@ -0,0 +1,194 @@
+"""Tracing of where the time goes in a run of the CLI.
+
+When enabled with `--trace=<file>` the slow operations (spawning the
+`azure` CLI and other local commands, SSH handshakes, commands run on
+the master and agents and setting up the tunnel) are recorded as spans
+and written, when the command completes, as a Chrome trace event file.
+Open it in chrome://tracing or https://ui.perfetto.dev to see them on
+a timeline.
+
+Each thread has its own lane, and work on an agent is drawn in the
+agent's lane, whichever thread of the pool it ran on, so a fan out to
+the agents shows as one row per agent.
+
+Tracing is off by default and then `Trace.span()` returns a shared
+object that does nothing, so the instrumentation costs no more than a
+method call:
+
+    with Trace.span("azure", "azure", args = args):
+        ...
+
+"""
+import json
+import os
+import threading
+import time
+
+class _NoSpan:
+    """What `Trace.span()` and `Trace.lane()` return when disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+class _Span:
+    """A span being timed, recorded when it exits."""
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.tid = Trace._laneId(Trace._currentLane())
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__ + ": " + str(exc_value)
+        Trace._record(self.name, self.category, self.tid, self.start, end, self.args)
+        return False
+
+class _Lane:
+    """Draws the spans of the current thread in a named lane."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        lanes = getattr(Trace._local, "lanes", None)
+        if lanes is None:
+            lanes = Trace._local.lanes = []
+        lanes.append(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        Trace._local.lanes.pop()
+        return False
+
+class Trace:
+    """
+
+    Records spans while enabled and writes them as Chrome trace
+    events. `start(path)` enables tracing and `stop()` writes the file
+    to `path`, only in the process that called `start()` (the tunnel
+    is run in a forked process).
+
+    """
+    enabled = False
+    path = None
+    process_name = "acs"
+
+    _pid = None
+    _origin = 0
+    _events = []
+    _lanes = {}
+    _lock = threading.Lock()
+    _local = threading.local()
+
+    @classmethod
+    def start(cls, path, process_name = "acs"):
+        with cls._lock:
+            cls.path = path
+            cls.process_name = process_name
+            cls._pid = os.getpid()
+            cls._origin = time.perf_counter()
+            cls._events = []
+            cls._lanes = {}
+            cls.enabled = True
+
+    @classmethod
+    def span(cls, name, category, **args):
+        """
+        A context manager timing the code it wraps as a span called
+        `name`, in `category` (e.g. "azure", "ssh"). Keyword arguments
+        are shown with the span.
+        """
+        if not cls.enabled:
+            return _NO_SPAN
+        return _Span(name, category, args)
+
+    @classmethod
+    def lane(cls, name):
+        """
+        A context manager putting the spans of the current thread in
+        the lane called `name`, e.g. that of the agent being worked on.
+        """
+        if not cls.enabled:
+            return _NO_SPAN
+        return _Lane(name)
+
+    @classmethod
+    def stop(cls):
+        """
+        Stop tracing and write the trace file. Returns the path
+        written, or None if we were not tracing.
+        """
+        with cls._lock:
+            if not cls.enabled or cls._pid != os.getpid():
+                cls.enabled = False
+                return None
+            cls.enabled = False
+            events = cls._metadata() + cls._events
+            cls._events = []
+
+        with open(cls.path, "w") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+        return cls.path
+
+    @classmethod
+    def _currentLane(cls):
+        lanes = getattr(cls._local, "lanes", None)
+        if lanes:
+            return lanes[-1]
+        return threading.current_thread().name
+
+    @classmethod
+    def _laneId(cls, lane):
+        """
+        The id of a lane, lanes being numbered in the order they are
+        first used.
+        """
+        with cls._lock:
+            tid = cls._lanes.get(lane)
+            if tid is None:
+                tid = len(cls._lanes) + 1
+                cls._lanes[lane] = tid
+            return tid
+
+    @classmethod
+    def _record(cls, name, category, tid, start, end, args):
+        with cls._lock:
+            if not cls.enabled:
+                return
+            cls._events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": round((start - cls._origin) * 1000000, 1),
+                "dur": round((end - start) * 1000000, 1),
+                "pid": cls._pid,
+                "tid": tid,
+                "args": args
+            })
+
+    @classmethod
+    def _metadata(cls):
+        """
+        The events naming the process and lanes, lanes being sorted in
+        the order they were first used.
+        """
+        events = [{"name": "process_name", "ph": "M", "pid": cls._pid, "tid": 0,
+                   "args": {"name": cls.process_name}}]
+        for lane, tid in sorted(cls._lanes.items(), key = lambda item: item[1]):
+            events.append({"name": "thread_name", "ph": "M", "pid": cls._pid, "tid": tid,
+                           "args": {"name": lane}})
+            events.append({"name": "thread_sort_index", "ph": "M", "pid": cls._pid, "tid": tid,
+                           "args": {"sort_index": tid}})
+        return events
@@ -0,0 +1,149 @@
+"""SSH port forwarding to the cluster's master.
+
+A `Tunnel` listens on one or more local ports and forwards each
+connection made to them over a single SSH transport to a port on the
+master, as `ssh -L` does. The transport sends keepalives so that a
+dead connection is noticed, and is re-established automatically after
+a network blip without the user having to reconnect.
+
+"""
+from .ACSLogs import *
+from .Trace import Trace
+
+import select
+import socket
+import threading
+
+import paramiko
+
+class Tunnel:
+    """
+
+    Forwards local ports to ports on the remote host of an
+    `SSHConnection`. `ports` is a list of (local_port, remote_port)
+    tuples.
+
+    `start()` returns once all the local ports are listening and the
+    SSH connection is established, so the caller knows the tunnel is
+    ready as soon as it returns. `serve_forever()` then watches the
+    connection, reconnecting if it drops, until `stop()` is called.
+
+    """
+    keepalive = 15
+    check_interval = 5
+    max_backoff = 60
+    chunk_size = 32768
+
+    def __init__(self, connection, ports, bind_address = "127.0.0.1"):
+        self.log = ACSLog("Tunnel")
+        self.connection = connection
+        self.ports = list(ports)
+        self.bind_address = bind_address
+        self.listeners = []
+        self.reconnects = 0
+        self._stopped = threading.Event()
+
+    def start(self):
+        """
+        Listen on the local ports and connect to the remote host,
+        raising an error if either fails.
+        """
+        try:
+            with Trace.span("tunnel start", "tunnel", host = self.connection.host, ports = self.ports):
+                for local_port, remote_port in self.ports:
+                    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    self.listeners.append(listener)
+                    listener.bind((self.bind_address, local_port))
+                    listener.listen(socket.SOMAXCONN)
+                self._connect()
+        except:
+            self.stop()
+            raise
+
+        for listener, (local_port, remote_port) in zip(self.listeners, self.ports):
+            self.log.debug("Forwarding local port %d to %s:%d", listener.getsockname()[1], self.connection.host, remote_port)
+            thread = threading.Thread(target = self._accept, args = (listener, remote_port))
+            thread.daemon = True
+            thread.start()
+
+    def localPorts(self):
+        """
+        The local ports being listened on, in the order of `ports`.
+        This is how to find the port chosen when 0 was requested.
+        """
+        return [listener.getsockname()[1] for listener in self.listeners]
+
+    def serve_forever(self):
+        """
+        Watch the SSH connection until `stop()` is called, reconnecting
+        with an exponential backoff whenever it is lost.
+        """
+        backoff = 1
+        while not self._stopped.wait(self.check_interval):
+            if self.connection.isActive():
+                backoff = 1
+                continue
+            self.log.warning("SSH tunnel to %s lost, reconnecting", self.connection.host)
+            try:
+                self._connect()
+                self.reconnects = self.reconnects + 1
+                self.log.info("SSH tunnel to %s re-established", self.connection.host)
+                backoff = 1
+            except (paramiko.SSHException, EOFError, socket.error) as e:
+                self.log.warning("Unable to reconnect SSH tunnel (%s), retrying in %d seconds", e, backoff)
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def stop(self):
+        self._stopped.set()
+        for listener in self.listeners:
+            listener.close()
+        self.listeners = []
+
+    def _connect(self):
+        transport = self.connection.connect()
+        transport.set_keepalive(self.keepalive)
+        return transport
+
+    def _accept(self, listener, remote_port):
+        while not self._stopped.is_set():
+            try:
+                client, address = listener.accept()
+            except OSError:
+                # the listener was closed by stop()
+                return
+            thread = threading.Thread(target = self._forward, args = (client, address, remote_port))
+            thread.daemon = True
+            thread.start()
+
+    def _forward(self, client, address, remote_port):
+        """
+        Copy data in both directions between a local client and a new
+        channel to the remote port until either side closes.
+        """
+        try:
+            channel = self._connect().open_channel("direct-tcpip", ("localhost", remote_port), address)
+        except (paramiko.SSHException, EOFError, socket.error) as e:
+            self.log.warning("Unable to forward connection to port %d: %s", remote_port, e)
+            client.close()
+            return
+
+        try:
+            while True:
+                readable, writable, failed = select.select([client, channel], [], [])
+                if client in readable:
+                    data = client.recv(self.chunk_size)
+                    if not data:
+                        break
+                    channel.sendall(data)
+                if channel in readable:
+                    data = channel.recv(self.chunk_size)
+                    if not data:
+                        break
+                    client.sendall(data)
+        except (paramiko.SSHException, EOFError, socket.error) as e:
+            self.log.debug("Forwarded connection to port %d closed: %s", remote_port, e)
+        finally:
+            channel.close()
+            client.close()
@@ -60,7 +60,7 @@ class ACSUtils:
         Scale the number of Agents availalbe to the supplied number
         """
         agentPool = AgentPool(self.config)
-        agentPool.scale(capacity)
+        agentPool.scale(None, capacity)
 
     def dockerCommand(self, command):
         url = self.getManagementEndpoint()
@@ -2,10 +2,12 @@
 acs
 
 Usage:
-  acs [--config-file=<file>] [--version] [--help] <command> [<args>...]
+  acs [--config-file=<file>] [--log-level=<level>] [--trace=<file>] [--version] [--help] <command> [<args>...]
 
 Options: 
   -h --help                           Show this help.
+  --log-level=<level>                 DEBUG, INFO, WARNING or ERROR (default: $ACS_LOG_LEVEL or INFO)
+  --trace=<file>                      Write a Chrome trace of where the time went to <file>
 
 Commands:
   login      Login to Azure interactively
@@ -25,46 +27,56 @@ Help:
 """
 
 from . import __version__ as VERSION
-from acs.commands.base import Config
 
 from docopt import docopt
-from inspect import getmembers, isclass
 import os.path
 import subprocess
 import sys
 
 def main():
   """Main CLI entrypoint"""
-  from . import commands
-
   args = docopt(__doc__, version=VERSION, options_first=True)
 
-  config = Config(args['--config-file'])
+  if args['--log-level']:
+    from .ACSLogs import ACSLog
+    ACSLog.setLevel(args['--log-level'])
+
   command_name = args["<command>"]
+  argv = args['<args>']
+  if not args['--trace']:
+    run(command_name, argv, args['--config-file'])
+    return
+
+  from .Trace import Trace
+  Trace.start(args['--trace'], " ".join(["acs", command_name] + argv))
+  try:
+    run(command_name, argv, args['--config-file'])
+  finally:
+    path = Trace.stop()
+    if path:
+      sys.stderr.write("Trace written to " + path + "\n")
+
+def run(command_name, argv, config_file):
+  """Run a command"""
+  from . import commands
+
   if command_name == "login":
     print(login())
     return
-    
-  argv = args['<args>']
-  module = getattr(commands, command_name)
-  commands = getmembers(module, isclass)
-  command_class = None
-  command = None
-  for k, command_class in commands:
-      if command_name.lower() in command_class.__name__.lower():
-        command = command_class(config, argv)
-  if command is None:
-    raise Exception("Unrecognized command: " + command_name)
+
+  command_class = commands.getCommandClass(command_name)
+  if "-h" in argv or "--help" in argv:
+    # let docopt print the command's help without reading the config
+    docopt(sys.modules[command_class.__module__].__doc__, argv=argv)
+
+  from acs.commands.base import Config
+  config = Config(config_file)
+  command = command_class(config, argv)
   command.run()
 
 def login():
-  p = subprocess.Popen(["azure", "account", "show"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-  output, errors = p.communicate()
-  if errors:
-    # Not currently logged in
-  
-    p = subprocess.Popen(["azure", "login"], stderr=subprocess.PIPE)
-    output, errors = p.communicate()
-    if errors:
-      return "Failed to login: " + errors.decode("utf-8")
-  return "Logged in to Azure"
+  from .AzureCLI import AzureCLI
+  return AzureCLI.login(force = True)
+
+if __name__ == "__main__":
+  main()
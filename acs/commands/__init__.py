@@ -1,7 +1,83 @@
-from .afs import *
-from .app import *
-from .demo import *
-from .docker import *
-from .lb import *
-from .oms import *
-from .service import *
+"""The registry of top level commands.
+
+Each command is registered by name with the module and class that
+implement it, in the form "module:Class". Command modules (and the
+libraries they depend on) are only imported when the command is
+used, which keeps `acs --help` and other simple invocations fast.
+
+Other packages can add commands by declaring an entry point in the
+`acs.commands` group, for example:
+
+  entry_points = {'acs.commands': ['foo=acs_foo.commands:Foo']}
+
+"""
+
+from collections import OrderedDict
+from importlib import import_module
+import sys
+from types import ModuleType
+
+registry = OrderedDict([
+  ("afs", "acs.commands.afs:Afs"),
+  ("app", "acs.commands.app:App"),
+  ("demo", "acs.commands.demo:Demo"),
+  ("docker", "acs.commands.docker:Docker"),
+  ("lb", "acs.commands.lb:Lb"),
+  ("oms", "acs.commands.oms:Oms"),
+  ("service", "acs.commands.service:Service"),
+])
+
+entry_point_group = "acs.commands"
+
+def _entryPoints():
+  """
+  Get the commands registered by other packages as a dictionary of
+  name to "module:Class".
+  """
+  try:
+    from importlib.metadata import entry_points
+  except ImportError:
+    import pkg_resources
+    return dict((ep.name, ep.module_name + ":" + ".".join(ep.attrs)) for ep in pkg_resources.iter_entry_points(entry_point_group))
+
+  eps = entry_points()
+  if hasattr(eps, "select"):
+    eps = eps.select(group = entry_point_group)
+  else:
+    eps = eps.get(entry_point_group, [])
+  return dict((ep.name, ep.value) for ep in eps)
+
+def getCommandClass(name):
+  """
+  Import and return the class implementing the named command. Built
+  in commands are found without consulting the entry points.
+  """
+  path = registry.get(name)
+  if path is None:
+    path = _entryPoints().get(name)
+  if path is None:
+    raise Exception("Unrecognized command: " + name)
+
+  module_name, class_name = path.split(":")
+  return getattr(import_module(module_name), class_name)
+
+class _CommandsModule(ModuleType):
+  """
+
+  Allow `commands.Service` etc. as when every command was imported
+  by this package, importing the command module on first use.
+  Python < 3.7 has no module level `__getattr__`, so the class of
+  this module is replaced instead.
+
+  """
+  def __getattr__(self, name):
+    if name == "Base":
+      from .base import Base
+      return Base
+    for path in registry.values():
+      module_name, class_name = path.split(":")
+      if class_name == name:
+        return getattr(import_module(module_name), class_name)
+    raise AttributeError("module " + __name__ + " has no attribute " + name)
+
+sys.modules[__name__].__class__ = _CommandsModule
@@ -12,22 +12,43 @@ Options:
     Azure storage account name
   -k --key
     Azure storage account key
+  --parallel=<number>
+    the number of agents to install on concurrently [default: 10]
+  --tree
+    upload the driver once to the master and copy it between agents,
+    rather than from this machine to every agent. Needs a running
+    ssh-agent, to which the private key is added if not loaded
+  --output=<format>
+    how to report each agent's result: text, compact (agents with
+    identical output grouped together), json or ndjson [default: text]
+  --command-timeout=<seconds>
+    stop waiting for the install on an agent after this long
+  --deadline=<seconds>
+    stop waiting for all of the agents after this long
 
 Help:
   For help using the oms command please open an issue at 
   https://github.com/rgardler/acs-scripts
 """
 
-from ..acs_utils import *
+from ..AzureCLI import AzureCLI
 from .base import Base
 
-import subprocess
 from docopt import docopt
 from inspect import getmembers, ismethod
 from json import dumps
+import sys
+import time
 
 class Afs(Base): 
 
+    driver_version = "0.2"
+    # The SHA-256 of the driver's files of each version, by filename.
+    # Downloads that don't match are rejected. Checksums can also be
+    # set in the [Artifacts] section of the config, files with neither
+    # are trusted on first download.
+    driver_checksums = {}
+
     def run(self):
         args = docopt(__doc__, argv=self.options)
         # print("Global args")
@@ -35,18 +56,16 @@ class Afs(Base):
         self.args = args
         
         command = self.args["<command>"]
-        result = None
-        methods = getmembers(self, predicate = ismethod)
-        for name, method in methods:
-            if name == command:
-                result = method()
-                if result is None:
-                    result = command + " returned no results"
-        if result:
-            print(result)
-        else:
+        methods = dict(getmembers(self, predicate = ismethod))
+        if command not in methods:
             print("Unknown command: '" + command + "'")
             self.help()
+            return
+        result = methods[command]()
+        if result is None:
+            print(command + " returned no results")
+        elif result:
+            print(result)
                     
     def help(self):
     	return __doc__
@@ -55,63 +74,62 @@ class Afs(Base):
         """
         Add the AFS feature to the ACS cluster provided.
         """
-        self.createStorage()
-
-        driver_version = "0.2"
+        driver_version = self.driver_version
+        checksums = self.driver_checksums.get(driver_version, {})
         mount = self.config.get("Storage", "mount")
         package = "cifs-utils"
         
-        ips = Base.getAgentIPs(self)
-        for ip in ips:
-            self.log.debug("Installing AFS on: " + ip)
-     
-            result = ""
-
-            cmd = "rm azurefile-dockervolumedriver*"
-            result = result + self.executeOnAgent(cmd, ip)
-            
-            cmd = "wget https://github.com/Azure/azurefile-dockervolumedriver/releases/download/" + driver_version + "/azurefile-dockervolumedriver"
-            result = result + self.executeOnAgent(cmd, ip)
-
-            cmd = "cp azurefile-dockervolumedriver /usr/bin/azurefile-dockervolumedriver"
-            result = result + self.executeOnAgent(cmd, ip)
-
-            cmd = "chmod +x /usr/bin/azurefile-dockervolumedriver"
-            result = result + self.executeOnAgent(cmd, ip)
-
-            cmd = "wget https://raw.githubusercontent.com/Azure/azurefile-dockervolumedriver/" + driver_version + "/contrib/init/systemd/azurefile-dockervolumedriver.service"
-            result = result + self.executeOnAgent(cmd, ip)
-            cmd = "sudo cp azurefile-dockervolumedriver.service /etc/systemd/system/azurefile-dockervolumedriver.service"
-            result = result + self.executeOnAgent(cmd, ip)
-
-            cmd = "echo 'AZURE_STORAGE_ACCOUNT=" + self.config.get("Storage", "name") + "' > azurefile-dockervolumedriver"
-            result = result + self.executeOnAgent(cmd, ip)
-        
-            cmd = "echo 'AZURE_STORAGE_ACCOUNT_KEY=" + self.getStorageAccountKey() + "' >> azurefile-dockervolumedriver"
-            result = result + self.executeOnAgent(cmd, ip)
-            
-            cmd = "sudo cp azurefile-dockervolumedriver /etc/default/azurefile-dockervolumedriver"
-            result = result + self.executeOnAgent(cmd, ip)
-
-            cmd = "sudo systemctl daemon-reload"
-            result = result + self.executeOnAgent(cmd, ip)
+        # fetched before creating the storage, so that a failed download
+        # doesn't leave a storage account behind
+        try:
+            driver = self.fetchArtifact("https://github.com/Azure/azurefile-dockervolumedriver/releases/download/" + driver_version + "/azurefile-dockervolumedriver", driver_version, checksums)
+            unit = self.fetchArtifact("https://raw.githubusercontent.com/Azure/azurefile-dockervolumedriver/" + driver_version + "/contrib/init/systemd/azurefile-dockervolumedriver.service", driver_version, checksums)
+        except IOError as e:
+            self.log.error("Unable to fetch the AFS driver: " + str(e))
+            sys.exit("Unable to fetch the AFS driver: " + str(e))
 
-            cmd = "sudo systemctl enable azurefile-dockervolumedriver"
-            result = result + self.executeOnAgent(cmd, ip)
+        self.createStorage()
 
-            cmd = "sudo systemctl start azurefile-dockervolumedriver"
-            result = result + self.executeOnAgent(cmd, ip)
+        ips = self.getAgentIPs()
+        if self.getOption("--tree"):
+            self.distributeArtifact(driver, ips)
+            self.distributeArtifact(unit, ips)
 
-            cmd = "mkdir -p " + mount
-            result = result + self.executeOnAgent(cmd, ip)
-        
-            urn = self.getShareEndpoint().replace("https:", "") + self.config.get("Storage", "shareName")
-            username = self.config.get("Storage", "name")
-            password = self.getStorageAccountKey()
-            cmd = "sudo mount -t cifs " + urn + " " + mount + " -o uid=1000,gid=1000,vers=2.1,username=" + username + ",password=" + password
-            result = result + self.executeOnAgent(cmd, ip)
+        return self.reportOnAgents(lambda ip: self._installOnAgent(ip, driver, unit, mount), ips)
 
-            return result
+    def _installOnAgent(self, ip, driver, unit, mount):
+        """
+        Install the AFS driver on a single agent, from the driver and
+        systemd unit artifacts. Returns an `AgentResult`.
+        """
+        self.log.debug("Installing AFS on: " + ip)
+        start = time.time()
+
+        urn = self.getShareEndpoint().replace("https:", "") + self.config.get("Storage", "shareName")
+        username = self.config.get("Storage", "name")
+        password = self.getStorageAccountKey()
+
+        driver_path = self.pushArtifact(driver, ip)
+        unit_path = self.pushArtifact(unit, ip)
+
+        steps = [
+            self.verifyArtifactStep(driver, driver_path),
+            self.verifyArtifactStep(unit, unit_path),
+            "cp " + driver_path + " /usr/bin/azurefile-dockervolumedriver",
+            "chmod +x /usr/bin/azurefile-dockervolumedriver",
+            "sudo cp " + unit_path + " /etc/systemd/system/azurefile-dockervolumedriver.service",
+            "echo 'AZURE_STORAGE_ACCOUNT=" + self.config.get("Storage", "name") + "' > azurefile-dockervolumedriver",
+            "echo 'AZURE_STORAGE_ACCOUNT_KEY=" + self.getStorageAccountKey() + "' >> azurefile-dockervolumedriver",
+            "sudo cp azurefile-dockervolumedriver /etc/default/azurefile-dockervolumedriver",
+            "sudo systemctl daemon-reload",
+            "sudo systemctl enable azurefile-dockervolumedriver",
+            "sudo systemctl start azurefile-dockervolumedriver",
+            "mkdir -p " + mount,
+            "sudo mount -t cifs " + urn + " " + mount + " -o uid=1000,gid=1000,vers=2.1,username=" + username + ",password=" + password
+        ]
+
+        results = self.executeScriptOnAgent(steps, ip)
+        return self.scriptResult(ip, steps, results, time.time() - start)
 
     def createStorage(self):
         """
@@ -127,17 +145,16 @@ class Afs(Base):
         command = command + " --location " + self.config.get('Group', 'region')
         command = command + " " + self.config.get('Storage', 'name')
     
-        os.system(command)
+        AzureCLI.system(command)
 
         key = self.getStorageAccountKey()
 
         try:
-            command = "azure storage share create"
-            command = command + " --account-name " + self.config.get('Storage', 'name')
-            command = command + " --account-key " + key
-            command = command + " " + self.config.get('Storage', 'shareName')
-
-            out = subprocess.check_output(command, shell=True)
+            out = AzureCLI.check_output([
+                "storage", "share", "create",
+                "--account-name", self.config.get('Storage', 'name'),
+                "--account-key", key,
+                self.config.get('Storage', 'shareName')])
         except:
             # FIXME: test if the share already exists, if it does then don't try to recreate it
             # For now we just assume that an error is always that the share alrady exists 
@@ -147,12 +164,10 @@ class Afs(Base):
         """
         Get the a share endpoint for the storage account defined in the ini file
         """
-        command = "azure storage account show"
-        command = command + " --resource-group " + self.config.get('Group', 'name')
-        command = command + " " + self.config.get('Storage', 'name')
-        command = command + " --json"
-        
-        data = json.loads(subprocess.check_output(command, shell=True))
+        data = AzureCLI.json([
+            "storage", "account", "show",
+            "--resource-group", self.config.get('Group', 'name'),
+            self.config.get('Storage', 'name')])
         endpoint = data['primaryEndpoints']['file']
 
         return endpoint
@@ -162,13 +177,11 @@ class Afs(Base):
         Get the storage account key for the storage account defined in the ini file
         FIXME: this and related storage methods should move to their own module or class
         """
-        command = "azure storage account keys list"
-        command = command + " --resource-group " + self.config.get('Group', 'name')
-        command = command + " " + self.config.get('Storage', 'name')
-        command = command + " --json"
-        self.log.debug("Command to get storage keys: " + command)
-
-        keys = json.loads(subprocess.check_output(command, shell=True))
+        # The keys are secret so they are only ever memoized in memory
+        keys = AzureCLI.json([
+            "storage", "account", "keys", "list",
+            "--resource-group", self.config.get('Group', 'name'),
+            self.config.get('Storage', 'name')], persist = False)
         return keys['key1']
 
 
@@ -10,26 +10,73 @@ Commands:
   remove                remove an application described by the appropriate app configuration from the cluster
 
 Options:
-  --app-config=<file>   the application configuration (compose file for Docker Swarm, Marhon JSON for DC/OS).
+  --app-config=<files>  the application configuration (compose file for Docker Swarm, Marhon JSON for DC/OS).
                         Note that some special values in this file will be replaced, for example, $AGENT_FQDN
                         will be replaced with the Fully Qualifed Domain Name of the public agent pool.
+                        Several applications can be given as a comma separated list of files and/or
+                        directories, in which case every `.json` file in the directories is used.
+  --group=<id>          deploy (or remove) the applications as a single Marathon group with this ID
+  --parallel=<number>   the number of applications to deploy or remove concurrently [default: 10]
+  --force               deploy the applications even if they are unchanged
+  --wait                wait for the deployments to complete
+  --timeout=<seconds>   the maximum time to wait for deployments to complete [default: 600]
 
 Help:
   For help using the oms command please open an issue at 
   https://github.com/rgardler/acs-scripts
 """
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from docopt import docopt
 from inspect import getmembers, ismethod
 import json
 from json import dumps
+import hashlib
 import os
-import subprocess as sub 
+import threading
 
+from ..Marathon import Marathon, MarathonError
 from .base import Base
+from .service import Service
 
 class App(Base):
   app_config_dir = "~/.acs/app/"
+  app_hash_dir = "~/.acs/app/hashes/"
+
+  # Objects in a running app to which Marathon adds fields with their
+  # default values, so extra fields in them are not changes ("*" is
+  # any element of a list). Everywhere else, e.g. env and labels, the
+  # running app must match the definition exactly.
+  defaulted_objects = (
+    ("container",),
+    ("container", "docker"),
+    ("container", "docker", "portMappings", "*"),
+    ("container", "portMappings", "*"),
+    ("container", "volumes", "*"),
+    ("container", "volumes", "*", "persistent"),
+    ("portDefinitions", "*"),
+    ("healthChecks", "*"),
+    ("readinessChecks", "*"),
+    ("ipAddress",),
+    ("ipAddress", "discovery"),
+    ("residency",),
+    ("upgradeStrategy",),
+    ("fetch", "*"),
+  )
+
+  # Fields that are cleared, by sending these values, when they are
+  # removed from the definition
+  cleared_fields = {
+    "env": {},
+    "labels": {},
+    "healthChecks": [],
+    "constraints": [],
+    "uris": [],
+    "fetch": [],
+    "dependencies": [],
+    "secrets": {},
+  }
 
   def run(self):
     args = docopt(__doc__, argv=self.options)
@@ -54,6 +101,16 @@ class App(Base):
   def help(self):
     print(__doc__)
 
+  @contextmanager
+  def marathon(self):
+    """
+    A context providing a `Marathon` client connected through an SSH
+    tunnel to the cluster.
+    """
+    with Service(self.config, self.options).tunnel():
+      with Marathon(port = self.config.getLocalPort(80)) as marathon:
+        yield marathon
+
   def parseAppConfig(self, config_path):
     """
     Parse a use provided application configuration, replacing any
@@ -80,46 +137,429 @@ class App(Base):
 
     return perm_filename
     
+  def getAppConfigs(self):
+    """
+    Get the paths of the application configurations listed in
+    `--app-config`. Directories are expanded to the `.json` files
+    within them, in name order.
+    """
+    config_paths = self.args["--app-config"]
+    if not config_paths:
+      self.log.error("--app-config not supplied, unable to deploy application")
+      raise IOError("Must provide an application config file as '--app-config'")
+
+    paths = []
+    for path in config_paths.split(","):
+      path = path.strip()
+      if not path:
+        continue
+      expanded = os.path.expanduser(path)
+      if os.path.isdir(expanded):
+        paths.extend(os.path.join(path, name) for name in sorted(os.listdir(expanded)) if name.endswith(".json"))
+      else:
+        paths.append(path)
+    if not paths:
+      raise IOError("No application configurations found in '" + config_paths + "'")
+    return paths
+
+  def loadApps(self):
+    """
+    Parse and load every application configuration listed in
+    `--app-config`. Returns an OrderedDict mapping each app ID to the
+    app definition.
+    """
+    apps = OrderedDict()
+    for config_path in self.getAppConfigs():
+      perm_filename = self.parseAppConfig(config_path)
+      with open(perm_filename) as app_config:
+        app = json.load(app_config)
+      app_id = "/" + app["id"].strip("/")
+      if app_id in apps:
+        raise IOError("Application ID " + app_id + " is used by more than one configuration")
+      apps[app_id] = app
+    return apps
+
+  def forEachApp(self, fn, apps):
+    """
+    Call `fn(marathon, app)` for each app, up to `--parallel` at a
+    time. Each worker thread has its own keep-alive Marathon client,
+    all sharing one SSH tunnel. Returns an OrderedDict mapping each
+    app ID to the value returned by `fn` or an "Exception: ..."
+    message.
+    """
+    local = threading.local()
+    clients = []
+
+    def call(app_id):
+      if not hasattr(local, "marathon"):
+        local.marathon = Marathon(port = self.config.getLocalPort(80))
+        clients.append(local.marathon)
+      return fn(local.marathon, apps[app_id])
+
+    with Service(self.config, self.options).tunnel():
+      try:
+        return self.forEach(call, list(apps))
+      finally:
+        for client in clients:
+          client.close()
+
+  def groupDefinition(self, group_id, apps):
+    """
+    Get the definition of a Marathon group containing `apps`. App IDs
+    are made relative so that the apps are created within the group.
+    """
+    group_apps = []
+    for app in apps.values():
+      app = dict(app)
+      app["id"] = app["id"].strip("/")
+      group_apps.append(app)
+    return {"id": group_id, "apps": group_apps}
+
+  def formatResults(self, action, results):
+    """
+    Report the outcome of an action on each application.
+    """
+    failed = [app_id for app_id, result in results.items() if str(result).startswith("Exception: ")]
+    lines = [action + " " + str(len(results) - len(failed)) + " of " + str(len(results)) + " applications"]
+    for app_id, result in results.items():
+      lines.append("  " + app_id + ": " + str(result))
+    return "\n".join(lines)
+
+  def hashApp(self, app):
+    """
+    Get a hash of a rendered app (or group) definition.
+    """
+    canonical = json.dumps(app, sort_keys = True, separators = (",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+  def _hashPath(self):
+    return os.path.expanduser(self.app_hash_dir + self.getManagementEndpoint() + ".json")
+
+  def loadHashes(self):
+    """
+    Get the record of what was last deployed to this cluster, a
+    dictionary mapping app (or group) IDs to the hash of the
+    definition deployed and the Marathon version it became.
+    """
+    try:
+      with open(self._hashPath()) as hash_file:
+        return json.load(hash_file)
+    except (OSError, ValueError):
+      return {}
+
+  def saveHashes(self, hashes):
+    path = self._hashPath()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_path, "w") as hash_file:
+      json.dump(hashes, hash_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+  def changedFields(self, app, live):
+    """
+    Get the top level fields of `app` whose values differ from the
+    running app `live`, mapped to the values to send. Fields Marathon
+    adds to the running app, and those it adds to the
+    `defaulted_objects`, are not considered changes. `cleared_fields`
+    that the running app has but `app` doesn't are changed to empty.
+    """
+    changes = {}
+    for name, value in app.items():
+      if name == "id":
+        continue
+      if name not in live or not self._matches(value, live[name], (name,)):
+        changes[name] = value
+    for name, empty in self.cleared_fields.items():
+      if name not in app and live.get(name) not in (None, empty):
+        changes[name] = empty
+    return changes
+
+  def _matches(self, desired, live, path):
+    if isinstance(desired, dict):
+      if not isinstance(live, dict):
+        return False
+      if path not in self.defaulted_objects and set(live) != set(desired):
+        return False
+      for name, value in desired.items():
+        if name not in live or not self._matches(value, live[name], path + (name,)):
+          return False
+      return True
+    if isinstance(desired, list):
+      if not isinstance(live, list) or len(desired) != len(live):
+        return False
+      for value, live_value in zip(desired, live):
+        if not self._matches(value, live_value, path + ("*",)):
+          return False
+      return True
+    return desired == live
+
+  def deployApp(self, marathon, app, hashes, force = False, deployments = None):
+    """
+    Deploy an app unless the running app already matches it. `hashes`
+    is the record from `loadHashes()`, which is updated. If supplied,
+    `deployments` is updated with the IDs of the Marathon deployments
+    started for the app. Returns a description of what was done.
+
+    If the definition hasn't changed since we last deployed it, and
+    nobody else has changed the running app since, there is nothing
+    to do. Otherwise the definition is compared with the running app
+    and only the fields that differ are sent, so an unchanged app is
+    never restarted.
+    """
+    app_id = "/" + app["id"].strip("/")
+    digest = self.hashApp(app)
+
+    if force:
+      result = marathon.updateApp(app_id, app)
+      hashes[app_id] = {"hash": digest, "version": result.get("version")}
+      self._recordDeployments(deployments, app_id, marathon, result)
+      return "deployed"
+
+    try:
+      live = marathon.getApp(app_id)
+    except MarathonError as e:
+      if e.status != 404:
+        raise
+      live = None
+
+    if live is None:
+      result = marathon.createApp(app)
+      hashes[app_id] = {"hash": digest, "version": result.get("version")}
+      self._recordDeployments(deployments, app_id, marathon, result)
+      return "created"
+
+    stored = hashes.get(app_id, {})
+    if stored.get("hash") == digest and stored.get("version") == live.get("version"):
+      return "unchanged"
+
+    changes = self.changedFields(app, live)
+    if not changes:
+      hashes[app_id] = {"hash": digest, "version": live.get("version")}
+      return "unchanged"
+
+    self.log.debug("Updating %s: %s", app_id, ", ".join(sorted(changes)))
+    result = marathon.updateApp(app_id, changes)
+    hashes[app_id] = {"hash": digest, "version": result.get("version")}
+    self._recordDeployments(deployments, app_id, marathon, result)
+    return "updated (" + ", ".join(sorted(changes)) + ")"
+
+  def deployGroup(self, marathon, group_id, apps, hashes, force = False, deployments = None):
+    """
+    Deploy apps as a group unless the running group was deployed from
+    the same definition. Returns a description of what was done.
+    """
+    group = self.groupDefinition(group_id, apps)
+    key = "/" + group_id.strip("/")
+    digest = self.hashApp(group)
+
+    stored = hashes.get(key, {})
+    if not force and stored.get("hash") == digest:
+      try:
+        if marathon.getGroup(group_id).get("version") == stored.get("version"):
+          return "unchanged"
+      except MarathonError as e:
+        if e.status != 404:
+          raise
+
+    result = marathon.updateGroup(group_id, group)
+    hashes[key] = {"hash": digest, "version": result.get("version")}
+    self._recordDeployments(deployments, key, marathon, result, group = True)
+    return "deployed"
+
+  def _recordDeployments(self, deployments, key, marathon, result, group = False, removed = False):
+    if deployments is not None:
+      if group:
+        deployments[key] = marathon.deploymentTargets(result, group_id = key, removed = removed)
+      else:
+        deployments[key] = marathon.deploymentTargets(result, app_id = key, removed = removed)
+
+  def waitForDeployments(self, deployments):
+    """
+    Wait, for up to `--timeout` seconds, for the deployments started
+    for each app (or group). `deployments` maps each app ID to the
+    targets of its deployments (see `Marathon.deploymentTargets`).
+    Returns a dictionary mapping each app ID to "ready", "failed",
+    "timed out" or "outcome unknown".
+    """
+    targets = {}
+    for app_targets in deployments.values():
+      targets.update(app_targets)
+    timeout = float(self.args.get("--timeout") or 600)
+    self.log.debug("Waiting up to %d seconds for %d deployments", timeout, len(targets))
+    with self.marathon() as marathon:
+      outcomes = marathon.waitForDeployments(list(targets), timeout, targets)
+
+    results = {}
+    for app_id, app_targets in deployments.items():
+      states = [outcomes[deployment_id] for deployment_id in app_targets]
+      if "failed" in states:
+        results[app_id] = "failed"
+      elif "timed out" in states:
+        results[app_id] = "timed out"
+      elif "unknown" in states:
+        results[app_id] = "outcome unknown"
+      else:
+        results[app_id] = "ready"
+    return results
+
+  def addOutcomes(self, results, deployments):
+    """
+    Wait for `deployments` and add the outcome to the result of each
+    app, making the result an "Exception: ..." message if the
+    deployment did not succeed.
+    """
+    for app_id, outcome in self.waitForDeployments(deployments).items():
+      if outcome == "ready":
+        results[app_id] = results[app_id] + ", ready"
+      else:
+        results[app_id] = "Exception: deployment " + outcome
+    return results
+
+  @contextmanager
+  def waiting(self):
+    """
+    If `--wait` was given, a context in which the SSH tunnel is held
+    open so that the requests and the wait for them share it.
+    """
+    if self.args.get("--wait"):
+      with Service(self.config, self.options).tunnel():
+        yield
+    else:
+      yield
+
   def deploy(self):
-    """Deploy the application dfined in the file referenced in
-    `--app-config`. If the application is already deployed a
-    `RunitmeWarning` will be raised.
+    """Deploy the applications defined in the files referenced in
+    `--app-config`. Applications that are already running with the
+    same definition are not redeployed (unless `--force` is given),
+    and those that have changed are updated with only the fields that
+    differ. If a single application is given and deploying it fails a
+    `RunitmeWarning` will be raised, otherwise the result for each
+    application is reported.
+
+    If `--group` is given all the applications are submitted to
+    Marathon as a single group in one request, otherwise they are
+    deployed concurrently. If `--wait` is given we return once the
+    deployments have completed.
     """
-    config_path = self.args["--app-config"]
     try:
-      perm_filename = self.parseAppConfig(config_path)
+      apps = self.loadApps()
     except IOError as e:
       self.log.error("Unable to deploy applicatoin.\n" + str(e))
       raise e
 
-    p = sub.Popen(['dcos', 'marathon', 'app', "add", perm_filename],stdout=sub.PIPE,stderr=sub.PIPE)
-    output, errors = p.communicate()
-    if errors:
-      msg = "Error deploying application:\n" + errors.decode("utf-8")
-      self.log.error(msg)
-      raise RuntimeWarning(msg)
-    
-    self.log.debug("Application deployed. Configuration stored in " + perm_filename)
+    with self.waiting():
+      return self._deploy(apps)
+
+  def _deploy(self, apps):
+    force = self.args.get("--force")
+    wait = self.args.get("--wait")
+    hashes = self.loadHashes()
+    deployments = {}
+    group_id = self.args.get("--group")
+    if group_id:
+      self.log.debug("Deploying %d applications as the group %s", len(apps), group_id)
+      try:
+        with self.marathon() as marathon:
+          status = self.deployGroup(marathon, group_id, apps, hashes, force, deployments)
+      except MarathonError as e:
+        msg = "Error deploying application group " + group_id + ":\n" + str(e)
+        self.log.error(msg)
+        raise RuntimeWarning(msg)
+      self.saveHashes(hashes)
+      if wait and deployments:
+        self._raiseUnlessReady("Deployment of application group " + group_id, deployments)
+        status = status + " and ready"
+      return "Application group " + group_id + " " + status + " (" + ", ".join(apps) + ")"
+
+    if len(apps) == 1:
+      app_id, app = list(apps.items())[0]
+      try:
+        with self.marathon() as marathon:
+          status = self.deployApp(marathon, app, hashes, force, deployments)
+      except MarathonError as e:
+        msg = "Error deploying application:\n" + str(e)
+        self.log.error(msg)
+        raise RuntimeWarning(msg)
+      self.saveHashes(hashes)
+      self.log.debug("Application " + app_id + " " + status)
+      if status == "unchanged":
+        return "Application unchanged, not deployed"
+      if wait and deployments:
+        self._raiseUnlessReady("Deployment of application " + app_id, deployments)
+      msg = "Application " + status if status.startswith("updated") else "Application deployed"
+      return msg + " and ready" if wait else msg
+
+    results = self.forEachApp(lambda marathon, app: self.deployApp(marathon, app, hashes, force, deployments), apps)
+    self.saveHashes(hashes)
+    if wait and deployments:
+      self.addOutcomes(results, deployments)
+    return self.formatResults("Deployed", results)
 
-    return "Application deployed"
+  def _raiseUnlessReady(self, action, deployments):
+    for app_id, outcome in self.waitForDeployments(deployments).items():
+      if outcome != "ready":
+        msg = action + " " + outcome
+        self.log.error(msg)
+        raise RuntimeWarning(msg)
 
   def remove(self):
-    config_path = self.args["--app-config"]
-    try:
-      perm_filename = self.parseAppConfig(config_path)
-      with open(perm_filename) as app_config: 
-        app = json.load(app_config)
-        app_id = app["id"]
-    except IOError as e:
-      self.log.error(e)
-      raise e
+    """Remove the applications defined in the files referenced in
+    `--app-config`, or the group given in `--group`. If `--wait` is
+    given we return once they have been removed. A group is removed
+    by its ID alone, so `--app-config` is not needed with `--group`.
+    """
+    if self.args.get("--group"):
+      apps = OrderedDict()
+    else:
+      try:
+        apps = self.loadApps()
+      except IOError as e:
+        self.log.error(e)
+        raise e
+
+    with self.waiting():
+      return self._remove(apps)
+
+  def _remove(self, apps):
+    wait = self.args.get("--wait")
+    deployments = {}
+    group_id = self.args.get("--group")
+    if group_id:
+      self.log.debug("Removing application group " + group_id)
+      try:
+        with self.marathon() as marathon:
+          self._recordDeployments(deployments, group_id, marathon, marathon.deleteGroup(group_id), group = True, removed = True)
+      except MarathonError as e:
+        self.log.error("Error removing application group:\n" + str(e))
+        return "Unable to remove application group, see log for full details."
+      outcome = self.waitForDeployments(deployments)[group_id] if wait else "ready"
+      if outcome != "ready":
+        self.log.error("Removal of application group " + group_id + " " + outcome)
+        return "Unable to remove application group, removal " + outcome + "."
+      return "Application group " + group_id + " removed."
+
+    if len(apps) == 1:
+      app_id = list(apps)[0]
+      self.log.debug("Removing app with the ID " + app_id)
+      try:
+        with self.marathon() as marathon:
+          self._recordDeployments(deployments, app_id, marathon, marathon.deleteApp(app_id), removed = True)
+      except MarathonError as e:
+        self.log.error("Error removing application:\n" + str(e))
+        return "Unable to remove application, see log for full details."
+      outcome = self.waitForDeployments(deployments)[app_id] if wait else "ready"
+      if outcome != "ready":
+        self.log.error("Removal of application " + app_id + " " + outcome)
+        return "Unable to remove application, removal " + outcome + "."
+      self.log.debug("Application removed.")
+      return "Application removed."
 
-    self.log.debug("Removing app with the ID " + app_id)
-    p = sub.Popen(['dcos', 'marathon', 'app', "remove", app_id],stdout=sub.PIPE,stderr=sub.PIPE)
-    output, errors = p.communicate()
-    if errors:
-      self.log.error("Error removing application:\n" + errors.decode("utf-8"))
-      return "Unable to remove application, see log for full details."
-    self.log.debug("Application removed. Configuration stored in " + perm_filename)
+    def removeApp(marathon, app):
+      app_id = "/" + app["id"].strip("/")
+      self._recordDeployments(deployments, app_id, marathon, marathon.deleteApp(app_id), removed = True)
+      return "removed"
 
-    return "Application removed."
+    results = self.forEachApp(removeApp, apps)
+    if wait and deployments:
+      self.addOutcomes(results, deployments)
+    return self.formatResults("Removed", results)
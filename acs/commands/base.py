@@ -1,18 +1,32 @@
 """The base command class. All implemented commands should extend this class."""
 from ..AgentPool import AgentPool
+from ..AgentResult import AgentResult, ResultWriter
+from ..AzureCLI import AzureCLI
+from ..RemoteScript import RemoteScript
+from ..Trace import Trace
 
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import json
 import os.path
+import shlex
 from subprocess import call
-import paramiko
-from paramiko import SSHClient
-from paramiko.agent import AgentRequestHandler
 import socket
 import subprocess, os
+import threading
+import time
 
 class Base(object):
 
   temp_filepath = os.path.expanduser("~/.acs/tmp")
+  # where artifacts are copied to on agents, relative to the home directory
+  remote_artifact_dir = ".acs/artifacts"
+  default_parallelism = 10
+  # command line options that override the [Timeouts] section of the config file
+  timeout_options = {"command": "--command-timeout", "deadline": "--deadline"}
+  # private keys known to be loaded into the local ssh-agent
+  _agent_keys = set()
+  _agent_lock = threading.Lock()
   
   def __init__(self, config, options, *args, **kwargs):
     self.log = ACSLog("Base")
@@ -20,20 +34,19 @@ class Base(object):
     self.options = options
     self.args = args
     self.kwargs = kwargs
+    # artifact checksum -> agent IPs it has been distributed to
+    self._distributed = {}
+    # the `Cancellation` of the run of `forEach` each thread is working for
+    self._run = threading.local()
     os.makedirs(self.temp_filepath, exist_ok=True)
-    self.login()
-    
+
   def login(self):
-    p = subprocess.Popen(["azure", "account", "show"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, errors = p.communicate()
-    if errors:
-      # Not currently logged in
-  
-      p = subprocess.Popen(["azure", "login"], stderr=subprocess.PIPE)
-      output, errors = p.communicate()
-      if errors:
-        return "Failed to login: " + errors.decode("utf-8")
-      return "Logged in to Azure"
+    """
+    Ensure we are logged in to Azure. This is not needed before
+    using the `azure` CLI through `AzureCLI`, which logs in on first
+    use, and the result is cached so it is cheap to call.
+    """
+    return AzureCLI.login()
 
   def _hostnameResolves(self, hostname):
     try:
@@ -43,16 +56,16 @@ class Base(object):
       return False
 
   def getManagementEndpoint(self):
-    return self.config.get('ACS', 'dnsPrefix') + 'mgmt.' + self.config.get('Group', 'region').replace(" ", "").replace('"', '') + '.cloudapp.azure.com'
+    return self.config.getManagementEndpoint()
 
   def getAgentEndpoint(self):
-    return self.config.get('ACS', 'dnsPrefix') + 'agents.' + self.config.get('Group', 'region').replace(" ", "").replace('"', '') + '.cloudapp.azure.com'
+    return self.config.getAgentEndpoint()
 
   def createResourceGroup(self):
     self.log.debug("Creating Resource Group")
 
     command = "azure group create " + self.config.get('Group', 'name')  + " " + self.config.get('Group', 'region')
-    os.system(command)
+    AzureCLI.system(command)
 
   def run(self):
     raise NotImplementedError("You must implement the run() method in your commands")
@@ -70,64 +83,502 @@ class Base(object):
     for nic in nics:
       try:
         ip = nic["ipConfigurations"][0]["privateIPAddress"]
-        self.log.debug("IP for " + nic["name"] + " is: " + str(ip))
+        self.log.debug("IP for %s is: %s", nic["name"], ip)
         ips.append(ip)
       except KeyError:
         self.log.warning("NIC doesn't seem to have the information we need")
         
-    self.log.debug("Agent IPs: " + str(ips))
+    self.log.debug("Agent IPs: %s", ips)
     return ips
 
+  def getOption(self, name, default = None):
+    """
+    Get the value of a command line option, or `default` if the
+    command was not run from the command line or has no such option.
+    """
+    if isinstance(self.args, dict) and self.args.get(name) is not None:
+      return self.args[name]
+    return default
+
+  def getParallelism(self, parallel = None):
+    """
+    Get the maximum number of agents (or other items) to operate on
+    concurrently. This is `parallel` if supplied, otherwise the value
+    of the `--parallel` option if the command has one, otherwise
+    `default_parallelism`.
+    """
+    if parallel is None:
+      parallel = self.getOption("--parallel")
+    if parallel is None:
+      return self.default_parallelism
+    parallel = int(parallel)
+    if parallel < 1:
+      raise ValueError("--parallel must be at least 1, got " + str(parallel))
+    return parallel
+
+  def getTimeout(self, name):
+    """
+    Get a timeout in seconds, from the command line option for it in
+    `timeout_options` if the command has one, otherwise from `name`
+    in the `[Timeouts]` section of the config file. Returns None if
+    neither is set.
+    """
+    value = self.getOption(self.timeout_options.get(name))
+    if value is None:
+      return self.config.getTimeout(name)
+    value = float(value)
+    if value <= 0:
+      raise ValueError(self.timeout_options[name] + " must be a positive number of seconds, got " + str(value))
+    return value
+
+  def forEachAgent(self, fn, ips = None, parallel = None):
+    """
+    Call `fn(ip)` for each agent in the cluster (or each of the
+    supplied `ips`), running up to `parallel` calls concurrently.
+
+    Returns an OrderedDict mapping each agent IP, in agent order, to
+    the value returned by `fn`. If `fn` raises, the agent's value is
+    an "Exception: ..." message and the other agents are unaffected.
+    The calls are subject to the "deadline" timeout, see `forEach`.
+    When tracing, the work on each agent is traced in its own lane.
+    """
+    if ips is None:
+      ips = self.getAgentIPs()
+    if not Trace.enabled:
+      return self.forEach(fn, ips, parallel, self.getTimeout("deadline"))
+
+    def traced(ip):
+      with Trace.lane("agent " + str(ip)):
+        return fn(ip)
+    with Trace.span("forEachAgent", "agents", agents = len(ips)):
+      return self.forEach(traced, ips, parallel, self.getTimeout("deadline"))
+
+  def forEach(self, fn, items, parallel = None, deadline = None):
+    """
+    Call `fn(item)` for each of `items`, running up to `parallel`
+    calls concurrently. Returns an OrderedDict mapping each item, in
+    order, to the value returned by `fn` or, if it raised, an
+    "Exception: ..." message.
+
+    If the calls have not all completed within `deadline` seconds the
+    remote commands and copies they have in flight are cancelled, any
+    they go on to start fail, and the value of each unfinished item is
+    an "Exception: ..." message, so that a hung host can only delay us
+    until the deadline. If we are interrupted (Ctrl-C) the calls are
+    cancelled in the same way before re-raising.
+    """
+    results = OrderedDict((item, None) for item in items)
+    if not results:
+      return results
+
+    workers = min(self.getParallelism(parallel), len(results))
+    self.log.debug("Running on %d items, %d at a time", len(results), workers)
+    expires = None if deadline is None else time.time() + deadline
+    from ..SSHPool import Cancellation
+    cancellation = Cancellation()
+
+    def call(item):
+      previous = getattr(self._run, "cancellation", None)
+      self._run.cancellation = cancellation
+      try:
+        cancellation.check()
+        return fn(item)
+      finally:
+        self._run.cancellation = previous
+
+    executor = ThreadPoolExecutor(max_workers = workers)
+    futures = dict((executor.submit(call, item), item) for item in results)
+    pending = set(futures)
+    try:
+      while pending:
+        timeout = None if expires is None else max(0, expires - time.time())
+        done, pending = wait(pending, timeout, FIRST_COMPLETED)
+        for future in done:
+          item = futures[future]
+          try:
+            results[item] = future.result()
+          except Exception as e:
+            self.log.error("Failed on " + str(item) + ": " + str(e))
+            results[item] = "Exception: " + str(e)
+        if pending and expires is not None and time.time() >= expires:
+          self.log.error("Deadline of %s seconds exceeded, cancelling %d unfinished", deadline, len(pending))
+          for future in pending:
+            future.cancel()
+            results[futures[future]] = "Exception: deadline of " + str(deadline) + " seconds exceeded"
+          self.cancel(cancellation)
+          break
+    except KeyboardInterrupt:
+      for future in pending:
+        future.cancel()
+      self.cancel(cancellation)
+      raise
+    finally:
+      executor.shutdown(wait = False)
+    return results
+
+  def cancel(self, cancellation = None):
+    """
+    Cancel the remote commands and copies of a run of `forEach`, given
+    its `Cancellation`, closing their channels, so that the run starts
+    no more. Without one, every command and copy in flight in the
+    process is cancelled.
+    """
+    if cancellation is not None:
+      cancellation.cancel()
+      return
+    from ..SSHPool import SSHPool
+    SSHPool.cancelAll()
+
+  def _cancellation(self):
+    """
+    The `Cancellation` of the run of `forEach` the current thread is
+    working for, or None.
+    """
+    return getattr(self._run, "cancellation", None)
+
+  def executeOnAgents(self, cmd, ips = None, parallel = None):
+    """
+    Execute a command concurrently on each agent. Returns an
+    OrderedDict mapping agent IP to the command output.
+    """
+    return self.forEachAgent(lambda ip: self.executeOnAgent(cmd, ip), ips, parallel)
+
   def executeOnAgent(self, cmd, ip):
     """
     Execute command on an agent identified by agent_name
     """
-    sshadd = "ssh-add " + self.config.get("SSH", "privatekey")
-    self.shell_execute(sshadd)
-    
-    sshAgentConnection = "ssh -o StrictHostKeyChecking=no " + self.config.get('ACS', 'username') + '@' + ip
-    self.log.debug("SSH Connection to agent: " + sshAgentConnection)
-    
-    self.log.debug("Command to run on agent: " + cmd)
-    
-    sshCmd = sshAgentConnection + ' \'' + cmd + '\''
-    self.shell_execute("exit")
-    result = self.executeOnMaster(sshCmd)
+    status, output, errors = self._executeOnAgent(cmd, ip)
+    return output
 
-    return result
+  def executeScriptOnAgent(self, steps, ip):
+    """
+    Execute an ordered list of commands on an agent as a single
+    remote script, stopping at the first command that fails. This
+    costs one round trip to the agent rather than one per command.
+
+    Returns a list of `StepResult`, one for each step executed.
+    """
+    script = RemoteScript(steps)
+    self.log.debug("Running %d steps as a script on agent %s", len(script.steps), ip)
+    status, output, errors = self._executeOnAgent("bash -s", ip, stdin = script.render())
+    results = script.parse(output)
+    for result in results:
+      self.log.debug("%s: '%s' exited with %s in %.2fs", ip, result.cmd, result.status, result.duration)
+    if len(results) < len(script.steps) and (not results or results[-1].succeeded()):
+      self.log.error("Script on agent " + ip + " exited with status " + str(status) + " before completing: " + errors)
+    return results
+
+  def runOnAgent(self, cmd, ip):
+    """
+    Execute a command on an agent, returning an `AgentResult`.
+    """
+    start = time.time()
+    status, output, errors = self._executeOnAgent(cmd, ip)
+    return AgentResult(ip, status, output, errors, time.time() - start)
+
+  def scriptResult(self, ip, steps, results, duration):
+    """
+    Summarise the results of `executeScriptOnAgent` as an
+    `AgentResult`. The output is that of each step and, if the script
+    did not complete, the errors are an "Exception: ..." message. The
+    failing command itself is not included as it may contain secrets.
+    """
+    output = "".join(result.stdout for result in results)
+    if results and not results[-1].succeeded():
+      failed = results[-1]
+      return AgentResult(ip, failed.status, output, "Exception: step " + str(len(results)) + " of " + str(len(steps)) + " failed on " + ip + " with status " + str(failed.status) + ": " + failed.stderr + "\n", duration)
+    if len(results) < len(steps):
+      return AgentResult(ip, None, output, "Exception: only " + str(len(results)) + " of " + str(len(steps)) + " steps completed on " + ip + "\n", duration)
+    return AgentResult(ip, 0, output, "".join(result.stderr for result in results), duration)
+
+  def reportOnAgents(self, fn, ips = None, title = None, parallel = None):
+    """
+    Call `fn(ip)`, which returns an `AgentResult`, for each agent and
+    report the results in the format given by the `--output` option
+    (see `ResultWriter`). JSON formats are written to stdout as each
+    agent finishes. Returns the text to display, which is empty for
+    the JSON formats.
+
+    If `fn` raises, or the deadline passes before it returns, the
+    agent's result has no status and the errors are an "Exception:
+    ..." message.
+    """
+    writer = ResultWriter(self.getOption("--output", "text"), title)
+
+    def report(ip):
+      start = time.time()
+      try:
+        result = fn(ip)
+      except Exception as e:
+        self.log.error("Failed on " + ip + ": " + str(e))
+        result = AgentResult(ip, None, "", "Exception: " + str(e) + "\n", time.time() - start)
+      writer.add(result)
+      return result
+
+    results = self.forEachAgent(report, ips, parallel)
+    for ip, result in results.items():
+      if not isinstance(result, AgentResult):
+        writer.add(AgentResult(ip, None, "", str(result) + "\n", 0))
+    return writer.close()
+
+  def _executeOnAgent(self, cmd, ip, stdin = None):
+    """
+    Execute command on an agent, returning a tuple of (exit_status,
+    stdout, stderr).
+    """
+    if not self.getMasterConnection().isActive() and not self._hostnameResolves(self.getManagementEndpoint()):
+      self.log.error("Endpoint " + self.getManagementEndpoint() + " does not exist, cannot SSH into it.")
+      return None, "Exception: No cluster is available at " + self.getManagementEndpoint(), ""
+
+    self.log.debug("Command to run on agent %s: %s", ip, cmd)
+    with Trace.span("executeOnAgent", "ssh", host = ip, cmd = cmd):
+      return self._execute(self.getAgentConnection(ip), cmd, stdin = stdin)
+
+  def fetchArtifact(self, url, version, checksums):
+    """
+    Get an `Artifact` from the cache, checked against a known SHA-256
+    so that a tampered or truncated download is never pushed to the
+    agents: that given for its filename in the `[Artifacts]` section
+    of the config file or, failing that, in `checksums`, a dictionary
+    of filenames to SHA-256. If neither has it the first download is
+    trusted, with a warning, and later runs use the cached copy, which
+    is checked against the hash recorded then. Raises `IOError` if the
+    download does not match.
+    """
+    from ..ArtifactCache import ArtifactCache
+    filename = url.rstrip("/").split("/")[-1]
+    sha256 = self.config.getArtifactChecksum(filename) or checksums.get(filename)
+    artifact = ArtifactCache.fetch(url, version, sha256)
+    if sha256 is None:
+      self.log.warning("No SHA-256 is known for %s %s, trusting the first download (%s). " +
+                       "Set it in the [Artifacts] section of %s to verify it.",
+                       filename, version, artifact.sha256, self.config.filename)
+    return artifact
+
+  def pushArtifact(self, artifact, ip):
+    """
+    Copy an `Artifact` from the local cache to an agent, unless the
+    agent already has an identical copy. Returns the path to the file
+    on the agent, relative to the user's home directory.
+
+    Install steps should verify the copy before using it, see
+    `verifyArtifactStep`.
+    """
+    remote_path = self.remote_artifact_dir + "/" + artifact.filename
+    if ip in self._distributed.get(artifact.sha256, ()):
+      return remote_path
+    status, output, errors = self._executeOnAgent("mkdir -p " + self.remote_artifact_dir + " && sha256sum " + remote_path + " 2>/dev/null", ip)
+    if status is None:
+      raise RuntimeError(output)
+    if output.split(" ")[0] == artifact.sha256:
+      self.log.debug("%s already has %s", ip, artifact.filename)
+    else:
+      self.getAgentConnection(ip).put(artifact.path, remote_path, cancellation = self._cancellation())
+    return remote_path
+
+  def verifyArtifactStep(self, artifact, remote_path):
+    """
+    Get a script step that fails unless the file at `remote_path` on
+    the agent has the artifact's checksum.
+    """
+    return "echo '" + artifact.sha256 + "  " + remote_path + "' | sha256sum -c -"
+
+  def distributeArtifact(self, artifact, ips = None):
+    """
+    Copy an `Artifact` to every agent (or each of the supplied `ips`)
+    while only sending it from this machine once. The file is
+    uploaded to the master and then copied between hosts within the
+    cluster in a binary tree: the master sends it to two agents, each
+    of which sends it to two more, and so on, each copy being checked
+    against the artifact's checksum on arrival. Copies within the
+    cluster authenticate with SSH agent forwarding, so a local
+    ssh-agent must be running; the private key is added to it if it
+    is not already loaded, see `loadPrivateKeyIntoAgent`.
+
+    If a copy fails the agents below it in the tree are served by the
+    failed agent's source instead. Returns an OrderedDict mapping
+    each agent IP to the path of the file on it, or an "Exception:
+    ..." message. Agents that received the file are remembered so
+    that a subsequent `pushArtifact` to them costs nothing.
+    """
+    if ips is None:
+      ips = self.getAgentIPs()
+    results = OrderedDict((ip, None) for ip in ips)
+    remote_path = self.remote_artifact_dir + "/" + artifact.filename
+    if not ips:
+      return results
+
+    self.loadPrivateKeyIntoAgent()
+    connection = self.getMasterConnection()
+    status, output, errors = self._executeOnMaster("mkdir -p " + self.remote_artifact_dir + " && sha256sum " + remote_path + " 2>/dev/null")
+    if status is None:
+      raise RuntimeError(output)
+    if output.split(" ")[0] != artifact.sha256:
+      connection.put(artifact.path, remote_path, cancellation = self._cancellation())
+
+    # node -1 is the master, node i is served by node (i - 1) // 2
+    def children(node):
+      return [child for child in (2 * node + 2, 2 * node + 3) if child < len(ips)]
+
+    def copy(source, node):
+      return self._copyBetweenHosts(artifact, remote_path, ips[source] if source >= 0 else None, ips[node])
+
+    distributed = self._distributed.setdefault(artifact.sha256, set())
+    with ThreadPoolExecutor(max_workers = min(self.getParallelism(), len(ips))) as executor:
+      futures = dict((executor.submit(copy, -1, node), (-1, node)) for node in children(-1))
+      while futures:
+        done, pending = wait(futures, return_when = FIRST_COMPLETED)
+        for future in done:
+          source, node = futures.pop(future)
+          try:
+            future.result()
+            results[ips[node]] = remote_path
+            distributed.add(ips[node])
+            server = node
+          except Exception as e:
+            self.log.error("Failed to copy " + artifact.filename + " to " + ips[node] + ": " + str(e))
+            results[ips[node]] = "Exception: " + str(e)
+            server = source
+          for child in children(node):
+            futures[executor.submit(copy, server, child)] = (server, child)
+    return results
+
+  def loadPrivateKeyIntoAgent(self):
+    """
+    Make sure the private key in the config is loaded into the local
+    ssh-agent, which copies between hosts in the cluster authenticate
+    with. `ssh-add` is run unless the agent already has the key.
+    Raises RuntimeError if no agent is running or the key can't be
+    added.
+    """
+    key_path = os.path.expanduser(self.config.get('SSH', "privatekey"))
+    with Base._agent_lock:
+      if key_path in Base._agent_keys:
+        return
+      if not os.environ.get("SSH_AUTH_SOCK"):
+        raise RuntimeError("Copying between hosts needs a running ssh-agent, start one with 'eval $(ssh-agent)'")
+      if not self._agentHasKey(key_path):
+        self.log.info("Adding %s to the ssh-agent", key_path)
+        if call(["ssh-add", key_path]) != 0:
+          raise RuntimeError("Unable to add " + key_path + " to the ssh-agent")
+      Base._agent_keys.add(key_path)
+
+  def _agentHasKey(self, key_path):
+    """
+    True if the ssh-agent has the key whose public half is in
+    `key_path`.pub. False if it doesn't or we can't tell.
+    """
+    try:
+      with open(key_path + ".pub") as public_key_file:
+        public_key = public_key_file.read().split()[1]
+    except (OSError, IndexError):
+      return False
+    import paramiko
+    agent = paramiko.Agent()
+    try:
+      return any(key.get_base64() == public_key for key in agent.get_keys())
+    finally:
+      agent.close()
+
+  def _copyBetweenHosts(self, artifact, remote_path, source_ip, target_ip):
+    """
+    Copy an artifact from an agent (or the master if `source_ip` is
+    None) to another agent, verifying its checksum on arrival. Raises
+    RuntimeError on failure.
+    """
+    tmp_path = remote_path + ".tmp"
+    receive = ("mkdir -p " + self.remote_artifact_dir + " && cat > " + tmp_path +
+               " && echo '" + artifact.sha256 + "  " + tmp_path + "' | sha256sum -c - >/dev/null" +
+               " && mv " + tmp_path + " " + remote_path)
+    cmd = ("ssh -o StrictHostKeyChecking=no -o BatchMode=yes " + self.config.get('ACS', "username") + "@" + target_ip +
+           " " + shlex.quote(receive) + " < " + remote_path)
+    if source_ip is None:
+      connection = self.getMasterConnection()
+    else:
+      connection = self.getAgentConnection(source_ip)
+    status, output, errors = self._execute(connection, cmd, forward_agent = True)
+    if status != 0:
+      raise RuntimeError("copy exited with status " + str(status) + ": " + errors.strip())
+
+  def getAgentConnection(self, ip):
+    """
+    Get the pooled SSH connection to the agent with the given IP. Agents
+    are only reachable from within the cluster so the connection is
+    tunnelled through the master's connection.
+    """
+    from ..SSHPool import SSHPool
+    return SSHPool.get(
+      ip,
+      22,
+      self.config.get('ACS', "username"),
+      os.path.expanduser(self.config.get('SSH', "privatekey")),
+      via = self.getMasterConnection(),
+      connect_timeout = self.getTimeout("connect"))
+
+  def getMasterConnection(self):
+    """
+    Get the pooled SSH connection to the lead master. The connection
+    is shared by every command in this process, so only the first
+    use pays for the SSH handshake.
+    """
+    from ..SSHPool import SSHPool
+    return SSHPool.get(
+      self.getManagementEndpoint(),
+      2200,
+      self.config.get('ACS', "username"),
+      os.path.expanduser(self.config.get('SSH', "privatekey")),
+      connect_timeout = self.getTimeout("connect"))
 
   def executeOnMaster(self, cmd):
     """
     Execute command on the current master leader
     """
-    if self._hostnameResolves(self.getManagementEndpoint()):
-      ssh = SSHClient()
-      ssh.load_system_host_keys()
-      ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-      ssh.connect(
-        self.getManagementEndpoint(),
-        username = self.config.get('ACS', "username"),
-        port = 2200,
-        key_filename = os.path.expanduser(self.config.get('SSH', "privatekey")))
-      session = ssh.get_transport().open_session()
-      self.log.debug("Session opened on master.")
-      self.log.debug("Executing on master: " + cmd)
-
-      AgentRequestHandler(session)
-      stdin, stdout, stderr = ssh.exec_command(cmd)
-      stdin.close()
-      
-      result = ""
-      for line in stdout.read().splitlines():
-        self.log.debug(line.decude("utf-8"))
-        result = result + line.decode("utf-8") + "\n"
-      for line in stderr.read().splitlines():
-        self.log.error(line.decode("utf-8"))
-    else:
+    status, output, errors = self._executeOnMaster(cmd)
+    return output
+
+  def _executeOnMaster(self, cmd, stdin = None):
+    """
+    Execute command on the current master leader, returning a tuple
+    of (exit_status, stdout, stderr).
+    """
+    connection = self.getMasterConnection()
+    if not connection.isActive() and not self._hostnameResolves(self.getManagementEndpoint()):
       self.log.error("Endpoint " + self.getManagementEndpoint() + " does not exist, cannot SSH into it.")
-      result = "Exception: No cluster is available at " + self.getManagementEndpoint()
-    ssh.close()
-    return result
+      return None, "Exception: No cluster is available at " + self.getManagementEndpoint(), ""
+
+    self.log.debug("Executing on master: %s", cmd)
+    with Trace.span("executeOnMaster", "ssh", cmd = cmd):
+      return self._execute(connection, cmd, stdin = stdin, forward_agent = True)
+
+  def streamOnMaster(self, cmd):
+    """
+    Start executing command on the current master leader and return a
+    `CommandStream` from which the output can be read as it arrives,
+    rather than waiting for the command to complete. The command is
+    subject to the "command" timeout.
+    """
+    connection = self.getMasterConnection()
+    if not connection.isActive() and not self._hostnameResolves(self.getManagementEndpoint()):
+      self.log.error("Endpoint " + self.getManagementEndpoint() + " does not exist, cannot SSH into it.")
+      raise RuntimeError("No cluster is available at " + self.getManagementEndpoint())
+
+    self.log.debug("Streaming from master: %s", cmd)
+    return connection.stream(cmd, forward_agent = True, timeout = self.getTimeout("command"))
+
+  def _execute(self, connection, cmd, stdin = None, forward_agent = False):
+    """
+    Execute command on a pooled SSH connection, logging its output.
+    The command is subject to the "command" timeout.
+    """
+    status, output, errors = connection.execute(cmd, forward_agent = forward_agent, stdin = stdin, timeout = self.getTimeout("command"),
+                                                cancellation = self._cancellation())
+
+    lines = output.splitlines()
+    self.log.debug(lambda: "\n".join(lines))
+    if errors:
+      self.log.error("%s", errors.rstrip("\n"))
+
+    return status, "".join(line + "\n" for line in lines), errors
 
   def getClusterSetup(self):
     """
@@ -151,7 +602,7 @@ class Base(object):
 
   def shell_execute(self, cmd):
     """ Execute a command on the client in a bash shell. """
-    self.log.debug("Executing command in shell: " + str(cmd))
+    self.log.debug("Executing command in shell: %s", cmd)
 
     dcos_config = os.path.expanduser('~/.dcos/dcos.toml')
     os.environ['PATH'] = ':'.join([os.getenv('PATH'), '/src/bin'])
@@ -159,8 +610,15 @@ class Base(object):
     os.makedirs(os.path.dirname(dcos_config), exist_ok=True)
     
     try:
-      p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-      output, errors = p.communicate()
+      if not Trace.enabled:
+        name = "shell"
+      elif isinstance(cmd, list):
+        name = cmd[0]
+      else:
+        name = cmd.split(" ", 1)[0]
+      with Trace.span(name, "shell", cmd = cmd):
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+        output, errors = p.communicate()
     except OSError as e:
       self.log.error("Error executing command " + str(cmd) + ". " + e)
       raise e
@@ -171,7 +629,12 @@ class Base(object):
 from acs.ACSLogs import ACSLog
 
 import configparser
+import copy
 import os 
+import re
+import shutil
+import tempfile
+import threading
 
 class Config(object):
 
@@ -212,13 +675,57 @@ class Config(object):
       tmpl.close()
       output.close()
 
+    self._lock = threading.Lock()
+    self._signature = None
+    self._load()
+
+  def _fileSignature(self):
+    try:
+      stat = os.stat(self.filename)
+    except OSError:
+      return self._signature
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+  def _load(self):
+    """
+    Parse the config file and forget any values derived from it.
+    """
+    signature = self._fileSignature()
     defaults = {"orchestratorType": "DCOS"}
     config = configparser.ConfigParser(defaults)
     config.read(self.filename)
     config.set('Group', 'name', config.get('Group', 'name'))
     self.config_parser = config
-      
+    self._cache = {}
+    self._signature = signature
+
+  def _refresh(self):
+    """
+    Re-read the config file if it has been modified (for example by
+    `service scale`) since we last read it.
+    """
+    if self._fileSignature() != self._signature:
+      with self._lock:
+        if self._fileSignature() != self._signature:
+          self.log.debug("Config file has changed, reloading " + self.filename)
+          self._load()
+
+  def _cached(self, key, compute):
+    """
+    Get a value derived from the config file, computing it with
+    `compute()` only if it has not been computed since the file was
+    last read.
+    """
+    self._refresh()
+    cache = self._cache
+    if key not in cache:
+      cache[key] = compute()
+    return cache[key]
+
   def get(self, section, name):
+    return self._cached(("get", section, name), lambda: self._get(section, name))
+
+  def _get(self, section, name):
     value = self.config_parser.get(section, name)
 
     if section == "SSH": 
@@ -243,7 +750,144 @@ class Config(object):
     return value
 
   def getint(self, section, name):
-    return self.config_parser.getint(section, name)
+    return self._cached(("getint", section, name), lambda: self.config_parser.getint(section, name))
+
+  def set(self, section, name, value):
+    """
+    Set the value of an option and save it to the config file,
+    preserving the rest of the file (including comments). The file is
+    replaced atomically so that it is never seen half written, and
+    the previous version is kept with a `.bak` suffix.
+    """
+    with self._lock:
+      with open(self.filename) as old_file:
+        lines = old_file.readlines()
+
+      current = None
+      updated = False
+      for i, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped.startswith("[") and stripped.endswith("]"):
+          if current == section and not updated:
+            lines.insert(i, name + ": " + str(value) + "\n")
+            updated = True
+            break
+          current = stripped[1:-1]
+        elif current == section and re.match(re.escape(name) + r"\s*[:=]", stripped, re.IGNORECASE):
+          lines[i] = name + ": " + str(value) + "\n"
+          updated = True
+          break
+      if not updated:
+        if current != section:
+          lines.append("\n[" + section + "]\n")
+        lines.append(name + ": " + str(value) + "\n")
+
+      fh, tmp_path = tempfile.mkstemp(dir = os.path.dirname(self.filename))
+      try:
+        with os.fdopen(fh, "w") as new_file:
+          new_file.writelines(lines)
+        shutil.copymode(self.filename, tmp_path)
+        shutil.copy2(self.filename, self.filename + ".bak")
+        os.replace(tmp_path, self.filename)
+      except:
+        os.remove(tmp_path)
+        raise
+      self._load()
+
+  def getManagementEndpoint(self):
+    return self._cached(("endpoint", "mgmt"), lambda: self._endpoint('mgmt.'))
+
+  def getAgentEndpoint(self):
+    return self._cached(("endpoint", "agents"), lambda: self._endpoint('agents.'))
+
+  def getTimeout(self, name):
+    """
+    Get a timeout in seconds from the `[Timeouts]` section, or None
+    if it is not set. The timeouts are:
+
+      connect   for each attempt to connect to a host over SSH
+      command   for each command executed on a host
+      deadline  for a command executed on all the agents to complete
+                on every one of them
+    """
+    return self._cached(("timeout", name), lambda: self._getTimeout(name))
+
+  def _getTimeout(self, name):
+    if not self.config_parser.has_option("Timeouts", name):
+      return None
+    value = self.config_parser.get("Timeouts", name).strip()
+    if not value:
+      return None
+    try:
+      value = float(value)
+    except ValueError:
+      raise ValueError("Invalid [Timeouts] " + name + ": '" + value + "'")
+    if value <= 0:
+      raise ValueError("[Timeouts] " + name + " must be a positive number of seconds, got " + str(value))
+    return value
+
+  def getArtifactChecksum(self, filename):
+    """
+    Get the SHA-256 an artifact must have from the `[Artifacts]`
+    section, or None if it isn't given there, e.g.
+
+      [Artifacts]
+      azurefile-dockervolumedriver: 6f1e...
+    """
+    return self._cached(("artifactChecksum", filename), lambda: self._getArtifactChecksum(filename))
+
+  def _getArtifactChecksum(self, filename):
+    if not self.config_parser.has_option("Artifacts", filename):
+      return None
+    return self.config_parser.get("Artifacts", filename).strip().lower()
+
+  def getTunnelPorts(self):
+    """
+    Get the ports to forward through the SSH tunnel to the master as
+    a list of (local_port, remote_port) tuples. These are set by the
+    `ports` option of the `[Tunnel]` section, a comma separated list
+    of `local:remote` (or just `port` if they are the same), e.g.
+
+      [Tunnel]
+      ports: 8080:80, 2375, 8443:443
+
+    If not set the management port of the orchestrator (80 for DC/OS,
+    2375 for Swarm) is forwarded to the same local port.
+    """
+    return list(self._cached(("tunnelPorts",), self._getTunnelPorts))
+
+  def _getTunnelPorts(self):
+    if self.config_parser.has_option("Tunnel", "ports"):
+      spec = self.config_parser.get("Tunnel", "ports")
+    elif self.get("ACS", "orchestratorType").lower() == "swarm":
+      spec = "2375"
+    else:
+      spec = "80"
+
+    ports = []
+    for port in spec.split(","):
+      port = port.strip()
+      if not port:
+        continue
+      local, sep, remote = port.partition(":")
+      try:
+        ports.append((int(local), int(remote or local)))
+      except ValueError:
+        raise ValueError("Invalid port in [Tunnel] ports: '" + port + "'")
+    return ports
+
+  def getLocalPort(self, remote_port):
+    """
+    Get the local port on which the tunnel forwards `remote_port` on
+    the master. If it is not forwarded the same port is returned.
+    """
+    for local, remote in self.getTunnelPorts():
+      if remote == remote_port:
+        return local
+    return remote_port
+
+  def _endpoint(self, kind):
+    return self.get('ACS', 'dnsPrefix') + kind + self.get('Group', 'region').replace(" ", "").replace('"', '') + '.cloudapp.azure.com'
 
   def value(self, set_to):
     value = {}
@@ -256,6 +900,9 @@ class Config(object):
     this is not all the parameters provided in the config 
     file, only the ones needed by the ACS Resource Provider'
     """
+    return copy.deepcopy(self._cached(("ACSParams",), self._getACSParams))
+
+  def _getACSParams(self):
     params = {}
     params["dnsNamePrefix"] = self.value(self.get('ACS', 'dnsPrefix'))
     params["orchestratorType"] = self.value(self.get('ACS', 'orchestratorType'))
@@ -279,6 +926,7 @@ class Config(object):
       self.log.debug("SSH Directory doesn't exist, creating " + ssh_dir)
       os.makedirs(ssh_dir)
 
+    import paramiko
     key = paramiko.RSAKey.generate(1024)
     key.write_private_key_file(os.path.expanduser(private_filepath))
     
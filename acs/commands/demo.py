@@ -17,7 +17,6 @@ Help:
 
 """
 
-import acs.cli
 from .base import Base
 from .service import Service
 from .app import App
@@ -66,7 +65,7 @@ class Demo(Base):
     if self.args["--remove"]:
       return app.remove()
     
-    print(acs.cli.login())
+    print(self.login())
 
     service = Service(self.config, self.options)
     service.create()
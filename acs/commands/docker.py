@@ -4,7 +4,15 @@ cluster. It is useful for perfoming actions such as pre-pulling
 images.
 
 Usage:
-  docker <docker_cmd> [help]
+  docker <docker_cmd> [help] [options]
+
+Options:
+  --parallel=<number>   the number of agents to run the command on concurrently [default: 10]
+  --output=<format>     how to report each agent's result: text, compact (agents
+                        with identical output grouped together), json or ndjson
+                        [default: text]
+  --command-timeout=<seconds>  stop waiting for the command on an agent after this long
+  --deadline=<seconds>  stop waiting for all of the agents after this long
 
 Help:
   For help using the oms command please open an issue at 
@@ -22,26 +30,22 @@ class Docker(Base):
 
   def run(self):
     args = docopt(__doc__, argv=self.options)
-    print("Command args")
-    print(args)
+    self.log.debug("Command args: %s", args)
     self.args = args
 
     command = self.args["<docker_cmd>"]
-    print(self.execute(command))
+    result = self.execute(command)
+    if result:
+      print(result, end = "")
     
     	  
   def help(self):
     print(__doc__)
 
   def execute(self, cmd):
-    """ Run a Docker command on each of the agents """
+    """
+    Run a Docker command on each of the agents. Returns the results
+    in the format given by `--output`, see `Base.reportOnAgents`.
+    """
     self.log.debug("Docker command to run: " + cmd)
-
-    result = ""
-    ips = Base.getAgentIPs(self)
-    for ip in ips:
-      result = result + ip + ": " + cmd + "\n"
-      result = result + self.executeOnAgent("docker -H :2375 " + cmd, ip)
-      result = result + "\n"
-
-    return result
+    return self.reportOnAgents(lambda ip: self.runOnAgent("docker -H :2375 " + cmd, ip), title = cmd)
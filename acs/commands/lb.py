@@ -20,9 +20,9 @@ from docopt import docopt
 from inspect import getmembers, ismethod
 import json
 import os
-import subprocess as sub
 import time
 
+from ..AzureCLI import AzureCLI
 from .base import Base
 
 class Lb(Base):
@@ -62,9 +62,7 @@ class Lb(Base):
     rg = self.config.get("Group", "name")
 
     # List the LBs in order to get the name of the public agent LB
-    p = sub.Popen(['azure', 'network', 'lb', 'list', rg, "--json"],stdout=sub.PIPE,stderr=sub.PIPE)
-    output, errors = p.communicate()
-    lbs = json.loads(output.decode("utf-8"))
+    lbs = AzureCLI.json(['network', 'lb', 'list', rg])
     for lb in lbs:
       id = lb["id"]
       if (id.find("-agent-lb-") >= 0):
@@ -74,19 +72,17 @@ class Lb(Base):
         self.log.debug("Cluster ID " + cluster_id)
 
     # Create a probe
-    p = sub.Popen(['azure', 'network', 'lb', 'probe', "create", "-o", str(port), "-p", "tcp", "-g", rg, "-l", lb_name, "-n", probe_name],stdout=sub.PIPE,stderr=sub.PIPE)
-    output, errors = p.communicate()
+    output, errors = AzureCLI.execute(['network', 'lb', 'probe', "create", "-o", str(port), "-p", "tcp", "-g", rg, "-l", lb_name, "-n", probe_name])
     if errors:
-      self.log.error("Error creating probe for LB rule:\n" + errors.decode("utf-8"))
+      self.log.error("Error creating probe for LB rule:\n" + errors)
       return "Unable to create probe for LB rule, see log for full details."
     self.log.debug("Created probe called " + probe_name)
     
     backend_pool = "dcos-agent-pool-" + cluster_id
     # Create an LB rule
-    p = sub.Popen(['azure', 'network', 'lb', 'rule', "create", "-g", rg, "-l", lb_name, "-n", rule_name, "-p", "tcp", "-f", str(port), "-b", str(port), "-o", backend_pool, "-a", probe_name],stdout=sub.PIPE,stderr=sub.PIPE)
-    output, errors = p.communicate()
+    output, errors = AzureCLI.execute(['network', 'lb', 'rule', "create", "-g", rg, "-l", lb_name, "-n", rule_name, "-p", "tcp", "-f", str(port), "-b", str(port), "-o", backend_pool, "-a", probe_name])
     if errors:
-      self.log.error("Error creating LB rule:\n" + errors.decode("utf-8"))
+      self.log.error("Error creating LB rule:\n" + errors)
       self.log.error("FIXME: cleanup after failed LB port opening - delete probe that was created")
       return "Unable to create LB rule, see log for full details."
     self.log.debug("Created LB rule named " + rule_name)
@@ -95,10 +91,9 @@ class Lb(Base):
     nsg_name = "dcos-agent-public-nsg-" + cluster_id
     priority = 350
     self.log.warning("FIXME: Currently nsg rule priority is set at 350, this will clash if we try to setup a second rule")
-    p = sub.Popen(['azure', 'network', 'nsg', "rule", "create", "-g", rg, "-a", nsg_name, "-p", "*", "-u", str(port), "-n", nsg_rule_name, "-y", str(priority)],stdout=sub.PIPE,stderr=sub.PIPE)
-    output, errors = p.communicate()
+    output, errors = AzureCLI.execute(['network', 'nsg', "rule", "create", "-g", rg, "-a", nsg_name, "-p", "*", "-u", str(port), "-n", nsg_rule_name, "-y", str(priority)])
     if errors:
-      self.log.error("Error creating NSG rule:\n" + errors.decode("utf-8"))
+      self.log.error("Error creating NSG rule:\n" + errors)
       self.log.error("FIXME: cleanup after failed NSG rule creation - delete probe and LB rule that was created")
       return "Unable to create LB rule, see log for full details."
     self.log.debug("Created NSG rule named " + nsg_rule_name)
@@ -17,6 +17,14 @@ Commands:
   install                Install the OMS monitoring agent on all ACS agents
 
 Options:
+  --parallel=<number>    the number of agents to install on concurrently [default: 10]
+  --tree                 upload the OMS agent once to the master and copy it between agents,
+                         rather than from this machine to every agent. Needs a running
+                         ssh-agent, to which the private key is added if not loaded
+  --output=<format>      how to report each agent's result: text, compact (agents with
+                         identical output grouped together), json or ndjson [default: text]
+  --command-timeout=<seconds>  stop waiting for the install on an agent after this long
+  --deadline=<seconds>   stop waiting for all of the agents after this long
 
 Help:
   For help using the oms command please open an issue at 
@@ -27,11 +35,20 @@ Help:
 from docopt import docopt
 from inspect import getmembers, ismethod
 from json import dumps
+import sys
+import time
 
 from .base import Base
 
 class Oms(Base):
 
+  agent_version = "1.1.0-28"
+  # The SHA-256 of the agent bundle of each version, by filename.
+  # Downloads that don't match are rejected. The checksum can also be
+  # set in the [Artifacts] section of the config, a bundle with neither
+  # is trusted on first download.
+  agent_checksums = {}
+
   def run(self):
       args = docopt(__doc__, argv=self.options)
       # print("Global args")
@@ -39,19 +56,16 @@ class Oms(Base):
       self.args = args
 
       command = self.args["<command>"]
-      result = None
-      methods = getmembers(self, predicate = ismethod)
-      for name, method in methods:
-          if name == command:
-              result = method()
-          if result is None:
-            result = command + " returned no results"
-
-      if result:
-          print(result)
-      else:
+      methods = dict(getmembers(self, predicate = ismethod))
+      if command not in methods:
           print("Unknown command: '" + command + "'")
           self.help()
+          return
+      result = methods[command]()
+      if result is None:
+          print(command + " returned no results")
+      elif result:
+          print(result)
 
   def install(self):
       """Install the OMS agent on all ACS agents
@@ -59,36 +73,38 @@ class Oms(Base):
       """
 
       
-      ips = Base.getAgentIPs(self)
-      for ip in ips:
-        self.log.debug("Installing OMS on: " + ip)
-        
-        result = ""
-
-        cmd = "wget https://github.com/Microsoft/OMS-Agent-for-Linux/releases/download/v1.1.0-28/omsagent-1.1.0-28.universal.x64.sh\n"
-        # FIXME: do some error checking
-        result = self.executeOnAgent(cmd, ip)
-
-        cmd = "chmod +x ./omsagent-1.1.0-28.universal.x64.sh\n"
-        # FIXME: do some error checking
-        result = self.executeOnAgent(cmd, ip)
-
-        workspace_id = self.config.get('OMS', "workspace_id")
-        workspace_key = self.config.get('OMS', "workspace_primary_key")
-        cmd = "sudo ./omsagent-1.1.0-28.universal.x64.sh --upgrade -w " + workspace_id + " -s " + workspace_key + "\n"
-        # FIXME: do some error checking
-        result = self.executeOnAgent(cmd, ip)
-
-        cmd = 'sudo sed -i -E "s/(DOCKER_OPTS=\\\")(.*)\\\"/\\1\\2 --log-driver=fluentd --log-opt fluentd-address=localhost:25225\\\"/g" /etc/default/docker'
-        # FIXME: do some error checking
-        result = self.executeOnAgent(cmd, ip)
-
-        cmd = "sudo service docker restart\n"
-        # FIXME: do some error checking
-        result = self.executeOnAgent(cmd, ip)
-
-        result = "OMS installed on all agents (though we don't actually do error checking on the install at this point, so be vigilant)"
-        return result
+      try:
+        bundle = self.fetchArtifact("https://github.com/Microsoft/OMS-Agent-for-Linux/releases/download/v" + self.agent_version +
+                                    "/omsagent-" + self.agent_version + ".universal.x64.sh", self.agent_version,
+                                    self.agent_checksums.get(self.agent_version, {}))
+      except IOError as e:
+        self.log.error("Unable to fetch the OMS agent: " + str(e))
+        sys.exit("Unable to fetch the OMS agent: " + str(e))
+      ips = self.getAgentIPs()
+      if self.getOption("--tree"):
+        self.distributeArtifact(bundle, ips)
+      return self.reportOnAgents(lambda ip: self._installOnAgent(ip, bundle), ips)
+
+  def _installOnAgent(self, ip, bundle):
+      """Install the OMS agent on a single ACS agent from the bundle artifact, returning an `AgentResult`"""
+      self.log.debug("Installing OMS on: " + ip)
+      start = time.time()
+
+      workspace_id = self.config.get('OMS', "workspace_id")
+      workspace_key = self.config.get('OMS', "workspace_primary_key")
+
+      bundle_path = self.pushArtifact(bundle, ip)
+
+      steps = [
+        self.verifyArtifactStep(bundle, bundle_path),
+        "chmod +x " + bundle_path,
+        "sudo ./" + bundle_path + " --upgrade -w " + workspace_id + " -s " + workspace_key,
+        'sudo sed -i -E "s/(DOCKER_OPTS=\\\")(.*)\\\"/\\1\\2 --log-driver=fluentd --log-opt fluentd-address=localhost:25225\\\"/g" /etc/default/docker',
+        "sudo service docker restart"
+      ]
+
+      results = self.executeScriptOnAgent(steps, ip)
+      return self.scriptResult(ip, steps, results, time.time() - start)
 
   def help(self):
     print(__doc__)
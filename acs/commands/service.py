@@ -7,48 +7,80 @@ specified in `--config-file`.
 Usage:
   service <command> [help] [options]
   service execOnMaster <command>
+  service push <file> [options]
 
 Commands:
   create                create an Azure Container Service
   delete                delete an Azure Container Service
-  scale                 Scale the agent cluster up
+  scale                 Scale an agent pool up or down
   show                  display the current service configuration
   connect               open an SSH tunnel to the management interface
   disconnect            close the current SSH tunnel
   execOnMaster          execute a command on the lead master
+  push                  copy a file to every agent (into ~/.acs/artifacts), uploading it only once.
+                        Needs a running ssh-agent, to which the private key is added if not loaded
 
 Options:
-  --agents=<number>            number of agents (currently scale only scale up is supported)
+  --agents=<number>            number of agents
+  --pool=<name>                the agent pool (scale set) to scale, defaults to the private agents
   --quiet                      don't ask the user for input
+  --parallel=<number>          the number of copies between agents to run concurrently [default: 10]
 Examples:
 
 Make the number of agents in the primary pool 5
   acs service scale --agents=5
 
+Copy a Docker image to every agent
+  acs service push myimage.tar
+
 Help:
   For help using the oms command please open an issue at 
   https://github.com/rgardler/acs-scripts
 
 """
+from ..ACSLogs import ACSLog
+from ..AgentPool import AgentPool
+from ..ArtifactCache import ArtifactCache
+from ..AzureCLI import AzureCLI
+from ..Marathon import Marathon
+from ..Trace import Trace
 from .base import Base
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from docopt import docopt
 from inspect import getmembers, ismethod
 import json
 import os
-from sshtunnel import SSHTunnelForwarder
+import select
+import shutil
 import subprocess
 import sys  
-from tempfile import mkstemp
 import signal
+import threading
 import time
-from time import sleep
-import urllib.request
-from shutil import move
-from os import remove, close
 
 class Service(Base):
 
+  pidpath = os.path.expanduser("~/.acs/ssh.pid")
+  # seconds to wait for a new tunnel to be ready
+  tunnel_timeout = 30
+  # seconds to wait for a deployment, and then its DNS, to be ready
+  deployment_timeout = 3600
+  dns_timeout = 600
+  poll_interval = 5
+  max_poll_interval = 60
+
+  dcos_cli_installer_url = "https://raw.githubusercontent.com/mesosphere/dcos-cli/master/bin/install/install-optout-dcos-cli.sh"
+  # the installer follows the master branch, so is downloaded again daily
+  dcos_cli_installer_ttl = 24 * 60 * 60
+  _dcos_cli_prepared = False
+
+  # tunnel() users in this process, shared by all Service instances
+  _tunnel_users = 0
+  _tunnel_owned = False
+  _tunnel_lock = threading.Lock()
+
   def run(self):
     args = docopt(__doc__, argv=self.options)
     # self.log.debug("Service args")
@@ -59,7 +91,14 @@ class Service(Base):
     result = None
 
     if self.args["execOnMaster"]:
-      print(self.execOnMaster(command))
+      with self.streamOnMaster(command) as stream:
+        status = stream.copyTo(sys.stdout, sys.stderr)
+      if status != 0:
+        sys.exit(status)
+      return
+
+    if self.args["push"]:
+      print(self.push(self.args["<file>"]))
       return
 
     methods = getmembers(self, predicate = ismethod)
@@ -83,51 +122,135 @@ class Service(Base):
     return exists
 
   def create(self):
+    """
+    Create the cluster. The ARM deployment is started without waiting
+    for it, and while Azure provisions the cluster we prepare the
+    local tools that don't depend on it (the DC/OS CLI installer and
+    virtualenv). Once the deployment has succeeded we wait for the
+    management endpoint to appear in DNS and finish the setup.
+    """
     if self.exists():
       msg = "It appears that the cluster already exists:\n" + self.show()
       self.log.debug(msg)
       return msg
 
     self.log.debug("Creating ACS Deployment")
-    self.log.debug(json.dumps(self.config.getACSParams()))
+    self.log.debug(lambda: json.dumps(self.config.getACSParams()))
 
     Base.createResourceGroup(self)
-    
-    self._deploy(self.config.get('ACS', 'dnsPrefix'))
-    
-    if self.exists():
-      if self.config.get('ACS', 'orchestratorType') == 'DCOS':
+
+    deploymentName = self.config.get('ACS', 'dnsPrefix')
+    is_dcos = self.config.get('ACS', 'orchestratorType') == 'DCOS'
+    process = self._startDeploy(deploymentName)
+    with ThreadPoolExecutor(max_workers = 1) as executor:
+      prepared = executor.submit(self.prepare_dcos_cli) if is_dcos else None
+      state = self._waitForDeployment(deploymentName, process)
+      if prepared is not None:
+        prepared.result()
+
+    if state != "Succeeded":
+      msg = "Deployment of the cluster " + state.lower()
+      self.log.error(msg)
+      raise RuntimeError(msg)
+
+    if self.waitForDNS():
+      if is_dcos:
         self.install_dcos_cli()
-        
+
       return self.show()
+    raise RuntimeError("The cluster was deployed but " + self.getManagementEndpoint() + " does not resolve")
 
-  def install_dcos_cli(self):
-    self.log.info("Installing DCOS CLI")
+  def prepare_dcos_cli(self):
+    """
+    Get the DC/OS CLI installer (from the artifact cache) and install
+    virtualenv. This doesn't need the cluster so can be done while it
+    is deployed.
+    """
+    if self._dcos_cli_prepared:
+      return
+    self.log.info("Preparing DCOS CLI installation")
 
-    self.connect()
-    
     cmd = "pip install virtualenv"
     os.system(cmd)
 
-    cmd = "wget https://raw.githubusercontent.com/mesosphere/dcos-cli/master/bin/install/install-optout-dcos-cli.sh -O install-optout-dcos-cli.sh"
-    os.system(cmd)
+    installer = ArtifactCache.fetch(self.dcos_cli_installer_url, ttl = self.dcos_cli_installer_ttl)
+    shutil.copy(installer.path, "install-optout-dcos-cli.sh")
+    os.chmod("install-optout-dcos-cli.sh", 0o755)
 
-    cmd = "chmod +x install-optout-dcos-cli.sh"
-    os.system(cmd)
+    self._dcos_cli_prepared = True
 
-    cmd = "./install-optout-dcos-cli.sh . http://localhost --add-path yes"
-    os.system(cmd)
+  def install_dcos_cli(self):
+    self.log.info("Installing DCOS CLI")
+
+    self.connect()
+
+    self.prepare_dcos_cli()
+
+    cmd = "./install-optout-dcos-cli.sh . http://localhost:" + str(self.config.getLocalPort(80)) + " --add-path yes"
+    with Trace.span("install-optout-dcos-cli.sh", "shell", cmd = cmd):
+      os.system(cmd)
 
     self.log.info("DCOS installed. If you want to use the DC/OS command line directly then execute `. /src/bin/env-setup`")
 
-    
-  def _deploy(self, deploymentName):
-    command = "azure group deployment create"
-    command = command + " " + self.config.get('Group', 'name')
-    command = command + " " + deploymentName
-    command = command + " --template-uri " + self.config.get('Template', 'templateUrl')
-    command = command + " -p '" + json.dumps(self.config.getACSParams()) + "'"
-    os.system(command)
+  def _startDeploy(self, deploymentName):
+    """
+    Submit the cluster template for deployment without waiting for
+    it. Returns the `subprocess.Popen` for the CLI.
+    """
+    return AzureCLI.start(["group", "deployment", "create",
+                           self.config.get('Group', 'name'),
+                           deploymentName,
+                           "--template-uri", self.config.get('Template', 'templateUrl'),
+                           "-p", json.dumps(self.config.getACSParams()),
+                           "--nowait"])
+
+  def _waitForDeployment(self, deploymentName, process):
+    """
+    Poll the state of a deployment, backing off exponentially, until
+    it has finished. Returns the final provisioning state.
+    """
+    group = self.config.get('Group', 'name')
+    deadline = time.time() + self.deployment_timeout
+    interval = self.poll_interval
+    while True:
+      if process.poll() is not None and process.returncode != 0:
+        output, errors = process.communicate()
+        msg = "Unable to start the deployment: " + errors.decode("utf-8")
+        self.log.error(msg)
+        raise RuntimeError(msg)
+
+      try:
+        deployment = AzureCLI.json(["group", "deployment", "show", group, deploymentName], cached = False)
+        state = deployment.get("properties", deployment).get("provisioningState")
+      except subprocess.CalledProcessError:
+        # the deployment has not been created yet
+        state = None
+      self.log.debug("Deployment %s is %s", deploymentName, state)
+      if state in ("Succeeded", "Failed", "Canceled"):
+        process.communicate()
+        # results read while it was deploying are out of date
+        AzureCLI.invalidate()
+        return state
+
+      if time.time() + interval > deadline:
+        raise RuntimeError("Timed out waiting for the deployment " + deploymentName + ", it is " + str(state))
+      time.sleep(interval)
+      interval = min(interval * 2, self.max_poll_interval)
+
+  def waitForDNS(self):
+    """
+    Wait, for up to `dns_timeout` seconds, for the management endpoint
+    to resolve. Returns True if it does.
+    """
+    deadline = time.time() + self.dns_timeout
+    interval = 1
+    while not self.exists():
+      if time.time() + interval > deadline:
+        return False
+      self.log.debug("Waiting for %s to resolve", self.getManagementEndpoint())
+      time.sleep(interval)
+      interval = min(interval * 2, self.max_poll_interval)
+    return True
 
   def delete(self, quiet = False):
     self.log.debug("Deleting ACS Deployment")
@@ -148,7 +271,7 @@ class Service(Base):
     command = "azure acs delete"
     command = command + " " + group
     command = command + " containerservice-" + self.config.get('ACS', 'dnsPrefix')
-    os.system(command)
+    AzureCLI.system(command)
     
     # FIXME: we shouldn't need to do the group delete, but currently container delete is not a deep delete
     print("'azure acs delete 'does not currently delete resources created within the container service. You can delete all resources by also deleting the associated resource group, however, be aware this will delete everything in the resource group.")
@@ -156,32 +279,28 @@ class Service(Base):
     if quiet or self.args["--quiet"]:
       command = command + " --quiet "
     command = command + self.config.get('Group', 'name')
-    os.system(command)
+    AzureCLI.system(command)
 
   def scale(self):
+    """
+    Scale the agent pool given in `--pool` (by default the private
+    agents) to `--agents` agents, changing only the capacity of its
+    scale set rather than redeploying the whole template.
+    """
+    agents = self.args.get("--agents")
+    try:
+      desired_agents = int(agents)
+    except (TypeError, ValueError):
+      desired_agents = -1
+    if desired_agents < 0:
+      self.help()
+      return "--agents must be given as the number of agents to scale to, got " + str(agents)
+
     if not self.exists():
       return "It appears that the cluster does not exists (try running `acs service createo`)"
 
-    desired_agents = self.args["--agents"]
-
-    fh, abs_path = mkstemp()
-    with open(abs_path,'w') as new_file:
-      with open(self.config.filename) as old_file:
-        for line in old_file:
-          if line.startswith("agentCount:"):
-            new_file.write("agentCount: " + str(desired_agents) + "\n")
-          else:
-            new_file.write(line)
-    close(fh)
-    try:
-      remove(self.config.filename + ".bak")
-    except OSError:
-      pass
-    move(self.config.filename, self.config.filename + ".bak")
-    move(abs_path, self.config.filename)
+    AgentPool(self.config).scale(self.args.get("--pool"), desired_agents)
 
-    self._deploy("scale")
-    
     return "Scaled to " + str(desired_agents)
 
   def show(self):
@@ -198,83 +317,89 @@ class Service(Base):
     self.log.warning("Service.openTunnel() is deprecated. Please use Service.connect instead.")
   
   def connect(self):
-    """Open an SSH tunnel to the management endpoint, if one doesn't
-    already exist. The PID for the tunnel is written to
-    `~/.acs/ssh.pid`.  If a tunnel already exiss then a new one will
-    not be created instead PID for the existing tunnel will be
-    returned.
-
-    This method attempts to block until we have an active connection
-    to the master endpoint.
+    """Open an SSH tunnel to the master, if one doesn't already
+    exist, forwarding the ports configured in the `[Tunnel]` section
+    of the config file (by default the orchestrator's management
+    port). The PID for the tunnel is written to `~/.acs/ssh.pid`. If
+    a tunnel already exists then a new one will not be created,
+    instead the PID for the existing tunnel will be returned.
+
+    The tunnel runs in a forked process which tells us over a pipe
+    when it is ready (or why it failed), so this method returns as
+    soon as the tunnel can be used. The tunnel sends keepalives and
+    reconnects automatically if the connection to the master drops.
 
     """
+    pidpath = self.pidpath
+    pid = self._tunnelPid()
+    if pid is not None:
+      return "A tunnel already exists using PID " + str(pid)
 
-    pidpath = os.path.expanduser("~/.acs/ssh.pid")
-    if os.path.isfile(pidpath):
-      pidfile = open(pidpath)
-      pid = pidfile.read()
-      pidfile.close()
-
-      # check the process exists
-      # 'kill(pid, 0)' does not kill the process, it just throws an `OSError` if the PID does not exist
-      try:
-        os.kill(int(pid), 0)
-        return "A tunnel already exists using PID " + str(pid)
-      except OSError:
-        # seems the old tunnel has gone away
-        self.log.info("A PIDFile exists, but the process does not seem to be present. Removing the PIDFile and opening a new tunnel.")
-        os.remove(pidpath)
-    
+    ports = self.config.getTunnelPorts()
+    ready_read, ready_write = os.pipe()
     try:
       pid = os.fork()
-      if pid > 0:
-        # Exit parent process
-        pidfile = open(pidpath, 'w')
-        pidfile.write(str(pid))
-        pidfile.close()
-
-        time.sleep(0.5)
-
-        # wait until we can connect to the master endpoint
-        isConnected = False
-        attempts = 0
-        while not isConnected and attempts < 50:
-          req = urllib.request.Request("http://localhost")
-          try:
-            with urllib.request.urlopen(req) as response:
-              html = response.read()
-              isConnected = True
-          except urllib.error.URLError as e:
-            isConnected = False
-            attempts = attempts + 1
-            self.log.debug("SSH tunnel not established, waiting for 1/10th of a second")
-            time.sleep(0.1)
-
-        if attempts < 50:
-          msg = "Connection opened (PID " + str(pid) + ")"
-        else:
-          raise RuntimeError("Unable to open an SSH tunnel to the management endpoint.")
-          
-        return msg
     except OSError as e:
+      os.close(ready_read)
+      os.close(ready_write)
       msg = "Unable to create forked proces for the SSH Tunnel: " + str(e)
       self.log.error(msg)
       raise RuntimeError(msg)
 
+    if pid > 0:
+      os.close(ready_write)
+      # the tunnel's own spans are in the forked process and not traced
+      with Trace.span("tunnel connect", "tunnel", host = self.getManagementEndpoint(), ports = ports):
+        with os.fdopen(ready_read) as ready:
+          readable, writable, failed = select.select([ready], [], [], self.tunnel_timeout)
+          status = ready.readline().strip() if readable else "timed out waiting for the tunnel"
+
+      if status != "ready":
+        try:
+          os.kill(pid, signal.SIGTERM)
+        except OSError:
+          pass
+        self._waitForExit(pid, 1.0)
+        msg = "Unable to open an SSH tunnel to the management endpoint: " + status
+        self.log.error(msg)
+        raise RuntimeError(msg)
+
+      with open(pidpath, 'w') as pidfile:
+        pidfile.write(str(pid))
+      forwarded = ", ".join(str(local) + "->" + str(remote) for local, remote in ports)
+      return "Connection opened (PID " + str(pid) + ", ports " + forwarded + ")"
+
+    # the log writing thread is not copied by fork (this is automatic
+    # from Python 3.7)
+    ACSLog.afterFork()
+
     # Decouple from the parent environment
+    os.close(ready_read)
     os.chdir("/")
     os.setsid()
     os.umask(0)
 
-    with SSHTunnelForwarder(
-      (self.getManagementEndpoint(), 2200),
-      remote_bind_address = ('localhost', 80),
-      local_bind_address = ('', 80),
-      ssh_username = self.config.get('ACS', 'username'),
-      ssh_pkey = os.path.expanduser(self.config.get('SSH', "privatekey"))
-    ) as server:
-      while True:
-        sleep(10)
+    from ..SSHPool import SSHConnection
+    from ..Tunnel import Tunnel
+
+    connection = SSHConnection(self.getManagementEndpoint(), 2200,
+                               self.config.get('ACS', 'username'),
+                               os.path.expanduser(self.config.get('SSH', "privatekey")))
+    tunnel = Tunnel(connection, ports)
+    with os.fdopen(ready_write, "w") as ready:
+      try:
+        tunnel.start()
+        ready.write("ready\n")
+      except Exception as e:
+        ready.write(str(e).replace("\n", " ") + "\n")
+        ready.close()
+        os._exit(1)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: tunnel.stop())
+    try:
+      tunnel.serve_forever()
+    finally:
+      os._exit(0)
 
   def closeTunnel(self):
     """DEPRECATED: use disconnect() instead"""
@@ -286,46 +411,116 @@ class Service(Base):
     Close the SSH tunnel to the management endpoint with the supplied pid
     """
 
-    pidpath = os.path.expanduser("~/.acs/ssh.pid")
-    if os.path.isfile(pidpath):
-      pidfile = open(pidpath)
-      pid = pidfile.read()
-      pidfile.close()
-
-      # check the process exists
-      # 'kill(pid, 0)' does not kill the process, it just throws an `OSError` if the PID does not exist
-      try:
-        os.kill(int(pid), 0)
-      except OSError:
-        # seems the old tunnel has gone away
-        self.log.debug("A PIDFile exists, but the process does not seem to be present. Removing the PIDFile.")
-        os.remove(pidpath)
-    else:
+    pid = self._tunnelPid()
+    if pid is None:
       raise RuntimeWarning("No SSH PID file, therefore assuming there is no active tunnel to close.")
 
-    self.log.info("Attempting to kill the SSH tunnel, process: " + pid)
+    self.log.info("Attempting to kill the SSH tunnel, process: " + str(pid))
     try:
-      os.kill(int(pid), signal.SIGTERM)
-      time.sleep(1.0)
-      os.remove(pidpath)
+      os.kill(pid, signal.SIGTERM)
+      self._waitForExit(pid, 1.0)
+      os.remove(self.pidpath)
       return "Disconnected"
     except OSError as err:
       self.log.exception(err)
       raise RuntimeError("Unable to killthe SSH Tunnel process: " + str(err))
+
+  def _tunnelPid(self):
+    """
+    Get the PID of the running SSH tunnel process, or None if there
+    is no tunnel. A PID file left by a tunnel that has gone away is
+    removed.
+    """
+    if not os.path.isfile(self.pidpath):
+      return None
+    with open(self.pidpath) as pidfile:
+      pid = int(pidfile.read())
+
+    # check the process exists
+    # 'kill(pid, 0)' does not kill the process, it just throws an `OSError` if the PID does not exist
+    try:
+      os.kill(pid, 0)
+      return pid
+    except OSError:
+      # seems the old tunnel has gone away
+      self.log.info("A PIDFile exists, but the process does not seem to be present. Removing the PIDFile.")
+      os.remove(self.pidpath)
+      return None
+
+  def _waitForExit(self, pid, timeout):
+    """
+    Wait up to `timeout` seconds for a process to exit, reaping it if
+    it is our child.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+      try:
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+          return
+      except ChildProcessError:
+        # not our child, all we can do is check whether it still exists
+        try:
+          os.kill(pid, 0)
+        except OSError:
+          return
+      time.sleep(0.01)
+
+  @contextmanager
+  def tunnel(self):
+    """
+    A context in which an SSH tunnel to the management endpoint is
+    open. The tunnel is shared by nested and concurrent users in this
+    process and is only closed when the outermost user leaves the
+    context. A tunnel that was already open before the first user
+    entered the context is reused and left open.
+
+      with service.tunnel():
+        ...
+    """
+    with Service._tunnel_lock:
+      if Service._tunnel_users == 0:
+        Service._tunnel_owned = self._tunnelPid() is None
+        if Service._tunnel_owned:
+          self.connect()
+      Service._tunnel_users = Service._tunnel_users + 1
+    try:
+      yield
+    finally:
+      with Service._tunnel_lock:
+        Service._tunnel_users = Service._tunnel_users - 1
+        if Service._tunnel_users == 0 and Service._tunnel_owned:
+          Service._tunnel_owned = False
+          if self._tunnelPid() is not None:
+            self.disconnect()
     
+  def push(self, filename):
+    """
+    Copy a local file to every agent. The file is uploaded to the
+    master once and copied between the agents within the cluster.
+    """
+    artifact = ArtifactCache.forFile(filename)
+    results = self.distributeArtifact(artifact)
+    lines = []
+    for ip, result in results.items():
+      lines.append(ip + ": " + result)
+    return "\n".join(lines)
+
   def execOnMaster(self, command):
     """
-    Execute the supplied sommand on the lead master.
+    Execute the supplied command on the lead master, returning its
+    output.
     """
     return self.executeOnMaster(command)
         
   def marathonCommand(self, command, method = 'GET', data = None):
-    self.connect()
-    curl = 'curl -s -X ' + method 
-    if data != None:
-      curl = curl + " -d \"" + data + "\" -H \"Content-type:application/json\""
-    cmd = curl + ' localhost/marathon/v2/' + command 
-    self.log.debug('Command to execute: ' + cmd)
-    result = self.shell_execute(cmd)
-    self.disconnect()
-    return result
+    """
+    Make a request to the Marathon API through the tunnel, `command`
+    being the path relative to /marathon/v2 (e.g. "groups"). `data`
+    is the request body, either as JSON text or as the object to
+    send. Returns the decoded response.
+    """
+    if isinstance(data, str):
+      data = json.loads(data)
+    with self.tunnel():
+      with Marathon(port = self.config.getLocalPort(80)) as marathon:
+        return marathon.request(method, command, data)
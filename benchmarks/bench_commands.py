@@ -0,0 +1,136 @@
+"""Time whole `acs` commands offline and enforce their budgets.
+
+Each command in the budgets file is run in a new process with the fake
+`azure` and `dcos` tools (see fakecli/) answering from the fixture, an
+empty home directory and, if it needs agents, a `SimulatedCluster`.
+The time the command takes and the number of `azure` and `dcos`
+processes it spawns are compared with its budget. The exit status is 1
+if any command is over budget, so that caching and batching gains are
+kept.
+
+Usage:
+  bench_commands.py [options]
+
+Options:
+  --budgets=<file>    the commands and their budgets [default: benchmarks/budgets.json]
+  --fixture=<file>    the fixture the fake tools answer from [default: benchmarks/fixtures/cluster.json]
+  --runs=<number>     the number of times to run each command, the median time is used [default: 3]
+  --only=<names>      comma separated names of the commands to run, all of them if not given
+
+Run it from the root of the repository:
+
+  python -m benchmarks.bench_commands --only="service show,lb open"
+
+A budget may limit the `seconds` taken and the number of `azure` and
+`dcos` processes spawned. Commands that need agents give the number of
+`agents` to simulate and any `cluster` options (see `SimulatedCluster`).
+
+"""
+from docopt import docopt
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fake_cli_dir = os.path.join(root_dir, "benchmarks", "fakecli")
+
+def countCalls(state_dir):
+    """
+    Count the calls made to each of the fake tools.
+    """
+    counts = {"azure": 0, "dcos": 0}
+    try:
+        with open(os.path.join(state_dir, "calls.log")) as log_file:
+            for line in log_file:
+                tool = json.loads(line)["tool"]
+                counts[tool] = counts.get(tool, 0) + 1
+    except OSError:
+        pass
+    return counts
+
+def runOnce(command, fixture):
+    """
+    Run a command in a new process, returning the seconds it took and
+    the calls made to the fake tools.
+    """
+    home = tempfile.mkdtemp(prefix = "acs-bench-home-")
+    try:
+        state_dir = os.path.join(home, "fake-state")
+        spec_path = os.path.join(home, "spec.json")
+        spec = {
+            "argv": command["argv"],
+            "agents": command.get("agents", 0),
+            "cluster": command.get("cluster", {}),
+            "config": os.path.join(home, "cluster.ini"),
+            "result": os.path.join(home, "result.json")
+        }
+        with open(spec_path, "w") as spec_file:
+            json.dump(spec, spec_file)
+
+        env = dict(os.environ)
+        env["HOME"] = home
+        env["PATH"] = fake_cli_dir + os.pathsep + env.get("PATH", "")
+        env["PYTHONPATH"] = root_dir + os.pathsep + env.get("PYTHONPATH", "")
+        env["ACS_FAKE_FIXTURE"] = os.path.abspath(fixture)
+        env["ACS_FAKE_STATE"] = state_dir
+        env.pop("ACS_CACHE_TTL", None)
+
+        p = subprocess.Popen([sys.executable, "-m", "benchmarks.run_command", spec_path],
+                             cwd = home, env = env, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        output, errors = p.communicate()
+        if p.returncode != 0 or not os.path.isfile(spec["result"]):
+            raise RuntimeError("'acs " + " ".join(command["argv"]) + "' failed:\n" + errors.decode("utf-8"))
+        with open(spec["result"]) as result_file:
+            seconds = json.load(result_file)["seconds"]
+        return seconds, countCalls(state_dir)
+    finally:
+        shutil.rmtree(home, ignore_errors = True)
+
+def measure(command, fixture, runs):
+    times = []
+    calls = None
+    for i in range(runs):
+        seconds, calls = runOnce(command, fixture)
+        times.append(seconds)
+    times.sort()
+    result = {"name": command["name"], "seconds": times[len(times) // 2]}
+    result.update(calls)
+    return result
+
+def overBudget(result, budget):
+    """
+    The measures of a result that are over its budget.
+    """
+    return [measure for measure, limit in sorted(budget.items()) if result.get(measure, 0) > limit]
+
+def main(argv = None):
+    options = docopt(__doc__, argv = argv)
+    with open(options["--budgets"]) as budgets_file:
+        commands = json.load(budgets_file)
+    if options["--only"]:
+        names = [name.strip() for name in options["--only"].split(",")]
+        commands = [command for command in commands if command["name"] in names]
+
+    failed = False
+    print("%-16s %16s %10s %10s  %s" % ("command", "seconds", "azure", "dcos", ""))
+    for command in commands:
+        budget = command.get("budget", {})
+        result = measure(command, options["--fixture"], int(options["--runs"]))
+        over = overBudget(result, budget)
+        failed = failed or bool(over)
+
+        def column(measure, format):
+            value = format % result.get(measure, 0)
+            if measure in budget:
+                value = value + "/" + (format % budget[measure])
+            return value
+        print("%-16s %16s %10s %10s  %s" % (
+            command["name"], column("seconds", "%.2f"), column("azure", "%d"), column("dcos", "%d"),
+            "OVER BUDGET (" + ", ".join(over) + ")" if over else "ok"))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
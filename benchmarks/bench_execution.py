@@ -0,0 +1,260 @@
+"""Benchmark remote execution against a simulated cluster.
+
+Measures executing commands on the master and on agents, `acs docker`
+and the AFS and OMS installs, at each of the given cluster sizes, on a
+`SimulatedCluster` (see simcluster.py). Nothing needs to be deployed.
+
+For each operation we report how many operations completed per second,
+the median and 99th percentile time of an operation and the number of
+SSH handshakes made. Results can be saved with `--save` and compared
+with a previous run with `--baseline`, in which case the exit status is
+1 if any operation's throughput fell by more than `--tolerance`.
+
+Usage:
+  bench_execution.py [options]
+
+Options:
+  --agents=<sizes>          comma separated cluster sizes [default: 1,10,100,500]
+  --latency=<seconds>       latency of each hop, each way [default: 0.005]
+  --bandwidth=<bytes>       bandwidth of each hop in bytes per second, unlimited if 0 [default: 12500000]
+  --command-time=<secs>     time each simulated command takes [default: 0.01]
+  --step-time=<secs>        time each step of an install script takes [default: 0.01]
+  --artifact-size=<bytes>   size of the artifacts installed [default: 1048576]
+  --master-calls=<n>        number of commands to execute on the master [default: 50]
+  --parallel=<number>       the number of agents to work on concurrently [default: 10]
+  --save=<file>             write the results as JSON to this file
+  --baseline=<file>         compare the results with those saved from a previous run
+  --tolerance=<fraction>    the fall in throughput allowed before failing [default: 0.2]
+
+Run it from the root of the repository:
+
+  python -m benchmarks.bench_execution --agents=1,10
+
+"""
+from .simcluster import SimulatedCluster, SimulatedMasterCommand
+
+from acs import commands
+from acs.ArtifactCache import ArtifactCache
+from acs.SSHPool import SSHPool
+from acs.commands.base import Config
+
+from collections import OrderedDict
+from contextlib import contextmanager, redirect_stdout
+from docopt import docopt
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+CONFIG = """[Group]
+region: westus
+name: benchmark
+
+[ACS]
+dnsPrefix: benchmark
+username: azureuser
+orchestratorType: DCOS
+agentCount: 1
+agentVMSize: Standard_D2_v2
+masterCount: 1
+
+[SSH]
+publicKey: {key}.pub
+privatekey: {key}
+
+[Storage]
+name: benchmark
+type: LRS
+shareName: files
+mount: ~/sharedfiles
+
+[OMS]
+workspace_id: benchmark
+workspace_primary_key: benchmark
+"""
+
+class SimulatedClusterCommand(SimulatedMasterCommand):
+    """
+    Mixed in to a command to have it work entirely on a
+    `SimulatedCluster`, without the `azure` CLI.
+    """
+    def getAgentIPs(self):
+        return list(self.cluster.agents)
+
+    # The storage account is not part of what we're measuring
+
+    def createStorage(self):
+        pass
+
+    def getStorageAccountKey(self):
+        return "benchmark"
+
+    def getShareEndpoint(self):
+        return "https://benchmark.file.core.windows.net/"
+
+def simulated(command_class, cluster, config, args):
+    command = type("Simulated" + command_class.__name__, (SimulatedClusterCommand, command_class), {"cluster": cluster})(config, None)
+    command.args = args
+    return command
+
+@contextmanager
+def offlineArtifacts(cache_dir, size):
+    """
+    Have `ArtifactCache` produce artifacts of `size` bytes, rather than
+    downloading them, caching them in `cache_dir`.
+    """
+    def download(cls, url, sha256):
+        os.makedirs(os.path.join(cls.cache_dir, "blobs"), exist_ok = True)
+        content = (hashlib.sha256(url.encode("utf-8")).hexdigest().encode("utf-8") * (size // 64 + 1))[:size]
+        digest = hashlib.sha256(content).hexdigest()
+        with open(cls._blobPath(digest), "wb") as blob:
+            blob.write(content)
+        return digest
+
+    saved = (ArtifactCache.cache_dir, ArtifactCache.__dict__["_download"])
+    ArtifactCache.cache_dir = cache_dir
+    ArtifactCache._download = classmethod(download)
+    try:
+        yield
+    finally:
+        ArtifactCache.cache_dir, ArtifactCache._download = saved
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def measure(cluster, name, agents, operation):
+    """
+    Run `operation()` on a cold pool of connections. It returns the
+    time taken by each of the operations it performed.
+    """
+    SSHPool.closeAll()
+    cluster.resetCounters()
+    start = time.time()
+    durations = operation()
+    elapsed = time.time() - start
+    return OrderedDict([
+        ("operation", name),
+        ("agents", agents),
+        ("operations", len(durations)),
+        ("seconds", round(elapsed, 3)),
+        ("throughput", round(len(durations) / elapsed, 2) if elapsed else None),
+        ("p50", round(percentile(durations, 0.5), 4)),
+        ("p99", round(percentile(durations, 0.99), 4)),
+        ("handshakes", cluster.handshakes)
+    ])
+
+def recordDurations(command, run):
+    """
+    Run a fan-out command with `--output ndjson` and return the time
+    taken on each agent, raising an error if any agent failed.
+    """
+    out = io.StringIO()
+    with redirect_stdout(out):
+        run()
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    failed = [record for record in records if record["status"] != 0]
+    if failed:
+        raise RuntimeError(command + " failed on " + failed[0]["host"] + ": " + failed[0]["stderr"])
+    return [record["duration"] for record in records]
+
+def benchmark(agents, options, work_dir):
+    cluster = SimulatedCluster(
+        agents,
+        latency = float(options["--latency"]),
+        bandwidth = float(options["--bandwidth"]) or None,
+        command_time = float(options["--command-time"]),
+        step_time = float(options["--step-time"]),
+        key_dir = work_dir)
+    config_path = os.path.join(work_dir, "cluster.ini")
+    results = []
+    with cluster:
+        with open(config_path, "w") as config_file:
+            config_file.write(CONFIG.format(key = cluster.key_filename))
+        config = Config(config_path)
+        args = {"--parallel": options["--parallel"], "--output": "ndjson"}
+        base = simulated(commands.Base, cluster, config, args)
+
+        def onMaster():
+            durations = []
+            for i in range(int(options["--master-calls"])):
+                start = time.time()
+                base.executeOnMaster("hostname")
+                durations.append(time.time() - start)
+            return durations
+        results.append(measure(cluster, "executeOnMaster", agents, onMaster))
+
+        def onAgents():
+            def run(ip):
+                start = time.time()
+                base.executeOnAgent("hostname", ip)
+                return time.time() - start
+            return list(base.forEachAgent(run).values())
+        results.append(measure(cluster, "executeOnAgent", agents, onAgents))
+
+        docker = simulated(commands.Docker, cluster, config, args)
+        results.append(measure(cluster, "docker", agents,
+                               lambda: recordDurations("docker", lambda: docker.execute("pull nginx"))))
+
+        with offlineArtifacts(os.path.join(work_dir, "artifacts"), int(options["--artifact-size"])):
+            afs = simulated(commands.Afs, cluster, config, args)
+            results.append(measure(cluster, "afs install", agents,
+                                   lambda: recordDurations("afs install", afs.install)))
+            oms = simulated(commands.Oms, cluster, config, args)
+            results.append(measure(cluster, "oms install", agents,
+                                   lambda: recordDurations("oms install", oms.install)))
+    SSHPool.closeAll()
+    return results
+
+def report(results, baseline, tolerance):
+    """
+    Print the results, compared with the baseline if there is one.
+    Returns the results whose throughput regressed.
+    """
+    previous = dict(((result["operation"], result["agents"]), result) for result in baseline)
+    regressions = []
+    print("%-16s %6s %8s %10s %9s %9s %10s %s" % ("operation", "agents", "ops", "ops/sec", "p50", "p99", "handshakes", ""))
+    for result in results:
+        change = ""
+        before = previous.get((result["operation"], result["agents"]))
+        if before is not None and before["throughput"]:
+            ratio = result["throughput"] / before["throughput"]
+            change = "%+.0f%%" % ((ratio - 1) * 100)
+            if ratio < 1 - tolerance:
+                change = change + " REGRESSION"
+                regressions.append(result)
+        print("%-16s %6d %8d %10.2f %8.4fs %8.4fs %10d %s" % (
+            result["operation"], result["agents"], result["operations"], result["throughput"],
+            result["p50"], result["p99"], result["handshakes"], change))
+    return regressions
+
+def main(argv = None):
+    options = docopt(__doc__, argv = argv)
+    baseline = []
+    if options["--baseline"]:
+        with open(options["--baseline"]) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = []
+    for agents in options["--agents"].split(","):
+        work_dir = tempfile.mkdtemp(prefix = "acs-benchmark-")
+        try:
+            results.extend(benchmark(int(agents), options, work_dir))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors = True)
+
+    if options["--save"]:
+        with open(options["--save"], "w") as save_file:
+            json.dump(results, save_file, indent = 2)
+
+    regressions = report(results, baseline, float(options["--tolerance"]))
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""Stateful fakes of the `azure` and `dcos` command line tools.
+
+The `azure` and `dcos` executables in this directory answer from the
+JSON fixture named by `ACS_FAKE_FIXTURE`, so that commands can be run
+and timed offline. The fixture has a section per tool:
+
+  {
+    "azure": {
+      "delay": 0.3,
+      "rules": [
+        {"args": ["network", "lb", "list", "*", "--json"], "json": [...]},
+        {"args": ["network", "lb", "probe", "create", "**"],
+         "record": {"state": "probes", "key": "-n"}, "delay": 1.0},
+        ...
+      ]
+    },
+    "dcos": {...}
+  }
+
+The first rule whose `args` match the command line is used: `*`
+matches any one argument and `**` any number. A rule responds with
+`json` (printed as JSON), `stdout`, `stderr` and `status`, after
+sleeping for its `delay` (or the tool's default delay, which stands in
+for the seconds the real tools take to start). `sequence` is a list of
+responses returned in turn on successive calls, the last repeating.
+
+Rules can keep state between calls, in `ACS_FAKE_STATE` (a directory):
+`record` adds the value of the argument following `key` to a list in
+the state, failing as the real tool would if it is already there, and
+a `json` of `{"$state": name}` prints that list.
+
+Every call is logged to `calls.log` in the state directory, one JSON
+record per line, so that the number of processes spawned can be
+counted. Commands without a matching rule fail.
+
+"""
+import fcntl
+import json
+import os
+import sys
+import time
+
+def match(pattern, args):
+    if not pattern:
+        return not args
+    if pattern[0] == "**":
+        return any(match(pattern[1:], args[i:]) for i in range(len(args) + 1))
+    if not args:
+        return False
+    return (pattern[0] == "*" or pattern[0] == args[0]) and match(pattern[1:], args[1:])
+
+class State:
+    """The fake's state, locked for the duration of a call."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok = True)
+        self.lock_file = open(os.path.join(directory, "state.lock"), "w")
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            with open(os.path.join(directory, "state.json")) as state_file:
+                self.values = json.load(state_file)
+        except (OSError, ValueError):
+            self.values = {}
+
+    def log(self, tool, args):
+        with open(os.path.join(self.directory, "calls.log"), "a") as log_file:
+            log_file.write(json.dumps({"tool": tool, "args": args, "time": time.time()}) + "\n")
+
+    def save(self):
+        path = os.path.join(self.directory, "state.json")
+        with open(path + ".tmp", "w") as state_file:
+            json.dump(self.values, state_file)
+        os.replace(path + ".tmp", path)
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+
+def respond(tool, rule, args, state):
+    """
+    Get the response of a rule as a tuple of (stdout, stderr, status).
+    """
+    if "sequence" in rule:
+        calls = state.values.setdefault("calls", {})
+        key = tool + ":" + json.dumps(rule["args"])
+        index = calls.get(key, 0)
+        calls[key] = index + 1
+        response = rule["sequence"][min(index, len(rule["sequence"]) - 1)]
+    else:
+        response = rule
+
+    if "record" in rule:
+        record = rule["record"]
+        values = state.values.setdefault(record["state"], [])
+        value = args[args.index(record["key"]) + 1] if record["key"] in args else None
+        if value in values:
+            return "", "error:   " + str(value) + " already exists\n", 1
+        values.append(value)
+
+    stdout = response.get("stdout", "")
+    if "json" in response:
+        value = response["json"]
+        if isinstance(value, dict) and "$state" in value:
+            value = state.values.get(value["$state"], [])
+        stdout = json.dumps(value, indent = 2) + "\n"
+    return stdout, response.get("stderr", ""), response.get("status", 0)
+
+def main(tool, args):
+    with open(os.environ["ACS_FAKE_FIXTURE"]) as fixture_file:
+        fixture = json.load(fixture_file).get(tool, {})
+    state = State(os.environ["ACS_FAKE_STATE"])
+    try:
+        state.log(tool, args)
+        for rule in fixture.get("rules", []):
+            if match(rule["args"], args):
+                stdout, stderr, status = respond(tool, rule, args, state)
+                delay = rule.get("delay", fixture.get("delay", 0))
+                break
+        else:
+            stdout, stderr, status = "", "error:   '" + " ".join(args) + "' is not a " + tool + " command. See '" + tool + " help'.\n", 1
+            delay = fixture.get("delay", 0)
+    finally:
+        state.save()
+
+    time.sleep(delay)
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    return status
@@ -0,0 +1,56 @@
+"""Run and time a single `acs` command for bench_commands.py.
+
+This is run in a new process for each measurement, so that nothing
+cached in memory by an earlier run is reused, with `HOME` pointing at
+an empty directory and the fake `azure` and `dcos` first on the
+`PATH`. If the command needs agents a `SimulatedCluster` stands in for
+the master, everything else being the real command.
+
+Usage:
+  run_command.py <spec>
+
+The spec is a JSON file with the `argv` of the command, the number of
+`agents` to simulate and the `cluster` options for them (see
+`SimulatedCluster`), the `config` file to write and the `result` file
+to write the time taken to.
+
+"""
+from .bench_execution import CONFIG, offlineArtifacts
+from .simcluster import SimulatedCluster, simulatedCommand, writeKeyPair
+
+from acs import cli, commands
+
+from contextlib import ExitStack
+import json
+import os
+import sys
+import time
+
+def main(spec_path):
+    with open(spec_path) as spec_file:
+        spec = json.load(spec_file)
+    work_dir = os.path.dirname(os.path.abspath(spec_path))
+
+    with ExitStack() as stack:
+        if spec.get("agents"):
+            cluster = stack.enter_context(SimulatedCluster(spec["agents"], key_dir = work_dir, **spec.get("cluster", {})))
+            key_filename = cluster.key_filename
+            getCommandClass = commands.getCommandClass
+            commands.getCommandClass = lambda name: simulatedCommand(getCommandClass(name), cluster)
+        else:
+            key_filename = writeKeyPair(os.path.join(work_dir, "id_ecdsa"))
+        stack.enter_context(offlineArtifacts(os.path.expanduser("~/.acs/artifacts"), spec.get("artifact_size", 1048576)))
+
+        with open(spec["config"], "w") as config_file:
+            config_file.write(CONFIG.format(key = key_filename))
+
+        sys.argv = ["acs", "--config-file=" + spec["config"]] + spec["argv"]
+        start = time.time()
+        cli.main()
+        elapsed = time.time() - start
+
+    with open(spec["result"], "w") as result_file:
+        json.dump({"seconds": elapsed}, result_file)
+
+if __name__ == "__main__":
+    main(sys.argv[1])
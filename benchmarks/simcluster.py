@@ -0,0 +1,412 @@
+"""A simulated ACS cluster for benchmarking remote execution.
+
+`SimulatedCluster` runs an SSH server on localhost that stands in for
+the cluster's master. Agents are reached as they are in a real cluster:
+the client opens a `direct-tcpip` channel through the master, and an
+SSH server for the agent is run on the other end of that channel. Any
+number of agents can be simulated without opening extra ports.
+
+Each hop (client to master, master to agent) can be given a latency
+and a bandwidth limit, applied in both directions. Commands are not
+really executed: docker commands print a canned status, install
+scripts (see `acs.RemoteScript`) report every step as succeeding, and
+files uploaded over SFTP are kept in memory so that checksums of
+artifacts already pushed can be answered. Each command and each step
+of a script takes a configurable amount of time.
+
+Commands are pointed at the simulated master by mixing in
+`SimulatedMasterCommand`.
+
+"""
+import collections
+import hashlib
+import os
+import re
+import socket
+import threading
+import time
+
+import paramiko
+
+from acs.SSHPool import SSHPool
+
+def writeKeyPair(path):
+    """
+    Generate an SSH key pair, writing the private key to `path` and
+    the public key to `path`.pub. Returns `path`.
+    """
+    key = paramiko.ECDSAKey.generate()
+    key.write_private_key_file(path)
+    with open(path + ".pub", "w") as public_file:
+        public_file.write(key.get_name() + " " + key.get_base64() + " benchmark\n")
+    return path
+
+class Link:
+    """
+
+    Wraps a socket (or an SSH channel), delaying data in both
+    directions by `latency` seconds and limiting it to `bandwidth`
+    bytes per second, as a network link would. Only the parts of the
+    socket interface paramiko uses are provided.
+
+    """
+    chunk_size = 32768
+
+    def __init__(self, sock, latency = 0, bandwidth = None):
+        self.sock = sock
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.timeout = None
+        self._inbound = collections.deque()
+        self._buffer = b""
+        self._received = threading.Condition()
+        self._outbound = collections.deque()
+        self._sending = threading.Condition()
+        self._free = {"in": 0, "out": 0}
+        self._closed = False
+        for target in (self._receive, self._transmit):
+            thread = threading.Thread(target = target)
+            thread.daemon = True
+            thread.start()
+
+    def _due(self, direction, size):
+        """
+        When data of `size` bytes sent now in `direction` arrives,
+        having waited for the link to be free and for the latency.
+        """
+        start = max(time.time(), self._free[direction])
+        if self.bandwidth:
+            self._free[direction] = start + size / self.bandwidth
+        else:
+            self._free[direction] = start
+        return self._free[direction] + self.latency
+
+    def _receive(self):
+        while True:
+            try:
+                data = self.sock.recv(self.chunk_size)
+            except (OSError, EOFError):
+                data = b""
+            with self._received:
+                self._inbound.append((self._due("in", len(data)), data))
+                self._received.notify_all()
+            if not data:
+                return
+
+    def recv(self, size):
+        expires = None if self.timeout is None else time.time() + self.timeout
+        with self._received:
+            while not self._buffer:
+                now = time.time()
+                if self._inbound and self._inbound[0][0] <= now:
+                    due, data = self._inbound.popleft()
+                    if not data:
+                        return b""
+                    self._buffer = data
+                    break
+                wait = None
+                if self._inbound:
+                    wait = self._inbound[0][0] - now
+                if expires is not None:
+                    if now >= expires:
+                        raise socket.timeout()
+                    wait = expires - now if wait is None else min(wait, expires - now)
+                self._received.wait(wait)
+            data = self._buffer[:size]
+            self._buffer = self._buffer[size:]
+            return data
+
+    def send(self, data):
+        data = bytes(data)
+        with self._sending:
+            self._outbound.append((self._due("out", len(data)), data))
+            self._sending.notify()
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def _transmit(self):
+        while True:
+            with self._sending:
+                while not self._outbound and not self._closed:
+                    self._sending.wait()
+                if not self._outbound:
+                    break
+                due, data = self._outbound.popleft()
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.sock.sendall(data)
+            except (OSError, EOFError):
+                break
+        self.sock.close()
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def close(self):
+        with self._sending:
+            self._closed = True
+            self._sending.notify()
+
+class SimulatedHost(paramiko.ServerInterface):
+    """
+
+    The SSH server side of a simulated master or agent. Any public key
+    is accepted.
+
+    """
+    def __init__(self, cluster, address):
+        self.cluster = cluster
+        self.address = address
+        self.files = {}
+        self.destinations = {}
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OR_SUCCEEDED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        if self.address != "master" or destination[0] not in self.cluster.agents:
+            return paramiko.OPEN_FAILED_CONNECT_FAILED
+        self.destinations[chanid] = destination[0]
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_forward_agent_request(self, channel):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target = self.cluster.execute, args = (self, channel, command.decode("utf-8")))
+        thread.daemon = True
+        thread.start()
+        return True
+
+class SimulatedSFTP(paramiko.SFTPServerInterface):
+    """Keeps the files uploaded to a `SimulatedHost` in memory."""
+
+    def __init__(self, server, host, *args, **kwargs):
+        paramiko.SFTPServerInterface.__init__(self, server, *args, **kwargs)
+        self.host = host
+
+    def open(self, path, flags, attr):
+        return SimulatedFile(self.host, path, flags)
+
+    def stat(self, path):
+        if path not in self.host.files:
+            return paramiko.SFTP_NO_SUCH_FILE
+        attributes = paramiko.SFTPAttributes()
+        attributes.st_size = self.host.files[path][0]
+        attributes.st_mode = 0o100644
+        return attributes
+
+    lstat = stat
+
+class SimulatedFile(paramiko.SFTPHandle):
+    def __init__(self, host, path, flags):
+        paramiko.SFTPHandle.__init__(self, flags)
+        self.host = host
+        self.path = path
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, offset, data):
+        self.digest.update(data)
+        self.size = self.size + len(data)
+        return paramiko.SFTP_OK
+
+    def close(self):
+        self.host.files[self.path] = (self.size, self.digest.hexdigest())
+        paramiko.SFTPHandle.close(self)
+
+class SimulatedCluster:
+    """
+
+    A master and `agents` agents, listening on a local port. Use as a
+    context manager, or call `start()` and `stop()`. `latency` and
+    `bandwidth` apply to each hop, `command_time` to each command and
+    `step_time` to each step of an install script.
+
+    `handshakes` counts the SSH connections made to the master and the
+    agents since it was last reset.
+
+    """
+    def __init__(self, agents = 1, latency = 0, bandwidth = None, command_time = 0, step_time = 0, key_dir = None):
+        self.agents = ["10.0." + str(i // 250) + "." + str(i % 250 + 4) for i in range(agents)]
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.command_time = command_time
+        self.step_time = step_time
+        self.host_key = paramiko.ECDSAKey.generate()
+        self.key_dir = key_dir
+        self.key_filename = None
+        self.port = None
+        self.handshakes = 0
+        self.commands = 0
+        self._lock = threading.Lock()
+        self._listener = None
+        self._transports = []
+        self._agent_hosts = {}
+
+    def start(self):
+        if self.key_dir is not None:
+            self.key_filename = writeKeyPair(os.path.join(self.key_dir, "id_ecdsa"))
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(("127.0.0.1", 0))
+        self._listener.listen(socket.SOMAXCONN)
+        self.port = self._listener.getsockname()[1]
+        thread = threading.Thread(target = self._accept)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        with self._lock:
+            transports = list(self._transports)
+            self._transports = []
+        for transport in transports:
+            transport.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def resetCounters(self):
+        with self._lock:
+            self.handshakes = 0
+            self.commands = 0
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self._listener.accept()
+            except (OSError, AttributeError):
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._serve(Link(sock, self.latency, self.bandwidth), SimulatedHost(self, "master"))
+
+    def _serve(self, sock, host):
+        """
+        Run an SSH server for `host` on `sock`, in the background.
+        """
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, SimulatedSFTP, host)
+        with self._lock:
+            self.handshakes = self.handshakes + 1
+            self._transports.append(transport)
+        # with an event the handshake completes in the background
+        transport.start_server(threading.Event(), server = host)
+        if host.address == "master":
+            thread = threading.Thread(target = self._forward, args = (transport, host))
+            thread.daemon = True
+            thread.start()
+
+    def _forward(self, transport, master):
+        """
+        Serve the agents that channels through the master are opened to.
+        """
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is None:
+                continue
+            address = master.destinations.pop(channel.get_id(), None)
+            if address is not None:
+                with self._lock:
+                    host = self._agent_hosts.get(address)
+                    if host is None:
+                        host = SimulatedHost(self, address)
+                        self._agent_hosts[address] = host
+                self._serve(Link(channel, self.latency, self.bandwidth), host)
+
+    def execute(self, host, channel, command):
+        """
+        Simulate running `command` on `host`, replying on `channel`.
+        """
+        with self._lock:
+            self.commands = self.commands + 1
+        stdin = b""
+        try:
+            while True:
+                data = channel.recv(32768)
+                if not data:
+                    break
+                stdin = stdin + data
+            status, stdout, stderr, duration = self.respond(host, command, stdin.decode("utf-8"))
+            if duration:
+                time.sleep(duration)
+            if stdout:
+                channel.sendall(stdout.encode("utf-8"))
+            if stderr:
+                channel.sendall_stderr(stderr.encode("utf-8"))
+            channel.send_exit_status(status)
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
+        finally:
+            channel.close()
+
+    def respond(self, host, command, stdin):
+        """
+        The simulated result of a command, as a tuple of (exit_status,
+        stdout, stderr, seconds taken).
+        """
+        if command == "bash -s":
+            return self._runScript(stdin)
+        if "sha256sum" in command and "-c" not in command:
+            path = command.split("sha256sum ")[-1].split(" ")[0]
+            if path in host.files:
+                return 0, host.files[path][1] + "  " + path + "\n", "", self.command_time
+            return 1, "", "", self.command_time
+        if command.startswith("docker "):
+            return 0, "Status: Image is up to date\n", "", self.command_time
+        return 0, "", "", self.command_time
+
+    def _runScript(self, script):
+        boundary = re.search(r"(ACS-STEP-[0-9a-f]+)", script)
+        steps = [line for line in script.splitlines() if line.startswith("acs_step ")]
+        if boundary is None:
+            return 1, "", "Not a RemoteScript\n", self.command_time
+        output = ""
+        clock = time.time()
+        for index in range(len(steps)):
+            start = int(clock * 1e9)
+            clock = clock + self.step_time
+            output = output + boundary.group(1) + " " + str(index) + " 0 " + str(start) + " " + str(int(clock * 1e9)) + "\n\n\n"
+        return 0, output, "", self.command_time + self.step_time * len(steps)
+
+class SimulatedMasterCommand(object):
+    """
+    Mixed in to a command to have it connect to the master of the
+    `SimulatedCluster` in its `cluster` attribute, rather than to the
+    master of the cluster in its config file.
+    """
+    cluster = None
+
+    def getManagementEndpoint(self):
+        return "127.0.0.1"
+
+    def getMasterConnection(self):
+        return SSHPool.get("127.0.0.1", self.cluster.port, self.config.get("ACS", "username"), self.cluster.key_filename)
+
+def simulatedCommand(command_class, cluster):
+    """
+    Get a subclass of `command_class` that works on `cluster`.
+    """
+    return type("Simulated" + command_class.__name__, (SimulatedMasterCommand, command_class), {"cluster": cluster})
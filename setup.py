@@ -50,12 +50,11 @@ setup(
         'Programming Language :: Python :: 3'
     ],
     keywords = 'cli',
-    packages = find_packages(exclude=['docs', 'tests*']),
+    packages = find_packages(exclude=['benchmarks*', 'docs', 'tests*']),
     install_requires = [
         'cryptography',
         'docopt',
         'paramiko',
-        'sshtunnel',
         'scp'
     ],
     extras_require = {
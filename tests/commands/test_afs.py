@@ -14,3 +14,11 @@ class TestAfs():
         result = afs.install()
         assert "Exception" not in result
 
+    def test_failed_download_stops_before_creating_storage(self, afs, monkeypatch):
+        def fetch(url, version, checksums):
+            raise IOError("Checksum of " + url + " is 0000, expected 1111")
+        monkeypatch.setattr(afs, "fetchArtifact", fetch)
+        monkeypatch.setattr(afs, "createStorage", lambda: pytest.fail("storage created"))
+        with pytest.raises(SystemExit) as e:
+            afs.install()
+        assert "Unable to fetch the AFS driver: Checksum of" in str(e.value)
@@ -0,0 +1,159 @@
+"""Tests for `acs app` subcommand, run against a local fake Marathon."""
+
+from acs.commands.service import Service
+
+from contextlib import contextmanager
+import json
+import pytest
+
+@pytest.fixture
+def stack(tmp_path):
+    """A directory of app configurations."""
+    for name in ["frontend", "api", "worker"]:
+        with open(str(tmp_path / (name + ".json")), "w") as app_config:
+            json.dump({"id": "/" + name, "cmd": "run " + name, "instances": 1}, app_config)
+    (tmp_path / "README").write_text("not an app")
+    return str(tmp_path)
+
+@pytest.fixture
+def marathon_app(app, marathon_server, monkeypatch, tmp_path):
+    @contextmanager
+    def tunnel(self):
+        yield
+    monkeypatch.setattr(Service, "tunnel", tunnel)
+    monkeypatch.setattr(app.config, "getLocalPort", lambda port: marathon_server.server_address[1])
+    monkeypatch.setattr(app, "app_config_dir", str(tmp_path / "parsed") + "/")
+    monkeypatch.setattr(app, "app_hash_dir", str(tmp_path / "hashes") + "/")
+    app.args = {"--app-config": None, "--group": None, "--parallel": "2", "--force": False,
+                "--wait": False, "--timeout": "5"}
+    return app
+
+class TestApp():
+    def test_deploy_single_app(self, marathon_app, marathon_server):
+        marathon_app.args["--app-config"] = "config/demo/web/simple-web.json"
+        assert marathon_app.deploy() == "Application deployed"
+        assert len(marathon_server.apps) == 1
+
+        assert marathon_app.deploy() == "Application unchanged, not deployed"
+
+        assert marathon_app.remove() == "Application removed."
+        assert marathon_server.apps == {}
+
+    def test_deploy_directory_concurrently(self, marathon_app, marathon_server, stack):
+        marathon_app.args["--app-config"] = stack
+        result = marathon_app.deploy()
+        assert result.splitlines()[0] == "Deployed 3 of 3 applications"
+        assert sorted(marathon_server.apps) == ["/api", "/frontend", "/worker"]
+        # one keep-alive connection per worker
+        assert marathon_server.connections <= 2
+
+        marathon_server.apps.pop("/api")
+        result = marathon_app.remove()
+        assert result.splitlines()[0] == "Removed 2 of 3 applications"
+        assert "/api: Exception: Marathon returned 404" in result
+        assert marathon_server.apps == {}
+
+    def test_unchanged_apps_are_skipped(self, marathon_app, marathon_server, stack):
+        marathon_app.args["--app-config"] = stack
+        marathon_app.deploy()
+        requests = marathon_server.requests
+
+        result = marathon_app.deploy()
+        assert result.count(": unchanged") == 3
+        # only the checks of the running apps
+        assert marathon_server.requests == requests + 3
+        assert marathon_server.updates == []
+
+    def test_only_changed_fields_are_updated(self, marathon_app, marathon_server, stack):
+        marathon_app.args["--app-config"] = stack
+        marathon_app.deploy()
+
+        # the running app has defaults filled in, which are not changes
+        marathon_server.apps["/api"]["ports"] = [0]
+        with open(stack + "/api.json", "w") as app_config:
+            json.dump({"id": "/api", "cmd": "run api --verbose", "instances": 1}, app_config)
+
+        result = marathon_app.deploy()
+        assert "/api: updated (cmd)" in result
+        assert result.count(": unchanged") == 2
+        assert marathon_server.updates == [{"cmd": "run api --verbose"}]
+
+    def test_removed_env_and_labels_are_updated(self, marathon_app, marathon_server, stack):
+        with open(stack + "/api.json", "w") as app_config:
+            json.dump({"id": "/api", "cmd": "run api", "instances": 1,
+                       "env": {"A": "1", "B": "2"}, "labels": {"team": "web"}}, app_config)
+        marathon_app.args["--app-config"] = stack
+        marathon_app.deploy()
+
+        with open(stack + "/api.json", "w") as app_config:
+            json.dump({"id": "/api", "cmd": "run api", "instances": 1, "env": {"A": "1"}}, app_config)
+        result = marathon_app.deploy()
+        assert "/api: updated (env, labels)" in result
+        assert marathon_server.updates == [{"env": {"A": "1"}, "labels": {}}]
+
+        assert marathon_app.deploy().count(": unchanged") == 3
+
+    def test_app_changed_by_someone_else_is_updated(self, marathon_app, marathon_server):
+        marathon_app.args["--app-config"] = "config/demo/web/simple-web.json"
+        marathon_app.deploy()
+        marathon_server.apps["/web"]["instances"] = 7
+        marathon_server.apps["/web"]["version"] = "2016-02-01T00:00:00.000Z"
+
+        assert marathon_app.deploy() == "Application updated (instances)"
+
+    def test_fields_defaulted_by_marathon_are_not_changes(self, marathon_app, marathon_server):
+        marathon_app.args["--app-config"] = "config/demo/web/simple-web.json"
+        marathon_app.deploy()
+        live = marathon_server.apps["/web"]
+        for health_check in live["healthChecks"]:
+            health_check.update({"ignoreHttp1xx": False, "delaySeconds": 15, "ipProtocol": "IPv4"})
+        live["upgradeStrategy"] = {"minimumHealthCapacity": 1, "maximumOverCapacity": 1}
+        live["version"] = "2016-02-01T00:00:00.000Z"
+
+        assert marathon_app.deploy() == "Application unchanged, not deployed"
+
+    def test_force_deploys_unchanged_app(self, marathon_app, marathon_server):
+        marathon_app.args["--app-config"] = "config/demo/web/simple-web.json"
+        marathon_app.deploy()
+        marathon_app.args["--force"] = True
+        assert marathon_app.deploy() == "Application deployed"
+        assert len(marathon_server.updates) == 1
+
+    def test_deploy_as_group(self, marathon_app, marathon_server, stack):
+        marathon_app.args["--app-config"] = stack + ",config/demo/web/simple-web.json"
+        marathon_app.args["--group"] = "/stack"
+        marathon_app.deploy()
+        assert marathon_server.requests == 1
+        assert "/stack/web" in marathon_server.apps
+        assert len(marathon_server.apps) == 4
+
+        assert marathon_app.deploy().startswith("Application group /stack unchanged")
+        assert marathon_server.requests == 2
+
+        marathon_app.args["--app-config"] = None
+        assert marathon_app.remove() == "Application group /stack removed."
+        assert marathon_server.apps == {}
+
+    def test_deploy_and_remove_wait_for_deployments(self, marathon_app, marathon_server, stack):
+        marathon_server.failing.add("/worker")
+        marathon_app.args["--app-config"] = stack
+        marathon_app.args["--wait"] = True
+        result = marathon_app.deploy()
+        assert result.splitlines()[0] == "Deployed 2 of 3 applications"
+        assert "/api: created, ready" in result
+        assert "/worker: Exception: deployment failed" in result
+        assert marathon_server.deployments == {}
+
+        marathon_server.failing.clear()
+        result = marathon_app.remove()
+        assert "/api: removed, ready" in result
+        assert marathon_server.deployments == {}
+
+    def test_deploy_wait_times_out(self, marathon_app, marathon_server):
+        marathon_server.deployment_time = 10
+        marathon_app.args["--app-config"] = "config/demo/web/simple-web.json"
+        marathon_app.args["--wait"] = True
+        marathon_app.args["--timeout"] = "0.2"
+        with pytest.raises(RuntimeWarning) as e:
+            marathon_app.deploy()
+        assert "timed out" in str(e.value)
@@ -0,0 +1,120 @@
+"""Tests for the functionality shared by all commands."""
+
+from acs.ArtifactCache import ArtifactCache
+from acs.SSHPool import CommandCancelled, SSHConnection
+
+import hashlib
+import json
+import os
+import pytest
+import threading
+import time
+
+class TestBase():
+    def test_forEach_stops_at_deadline(self, base, monkeypatch):
+        hung = threading.Event()
+        monkeypatch.setattr(base, "cancel", lambda cancellation = None: hung.set())
+        def run(ip):
+            if ip == "10.0.0.2":
+                hung.wait(10)
+                raise RuntimeError("Command cancelled")
+            return "ok"
+
+        started = time.time()
+        results = base.forEach(run, ["10.0.0.1", "10.0.0.2", "10.0.0.3"], deadline = 0.2)
+        assert time.time() - started < 1
+        assert results["10.0.0.1"] == "ok"
+        assert results["10.0.0.2"] == "Exception: deadline of 0.2 seconds exceeded"
+        assert results["10.0.0.3"] == "ok"
+        assert hung.is_set()
+
+    def test_work_started_after_deadline_is_cancelled(self, base, monkeypatch):
+        connection = SSHConnection("10.0.0.2", 22, "azureuser", "~/.ssh/id_rsa")
+        sessions = []
+        monkeypatch.setattr(connection, "openSession", lambda cancellation = None: sessions.append(cancellation))
+        errors = []
+        finished = threading.Event()
+        def run(ip):
+            if ip == "10.0.0.2":
+                time.sleep(0.4)
+                try:
+                    base._execute(connection, "next step")
+                except Exception as e:
+                    errors.append(e)
+                finished.set()
+            return "ok"
+
+        results = base.forEach(run, ["10.0.0.1", "10.0.0.2"], deadline = 0.2)
+        assert results["10.0.0.2"] == "Exception: deadline of 0.2 seconds exceeded"
+        assert finished.wait(2)
+        assert sessions == []
+        assert isinstance(errors[0], CommandCancelled)
+
+    def test_report_includes_agents_past_deadline(self, base, monkeypatch):
+        monkeypatch.setattr(base, "cancel", lambda cancellation = None: None)
+        monkeypatch.setattr(base, "args", {"--deadline": "0.2", "--output": "compact"})
+        def run(ip):
+            if ip == "10.0.0.2":
+                time.sleep(0.5)
+            return base.scriptResult(ip, ["true"], [], 0)
+
+        result = base.reportOnAgents(run, ["10.0.0.1", "10.0.0.2"])
+        assert "10.0.0.2 (1) [status None]\n" in result
+        assert "Exception: deadline of 0.2 seconds exceeded" in result
+
+    def test_timeouts_from_options_and_config(self, base, monkeypatch):
+        monkeypatch.setattr(base, "args", {"--command-timeout": "30"})
+        monkeypatch.setattr(base.config, "getTimeout", lambda name: 15.0 if name == "connect" else None)
+        assert base.getTimeout("command") == 30.0
+        assert base.getTimeout("connect") == 15.0
+        assert base.getTimeout("deadline") is None
+
+    def test_artifacts_are_checked_against_known_checksum(self, base, monkeypatch, tmp_path):
+        monkeypatch.setattr(ArtifactCache, "cache_dir", str(tmp_path / "artifacts"))
+        source = tmp_path / "driver"
+        source.write_bytes(b"driver v1")
+        digest = hashlib.sha256(b"driver v1").hexdigest()
+
+        with pytest.raises(IOError):
+            base.fetchArtifact(source.as_uri(), "1.0", {"driver": hashlib.sha256(b"tampered").hexdigest()})
+        assert base.fetchArtifact(source.as_uri(), "1.0", {"driver": digest}).sha256 == digest
+
+        monkeypatch.setattr(base.config, "getArtifactChecksum", lambda filename: digest if filename == "driver" else None)
+        assert base.fetchArtifact(source.as_uri(), "2.0", {}).sha256 == digest
+
+    def test_artifacts_without_checksum_are_trusted_on_first_use(self, base, monkeypatch, tmp_path):
+        monkeypatch.setattr(ArtifactCache, "cache_dir", str(tmp_path / "artifacts"))
+        source = tmp_path / "driver"
+        source.write_bytes(b"driver v1")
+        digest = hashlib.sha256(b"driver v1").hexdigest()
+
+        assert base.fetchArtifact(source.as_uri(), "1.0", {}).sha256 == digest
+        source.write_bytes(b"tampered")
+        assert base.fetchArtifact(source.as_uri(), "1.0", {}).sha256 == digest
+
+    def test_shell_commands_are_traced(self, base, tmp_path):
+        from acs.Trace import Trace
+        Trace.start(str(tmp_path / "trace.json"))
+        try:
+            assert base.shell_execute(["echo", "hello"]) == ("\n", "")
+            assert base.shell_execute("echo hello") == ("hello\n", "")
+        finally:
+            Trace.stop()
+        spans = [event for event in json.loads((tmp_path / "trace.json").read_text())["traceEvents"] if event["ph"] == "X"]
+        assert [span["name"] for span in spans] == ["echo", "echo"]
+
+    def test_private_key_is_loaded_into_agent_once(self, base, monkeypatch):
+        import acs.commands.base
+        monkeypatch.setattr(acs.commands.base.Base, "_agent_keys", set())
+        monkeypatch.delenv("SSH_AUTH_SOCK", raising = False)
+        with pytest.raises(RuntimeError) as e:
+            base.loadPrivateKeyIntoAgent()
+        assert "ssh-agent" in str(e.value)
+
+        calls = []
+        monkeypatch.setenv("SSH_AUTH_SOCK", "/tmp/agent.sock")
+        monkeypatch.setattr(base, "_agentHasKey", lambda key_path: False)
+        monkeypatch.setattr(acs.commands.base, "call", lambda args: calls.append(args) or 0)
+        base.loadPrivateKeyIntoAgent()
+        base.loadPrivateKeyIntoAgent()
+        assert calls == [["ssh-add", os.path.expanduser(base.config.get("SSH", "privatekey"))]]
@@ -1,8 +1,11 @@
 """Tests for the cluster.ini and config class."""
 
+from acs.commands.base import Config
+
 import os
 import pytest
 import re
+import shutil
 
 class TestConfig():
 
@@ -42,3 +45,63 @@ class TestConfig():
         assert key == public_key
 
 
+    def test_values_are_cached(self, config):
+        assert config.getACSParams() == config.getACSParams()
+        assert config.getACSParams() is not config.getACSParams()
+        assert ("get", "ACS", "dnsPrefix") in config._cache
+        assert config.getManagementEndpoint() == "rgDcosTestmgmt.westus.cloudapp.azure.com"
+
+    def test_reloads_when_file_changes(self, tmp_path):
+        filename = str(tmp_path / "cluster.ini")
+        shutil.copy("tests/test_dcos_cluster.ini", filename)
+        config = Config(filename)
+        assert config.getint("ACS", "agentCount") == 2
+
+        with open(filename) as ini:
+            text = ini.read().replace("agentCount: 2", "agentCount: 5")
+        with open(filename, "w") as ini:
+            ini.write(text)
+        os.utime(filename, ns=(0, os.stat(filename).st_mtime_ns + 1000000))
+
+        assert config.getint("ACS", "agentCount") == 5
+        assert config.getACSParams()["agentCount"]["value"] == 5
+
+    def test_tunnel_ports(self, config, tmp_path):
+        assert config.getTunnelPorts() == [(80, 80)]
+        assert config.getLocalPort(80) == 80
+
+        filename = str(tmp_path / "cluster.ini")
+        shutil.copy("tests/test_dcos_cluster.ini", filename)
+        with open(filename, "a") as ini:
+            ini.write("\n[Tunnel]\nports: 8080:80, 2375\n")
+        tunneled = Config(filename)
+        assert tunneled.getTunnelPorts() == [(8080, 80), (2375, 2375)]
+        assert tunneled.getLocalPort(80) == 8080
+
+    def test_timeouts(self, config, tmp_path):
+        assert config.getTimeout("command") is None
+
+        filename = str(tmp_path / "cluster.ini")
+        shutil.copy("tests/test_dcos_cluster.ini", filename)
+        with open(filename, "a") as ini:
+            ini.write("\n[Timeouts]\nconnect: 15\ndeadline: 1800\n")
+        limited = Config(filename)
+        assert limited.getTimeout("connect") == 15.0
+        assert limited.getTimeout("command") is None
+        assert limited.getTimeout("deadline") == 1800.0
+
+    def test_set_updates_file_atomically(self, tmp_path):
+        filename = str(tmp_path / "cluster.ini")
+        shutil.copy("tests/test_dcos_cluster.ini", filename)
+        config = Config(filename)
+        config.set("ACS", "agentCount", 7)
+        config.set("Tunnel", "ports", "8080:80")
+
+        assert config.getint("ACS", "agentCount") == 7
+        with open(filename) as ini:
+            text = ini.read()
+        assert "agentCount: 7" in text
+        assert "; The kind of orchestrator you want" in text
+        assert Config(filename).getTunnelPorts() == [(8080, 80)]
+        assert os.path.isfile(filename + ".bak")
+        assert sorted(os.listdir(str(tmp_path))) == ["cluster.ini", "cluster.ini.bak"]
@@ -1,5 +1,6 @@
 """Tests for `acs oms` subcommand."""
 
+import json
 import pytest
 
 class TestOms():
@@ -13,3 +14,25 @@ class TestOms():
     def test_install(self, oms):
         result = oms.install()
         assert "Exception" not in result
+
+    def test_install_reports_each_agent(self, oms, monkeypatch, capsys):
+        ips = ["10.0.0.1", "10.0.0.2"]
+        def execute(cmd, ip, stdin = None):
+            if ip == "10.0.0.2":
+                return 1, "", "Failed to connect"
+            return 0, "", ""
+        monkeypatch.setattr(oms, "getAgentIPs", lambda: ips)
+        monkeypatch.setattr(oms, "pushArtifact", lambda artifact, ip: ".acs/artifacts/omsagent.sh")
+        monkeypatch.setattr(oms, "_executeOnAgent", execute)
+        monkeypatch.setattr(oms.config, "get", lambda section, name: "secret")
+        monkeypatch.setattr(oms, "fetchArtifact", lambda url, version, checksums: None)
+        monkeypatch.setattr(oms, "verifyArtifactStep", lambda artifact, path: "true")
+
+        result = oms.install()
+        assert "Exception: only 0 of 5 steps completed on 10.0.0.2" in result
+        assert "10.0.0.1:\n" in result
+
+        monkeypatch.setattr(oms, "args", {"--output": "ndjson"})
+        assert oms.install() == ""
+        records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        assert sorted(record["host"] for record in records) == ips
@@ -1,7 +1,9 @@
 """Tests for `acs service` command."""
 
 from acs.AgentPool import AgentPool
+from acs.AzureCLI import AzureCLI
 
+from contextlib import contextmanager
 import pytest
 import time
 import urllib.request
@@ -79,3 +81,143 @@ class TestService():
 
         result = service.scale()
         assert "Scaled to " + str(initial_agents + 1) == result
+
+    def test_scale_requires_agents(self, service, monkeypatch, capsys):
+        monkeypatch.setattr(service, "exists", lambda: pytest.fail("cluster checked"))
+        for agents in [None, "many", "-1"]:
+            service.args = {"--agents": agents, "--pool": None}
+            assert service.scale().startswith("--agents must be given")
+        assert "Usage:" in capsys.readouterr().out
+
+    def test_tunnel_is_shared_by_nested_users(self, service, monkeypatch):
+        calls = []
+        pids = [None]
+        def connect():
+            calls.append("connect")
+            pids[0] = 1234
+        def disconnect():
+            calls.append("disconnect")
+            pids[0] = None
+        monkeypatch.setattr(service, "connect", connect)
+        monkeypatch.setattr(service, "disconnect", disconnect)
+        monkeypatch.setattr(service, "_tunnelPid", lambda: pids[0])
+
+        with service.tunnel():
+            with service.tunnel():
+                assert calls == ["connect"]
+            assert calls == ["connect"]
+        assert calls == ["connect", "disconnect"]
+
+    def test_tunnel_leaves_existing_tunnel_open(self, service, monkeypatch):
+        calls = []
+        monkeypatch.setattr(service, "connect", lambda: calls.append("connect"))
+        monkeypatch.setattr(service, "disconnect", lambda: calls.append("disconnect"))
+        monkeypatch.setattr(service, "_tunnelPid", lambda: 1234)
+
+        with service.tunnel():
+            pass
+        assert calls == []
+
+    def test_create_prepares_tools_while_deploying(self, service, monkeypatch):
+        class Process():
+            returncode = None
+            def poll(self):
+                return None
+            def communicate(self):
+                return b"", b""
+
+        started = time.time()
+        states = ["Accepted", "Running", "Running", "Succeeded"]
+        calls = []
+        monkeypatch.setattr(AzureCLI, "system", lambda command: calls.append(command))
+        monkeypatch.setattr(AzureCLI, "start", lambda args: calls.append(args) or Process())
+        monkeypatch.setattr(AzureCLI, "json", lambda args, persist = True, cached = True: {"properties": {"provisioningState": states.pop(0)}})
+        monkeypatch.setattr(service, "poll_interval", 0.1)
+        resolves = [False, True]
+        monkeypatch.setattr(service, "exists", lambda: resolves.pop(0))
+        monkeypatch.setattr(service, "show", lambda: "cluster")
+        prepared = []
+        def prepare():
+            time.sleep(0.3)
+            prepared.append(time.time() - started)
+        monkeypatch.setattr(service, "prepare_dcos_cli", prepare)
+        monkeypatch.setattr(service, "install_dcos_cli", lambda: calls.append("install"))
+
+        assert service.create() == "cluster"
+        assert "--nowait" in calls[1]
+        assert calls[-1] == "install"
+        # polling took 0.1 + 0.2 + 0.4 seconds, the preparation overlapped it
+        assert prepared[0] < 0.5
+        assert time.time() - started < 1.5
+
+    def test_push_distributes_in_a_tree(self, service, monkeypatch, tmp_path):
+        image = tmp_path / "image.tar"
+        image.write_bytes(b"image")
+        ips = ["10.0.0." + str(i) for i in range(10)]
+        uploads = []
+        copies = []
+
+        class Master():
+            def put(self, local_path, remote_path, cancellation = None):
+                uploads.append(remote_path)
+        def copy(artifact, remote_path, source_ip, target_ip):
+            copies.append((source_ip, target_ip))
+            if target_ip == "10.0.0.1":
+                raise RuntimeError("disk full")
+        monkeypatch.setattr(service, "getAgentIPs", lambda: ips)
+        monkeypatch.setattr(service, "getMasterConnection", lambda: Master())
+        monkeypatch.setattr(service, "_executeOnMaster", lambda cmd: (1, "", ""))
+        monkeypatch.setattr(service, "_copyBetweenHosts", copy)
+        monkeypatch.setattr(service, "loadPrivateKeyIntoAgent", lambda: None)
+
+        result = service.push(str(image))
+        assert uploads == [".acs/artifacts/image.tar"]
+        assert sorted(target for source, target in copies) == ips
+        assert "10.0.0.1: Exception: disk full" in result
+        assert "10.0.0.9: .acs/artifacts/image.tar" in result
+
+        sources = [source for source, target in copies]
+        assert max(sources.count(ip) for ip in ips) <= 2
+        # the master serves two agents, and the two below the failed agent
+        assert sources.count(None) == 4
+        assert "10.0.0.1" not in sources
+        assert (None, "10.0.0.4") in copies
+
+    def test_marathon_command_sends_json_through_tunnel(self, service, marathon_server, monkeypatch):
+        tunnels = []
+        @contextmanager
+        def tunnel():
+            tunnels.append("open")
+            yield
+        monkeypatch.setattr(service, "tunnel", tunnel)
+        monkeypatch.setattr(service.config, "getLocalPort", lambda port: marathon_server.server_address[1])
+
+        app = '{"id": "/web", "cmd": "echo \\"it\'s up\\"", "instances": 1}'
+        service.marathonCommand("apps", "POST", app)
+        response = service.marathonCommand("apps")
+        assert tunnels == ["open", "open"]
+        assert [a["cmd"] for a in response["apps"]] == ['echo "it\'s up"']
+
+    def test_exec_on_master_exits_with_command_status(self, service, monkeypatch):
+        timeouts = []
+        class Stream():
+            def __enter__(self):
+                return self
+            def __exit__(self, *args):
+                return False
+            def copyTo(self, out, err):
+                return 1
+        class Master():
+            def isActive(self):
+                return True
+            def stream(self, cmd, forward_agent = False, timeout = None):
+                timeouts.append(timeout)
+                return Stream()
+        monkeypatch.setattr(service, "getMasterConnection", lambda: Master())
+        monkeypatch.setattr(service.config, "getTimeout", lambda name: 30.0 if name == "command" else None)
+
+        service.options = ["execOnMaster", "false"]
+        with pytest.raises(SystemExit) as e:
+            service.run()
+        assert e.value.code == 1
+        assert timeouts == [30.0]
@@ -1,4 +1,10 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
 import pytest
+import queue
+import socketserver
+import threading
+import time
 
 from acs.AgentPool import AgentPool
 from acs import commands
@@ -18,6 +24,11 @@ def afs():
     config = Config("tests/test_dcos_cluster.ini")
     return commands.Afs(config, None)
 
+@pytest.fixture(scope="module")
+def app():
+    config = Config("tests/test_dcos_cluster.ini")
+    return commands.App(config, None)
+
 @pytest.fixture(scope="module")
 def demo():
     config = Config("tests/test_dcos_cluster.ini")
@@ -46,3 +57,193 @@ def agentPool():
 @pytest.fixture(scope="module")
 def config():
     return Config("tests/test_dcos_cluster.ini")
+
+class FakeMarathonHandler(BaseHTTPRequestHandler):
+    """Enough of the Marathon API, kept in memory, to test clients of it."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections = self.server.connections + 1
+
+    def reply(self, status, body = None):
+        content = b"" if body is None else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        if self.server.drop_connections:
+            # Close without saying so, as a server timing out an idle
+            # keep-alive connection does
+            self.close_connection = True
+
+    def body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length).decode("utf-8"))
+
+    def version(self):
+        self.server.versions = self.server.versions + 1
+        return "2016-01-01T00:00:%02d.000Z" % self.server.versions
+
+    def appId(self):
+        return "/" + self.path.split("?")[0][len("/marathon/v2/apps/"):]
+
+    def do_GET(self):
+        if self.path.startswith("/marathon/v2/events"):
+            self.streamEvents()
+            return
+        self.server.requests = self.server.requests + 1
+        apps = self.server.apps
+        if self.path == "/marathon/v2/deployments":
+            time.sleep(self.server.deployments_delay)
+            with self.server.lock:
+                self.reply(200, [{"id": deployment_id, "affectedApps": [target]} for deployment_id, target in self.server.deployments.items()])
+        elif self.path.startswith("/marathon/v2/groups/"):
+            group_id = "/" + self.path[len("/marathon/v2/groups/"):].strip("/")
+            if group_id in self.server.groups:
+                self.reply(200, {"id": group_id, "version": self.server.groups[group_id]})
+            else:
+                self.reply(404, {"message": "Group '" + group_id + "' does not exist"})
+        elif self.path == "/marathon/v2/apps":
+            self.reply(200, {"apps": list(apps.values())})
+        elif self.appId() in apps:
+            self.reply(200, {"app": apps[self.appId()]})
+        else:
+            self.reply(404, {"message": "App '" + self.appId() + "' does not exist"})
+
+    def do_POST(self):
+        self.server.requests = self.server.requests + 1
+        app = self.body()
+        app_id = "/" + app["id"].strip("/")
+        if app_id in self.server.apps:
+            self.reply(409, {"message": "An app with id [" + app_id + "] already exists."})
+            return
+        app["id"] = app_id
+        app["version"] = self.version()
+        self.server.apps[app_id] = app
+        self.reply(201, dict(app, deployments = [{"id": self.server.startDeployment(app_id)}]))
+
+    def do_PUT(self):
+        self.server.requests = self.server.requests + 1
+        if self.path.startswith("/marathon/v2/apps/"):
+            update = self.body()
+            self.server.updates.append(update)
+            app = self.server.apps.setdefault(self.appId(), {"id": self.appId()})
+            app.update(update)
+            app["id"] = self.appId()
+            app["version"] = self.version()
+            self.reply(200, {"deploymentId": self.server.startDeployment(self.appId()), "version": app["version"]})
+            return
+        group = self.body()
+        group_id = "/" + self.path.split("?")[0][len("/marathon/v2/groups/"):].strip("/")
+        version = self.version()
+        self.server.groups[group_id] = version
+        for app in group.get("apps", []):
+            app_id = group_id + "/" + app["id"].strip("/")
+            self.server.apps[app_id] = dict(app, id = app_id, version = version)
+        self.reply(200, {"deploymentId": self.server.startDeployment(group_id), "version": version})
+
+    def do_DELETE(self):
+        self.server.requests = self.server.requests + 1
+        if self.path.startswith("/marathon/v2/groups/"):
+            group_id = "/" + self.path[len("/marathon/v2/groups/"):].strip("/")
+            self.server.groups.pop(group_id, None)
+            prefix = group_id + "/"
+            for app_id in [app_id for app_id in self.server.apps if app_id.startswith(prefix)]:
+                del self.server.apps[app_id]
+            self.reply(200, {"deploymentId": self.server.startDeployment(group_id), "version": "1"})
+            return
+        if self.server.apps.pop(self.appId(), None) is None:
+            self.reply(404, {"message": "App '" + self.appId() + "' does not exist"})
+        else:
+            self.reply(200, {"deploymentId": self.server.startDeployment(self.appId()), "version": "1"})
+
+    def streamEvents(self):
+        if not self.server.events_enabled:
+            self.reply(404, {"message": "Not found"})
+            return
+        subscriber = queue.Queue()
+        with self.server.lock:
+            self.server.subscribers.append(subscriber)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(b": connected\n\n")
+        # some versions of Marathon send events whose data isn't JSON
+        self.wfile.write(b"event: heartbeat\ndata: ping\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+        while not self.server.closing:
+            try:
+                event_type, data = subscriber.get(timeout = 0.01)
+            except queue.Empty:
+                continue
+            self.wfile.write(("event: " + event_type + "\ndata: " + json.dumps(data) + "\n\n").encode("utf-8"))
+            self.wfile.flush()
+
+class FakeMarathon(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def startDeployment(self, target):
+        """
+        Start a deployment that finishes after `deployment_time`,
+        failing if `target` is in `failing`.
+        """
+        with self.lock:
+            self.deployment_count = self.deployment_count + 1
+            deployment_id = "deployment-" + str(self.deployment_count)
+            self.deployments[deployment_id] = target
+        timer = threading.Timer(self.deployment_time, self.finishDeployment, args = (deployment_id,))
+        timer.daemon = True
+        timer.start()
+        return deployment_id
+
+    def finishDeployment(self, deployment_id):
+        """
+        Finish a deployment, recording its outcome in the app's task
+        counts and last task failure as Marathon would.
+        """
+        with self.lock:
+            target = self.deployments.pop(deployment_id)
+            subscribers = list(self.subscribers)
+            app = self.apps.get(target)
+            if app is not None and target in self.failing:
+                app["tasksRunning"] = 0
+                app["lastTaskFailure"] = {"version": app["version"], "message": "Command exited with status 1"}
+            elif app is not None:
+                app["tasksRunning"] = app.get("instances", 1)
+        event_type = "deployment_failed" if target in self.failing else "deployment_success"
+        for subscriber in subscribers:
+            subscriber.put((event_type, {"eventType": event_type, "id": deployment_id}))
+
+@pytest.fixture
+def marathon_server():
+    server = FakeMarathon(("127.0.0.1", 0), FakeMarathonHandler)
+    server.apps = {}
+    server.connections = 0
+    server.drop_connections = False
+    server.requests = 0
+    server.versions = 0
+    server.groups = {}
+    server.updates = []
+    server.lock = threading.Lock()
+    server.deployments = {}
+    server.deployment_count = 0
+    server.deployment_time = 0.05
+    server.deployments_delay = 0
+    server.failing = set()
+    server.subscribers = []
+    server.events_enabled = True
+    server.closing = False
+    thread = threading.Thread(target = server.serve_forever, args = (0.01,))
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.closing = True
+    server.shutdown()
+    server.server_close()
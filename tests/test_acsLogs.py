@@ -0,0 +1,50 @@
+"""Tests for ACS logging."""
+
+from acs.ACSLogs import ACSLog
+
+import logging
+
+import pytest
+
+class TestACSLog():
+    def test_disabled_messages_are_not_formatted(self):
+        log = ACSLog("TestACSLog")
+        ACSLog.setLevel("INFO")
+        calls = []
+        log.debug(lambda: calls.append("called"))
+        assert calls == []
+
+    def test_enabled_messages_are_formatted_lazily(self):
+        log = ACSLog("TestACSLog")
+        ACSLog.setLevel("DEBUG")
+        calls = []
+        log.debug(lambda: calls.append("called") or "message")
+        assert calls == ["called"]
+        ACSLog.setLevel("INFO")
+
+    def test_setLevel_rejects_unknown_levels(self):
+        with pytest.raises(ValueError):
+            ACSLog.setLevel("CHATTY")
+
+    def test_afterFork_starts_a_new_listener(self):
+        log = ACSLog("TestACSLog")
+        records = []
+        class Capture(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+
+        # as in a child process, where the listener's thread is gone
+        old = ACSLog._listener
+        ACSLog._listener_pid = None
+        ACSLog.afterFork()
+        old.stop()
+        listener = ACSLog._listener
+        assert listener is not old
+        ACSLog.afterFork()
+        assert ACSLog._listener is listener
+
+        listener.handlers = listener.handlers + (Capture(),)
+        log.warning("written after fork")
+        ACSLog.flush()
+        assert records == ["written after fork"]
+        listener.handlers = listener.handlers[:-1]
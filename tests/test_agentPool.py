@@ -1,6 +1,14 @@
 from acs import __version__ as VERSION
+from acs.AgentPool import AgentPool
+from acs.AzureCLI import AzureCLI
+from acs.commands.base import Config
 
+import json
+import os
 import pytest
+import shutil
+import stat
+import sys
 
 class TestAgentPool():
     def test_getPools(self, agentPool):
@@ -18,3 +26,62 @@ class TestAgentPool():
             expected_agents = expected_agents + 1
         assert num_agents == expected_agents
 
+@pytest.fixture
+def azure(tmp_path, monkeypatch):
+    """
+    Put a fake `azure` on the PATH that knows about two scale sets,
+    the first `vmss show` after a scale reporting it still updating.
+    """
+    state = tmp_path / "state.json"
+    state.write_text(json.dumps({"capacity": 2, "shows": 0, "calls": []}))
+    script = tmp_path / "azure"
+    script.write_text("""#!%s
+import json, sys
+args = sys.argv[1:]
+with open(%r) as f:
+    state = json.load(f)
+state["calls"].append(args)
+if args[:2] == ["account", "show"]:
+    print("[]")
+elif args[:2] == ["vmss", "list"]:
+    print(json.dumps([{"name": "dcos-agent-public-1234-vmss0"}, {"name": "dcos-agent-private-1234-vmss0"}]))
+elif args[:2] == ["vmss", "scale"]:
+    state["capacity"] = int(args[args.index("--new-capacity") + 1])
+    state["shows"] = 0
+elif args[:2] == ["vmss", "show"]:
+    state["shows"] = state["shows"] + 1
+    provisioning = "Updating" if state["shows"] == 1 else "Succeeded"
+    print(json.dumps({"name": args[3], "provisioningState": provisioning, "sku": {"capacity": state["capacity"]}}))
+with open(%r, "w") as f:
+    json.dump(state, f)
+""" % (sys.executable, str(state), str(state)))
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", str(tmp_path) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setattr(AzureCLI, "cache_dir", str(tmp_path / "cache"))
+    monkeypatch.setattr(AzureCLI, "_logged_in", True)
+    monkeypatch.setattr(AgentPool, "poll_interval", 0.01)
+    AzureCLI.invalidate()
+    return lambda: json.loads(state.read_text())
+
+@pytest.fixture
+def scalable(tmp_path):
+    filename = str(tmp_path / "cluster.ini")
+    shutil.copy("tests/test_dcos_cluster.ini", filename)
+    return AgentPool(Config(filename))
+
+class TestScale():
+    def test_scale_primary_pool(self, azure, scalable):
+        assert scalable.scale(None, 5) == "dcos-agent-private-1234-vmss0"
+        state = azure()
+        assert state["capacity"] == 5
+        assert state["shows"] == 2
+        assert ["vmss", "scale", "--resource-group", "rgDcosTestGroup", "--name", "dcos-agent-private-1234-vmss0",
+                "--new-capacity", "5"] in state["calls"]
+        assert not any(call[:3] == ["group", "deployment", "create"] for call in state["calls"])
+        assert scalable.config.getint("ACS", "agentCount") == 5
+        assert Config(scalable.config.filename).getint("ACS", "agentCount") == 5
+
+    def test_scale_down_other_pool_leaves_config(self, azure, scalable):
+        scalable.scale("dcos-agent-public-1234-vmss0", 1)
+        assert azure()["capacity"] == 1
+        assert scalable.config.getint("ACS", "agentCount") == 2
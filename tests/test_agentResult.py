@@ -0,0 +1,61 @@
+"""Tests for reporting the per-agent results of fan-out commands."""
+
+from acs.AgentResult import AgentResult, ResultWriter
+
+import io
+import json
+
+import pytest
+
+def results():
+    return [
+        AgentResult("10.0.0.10", 0, "Status: Image is up to date\n", "", 1.5),
+        AgentResult("10.0.0.2", 0, "Status: Image is up to date\n", "", 1.2),
+        AgentResult("10.0.0.3", 1, "", "Error: no space left on device\n", 0.4)
+    ]
+
+class TestResultWriter():
+    def test_text_lists_each_agent_in_order(self):
+        writer = ResultWriter("text", "pull nginx")
+        for result in results():
+            writer.add(result)
+        assert writer.close() == (
+            "10.0.0.2: pull nginx\nStatus: Image is up to date\n" +
+            "10.0.0.3: pull nginx\nError: no space left on device\n" +
+            "10.0.0.10: pull nginx\nStatus: Image is up to date\n")
+
+    def test_compact_groups_identical_results(self):
+        writer = ResultWriter("compact")
+        for result in results():
+            writer.add(result)
+        output = writer.close()
+        assert "10.0.0.2,10.0.0.10 (2)\n" in output
+        assert "10.0.0.3 (1) [status 1]\n" in output
+        assert output.count("Status: Image is up to date") == 1
+
+    def test_ndjson_is_written_as_results_are_added(self):
+        out = io.StringIO()
+        writer = ResultWriter("ndjson", out = out)
+        writer.add(results()[2])
+        record = json.loads(out.getvalue())
+        assert record == {"host": "10.0.0.3", "status": 1, "stdout": "",
+                          "stderr": "Error: no space left on device\n", "duration": 0.4}
+        writer.add(results()[0])
+        assert writer.close() == ""
+        assert len(out.getvalue().splitlines()) == 2
+
+    def test_json_is_an_array(self):
+        out = io.StringIO()
+        writer = ResultWriter("json", out = out)
+        for result in results():
+            writer.add(result)
+        writer.close()
+        assert [record["host"] for record in json.loads(out.getvalue())] == ["10.0.0.10", "10.0.0.2", "10.0.0.3"]
+
+        out = io.StringIO()
+        ResultWriter("json", out = out).close()
+        assert json.loads(out.getvalue()) == []
+
+    def test_unknown_format(self):
+        with pytest.raises(ValueError):
+            ResultWriter("yaml")
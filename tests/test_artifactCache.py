@@ -0,0 +1,61 @@
+"""Tests for the local artifact cache."""
+
+from acs.ArtifactCache import ArtifactCache
+
+import hashlib
+import pytest
+import time
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(ArtifactCache, "cache_dir", str(tmp_path / "artifacts"))
+    source = tmp_path / "driver"
+    source.write_bytes(b"driver v1")
+    return source
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+class TestArtifactCache():
+    def test_downloads_once(self, cache):
+        url = cache.as_uri()
+        first = ArtifactCache.fetch(url, "1.0")
+        assert first.sha256 == sha256(b"driver v1")
+        assert first.filename == "driver"
+
+        cache.write_bytes(b"driver v2")
+        second = ArtifactCache.fetch(url, "1.0")
+        assert second.path == first.path
+        with open(second.path, "rb") as artifact:
+            assert artifact.read() == b"driver v1"
+
+        third = ArtifactCache.fetch(url, "2.0")
+        assert third.sha256 == sha256(b"driver v2")
+
+    def test_checksum_is_verified(self, cache):
+        with pytest.raises(IOError):
+            ArtifactCache.fetch(cache.as_uri(), "1.0", sha256(b"something else"))
+        artifact = ArtifactCache.fetch(cache.as_uri(), "1.0", sha256(b"driver v1"))
+        assert ArtifactCache.checksum(artifact.path) == sha256(b"driver v1")
+
+    def test_expired_copy_is_downloaded_again(self, cache, monkeypatch):
+        url = cache.as_uri()
+        ArtifactCache.fetch(url, ttl = 60)
+        cache.write_bytes(b"driver v2")
+        assert ArtifactCache.fetch(url, ttl = 60).sha256 == sha256(b"driver v1")
+
+        now = time.time()
+        monkeypatch.setattr(time, "time", lambda: now + 120)
+        assert ArtifactCache.fetch(url, ttl = 60).sha256 == sha256(b"driver v2")
+
+        # the expired copy is used if it can't be downloaded
+        cache.unlink()
+        monkeypatch.setattr(time, "time", lambda: now + 240)
+        assert ArtifactCache.fetch(url, ttl = 60).sha256 == sha256(b"driver v2")
+
+    def test_corrupt_cache_is_replaced(self, cache):
+        artifact = ArtifactCache.fetch(cache.as_uri(), "1.0")
+        with open(artifact.path, "wb") as corrupt:
+            corrupt.write(b"garbage")
+        again = ArtifactCache.fetch(cache.as_uri(), "1.0")
+        assert ArtifactCache.checksum(again.path) == sha256(b"driver v1")
@@ -0,0 +1,160 @@
+"""Tests for the memoizing `azure` CLI wrapper."""
+
+from acs.AzureCLI import AzureCLI
+
+import json
+import os
+import stat
+import threading
+import time
+
+import pytest
+
+@pytest.fixture
+def azure(tmp_path, monkeypatch):
+    """Put a fake `azure` on the PATH that counts its invocations."""
+    calls = tmp_path / "calls"
+    script = tmp_path / "azure"
+    script.write_text("#!/bin/sh\nsleep 0.2\necho \"$@\" >> " + str(calls) + "\necho '{\"args\": \"'\"$*\"'\"}'\n")
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", str(tmp_path) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setattr(AzureCLI, "cache_dir", str(tmp_path / "cache"))
+    monkeypatch.setattr(AzureCLI, "session_dir", str(tmp_path / "session"))
+    monkeypatch.setattr(AzureCLI, "profile_path", str(tmp_path / "azureProfile.json"))
+    monkeypatch.setattr(AzureCLI, "_logged_in", True)
+    AzureCLI.invalidate()
+
+    def count():
+        if not calls.exists():
+            return 0
+        return len(calls.read_text().splitlines())
+    return count
+
+class TestAzureCLI():
+    def test_read_only_commands_are_memoized(self, azure):
+        first = AzureCLI.json(["network", "nic", "list", "rg"])
+        second = AzureCLI.json(["network", "nic", "list", "rg"])
+        assert first == second
+        assert azure() == 1
+
+    def test_concurrent_calls_are_collapsed(self, azure):
+        threads = [threading.Thread(target=AzureCLI.json, args=(["vmss", "list", "rg"],)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert azure() == 1
+
+    def test_mutating_commands_invalidate(self, azure):
+        AzureCLI.json(["network", "lb", "list", "rg"])
+        AzureCLI.execute(["network", "lb", "probe", "create", "-n", "list"])
+        AzureCLI.json(["network", "lb", "list", "rg"])
+        assert azure() == 3
+
+    def test_results_read_during_a_mutation_are_not_kept(self, azure, monkeypatch, tmp_path):
+        monkeypatch.setenv("ACS_CACHE_TTL", "60")
+        script = tmp_path / "azure"
+        script.write_text(script.read_text().replace("sleep 0.2\n", "[ \"$2\" = create ] && sleep 0.6 || sleep 0.1\n"))
+        mutation = threading.Thread(target = AzureCLI.execute, args = (["group", "create", "rg", "westus"],))
+        mutation.start()
+        time.sleep(0.2)
+        AzureCLI.json(["group", "list"])
+        mutation.join()
+
+        AzureCLI.json(["group", "list"])
+        assert azure() == 3
+
+    def test_isReadOnly_uses_first_verb(self):
+        assert AzureCLI.isReadOnly(["storage", "account", "keys", "list", "rg", "name"])
+        assert not AzureCLI.isReadOnly(["group", "create", "list", "westus"])
+
+    def test_calls_are_traced_without_secrets(self, azure, tmp_path):
+        from acs.Trace import Trace
+        Trace.start(str(tmp_path / "trace.json"))
+        try:
+            AzureCLI.execute(["storage", "share", "create", "--account-key", "c2VjcmV0", "files"])
+        finally:
+            Trace.stop()
+        spans = [event for event in json.loads((tmp_path / "trace.json").read_text())["traceEvents"] if event["ph"] == "X"]
+        assert [span["name"] for span in spans] == ["azure storage share create"]
+        assert spans[0]["args"]["args"] == "storage share create --account-key *** files"
+
+    def test_secrets_are_not_logged(self, azure, monkeypatch):
+        messages = []
+        class Log():
+            def debug(self, message, *args):
+                messages.append(message % args)
+        monkeypatch.setattr(AzureCLI, "log", Log())
+        AzureCLI.check_output(["storage", "share", "create", "--account-key", "c2VjcmV0", "files"])
+        AzureCLI.execute(["ad", "sp", "create", "--password", "hunter2"])
+        assert messages
+        assert not [message for message in messages if "c2VjcmV0" in message or "hunter2" in message]
+        assert "Executing: azure storage share create --account-key *** files" in messages
+
+    def test_disk_cache_honours_ttl(self, azure, monkeypatch):
+        monkeypatch.setenv("ACS_CACHE_TTL", "60")
+        AzureCLI.json(["vmss", "list", "rg"])
+        with AzureCLI._lock:
+            AzureCLI._memo.clear()
+        AzureCLI.json(["vmss", "list", "rg"])
+        assert azure() == 1
+
+        monkeypatch.setenv("ACS_CACHE_TTL", "0")
+        with AzureCLI._lock:
+            AzureCLI._memo.clear()
+        AzureCLI.json(["vmss", "list", "rg"])
+        assert azure() == 2
+
+    def test_disk_cache_is_per_subscription(self, azure, monkeypatch, tmp_path):
+        monkeypatch.setenv("ACS_CACHE_TTL", "60")
+        profile = tmp_path / "azureProfile.json"
+        profile.write_text('{"subscriptions": [{"id": "sub-1", "isDefault": true}]}')
+        AzureCLI.json(["group", "list"])
+        profile.write_text('{"subscriptions": [{"id": "sub-1"}, {"id": "sub-2", "isDefault": true}]}')
+        with AzureCLI._lock:
+            AzureCLI._memo.clear()
+        AzureCLI.json(["group", "list"])
+        assert azure() == 2
+
+class TestAzureLogin():
+    @pytest.fixture
+    def account(self, azure, tmp_path, monkeypatch):
+        """A fake `azure account show` for a logged in subscription."""
+        script = tmp_path / "azure"
+        script.write_text(script.read_text().replace("echo '{", "[ \"$1\" = account ] && echo '[{\"id\": \"sub-1\"}]' && exit 0\necho '{"))
+        (tmp_path / "azureProfile.json").write_text('{"subscriptions": [{"id": "sub-1", "isDefault": true}]}')
+        monkeypatch.setattr(AzureCLI, "_logged_in", False)
+        return azure
+
+    def test_login_is_checked_once_per_process(self, account):
+        AzureCLI.json(["vmss", "list", "rg"])
+        AzureCLI.json(["network", "nic", "list", "rg"])
+        assert account() == 3
+
+    def test_login_session_is_reused(self, account, monkeypatch):
+        AzureCLI.login()
+        monkeypatch.setattr(AzureCLI, "_logged_in", False)
+        AzureCLI.login()
+        assert account() == 1
+
+    def test_login_session_expires(self, account, monkeypatch):
+        monkeypatch.setenv("ACS_LOGIN_TTL", "0")
+        AzureCLI.login()
+        monkeypatch.setattr(AzureCLI, "_logged_in", False)
+        AzureCLI.login()
+        assert account() == 2
+
+    def test_interactive_login_records_session(self, account, tmp_path, monkeypatch):
+        script = tmp_path / "azure"
+        logged_in = tmp_path / "logged_in"
+        script.write_text(script.read_text().replace("[ \"$1\" = account ]",
+            "[ \"$1\" = login ] && touch " + str(logged_in) + " && exit 0\n"
+            "[ \"$1\" = account ] && [ ! -e " + str(logged_in) + " ] && echo 'Please login' >&2 && exit 1\n"
+            "[ \"$1\" = account ]"))
+        AzureCLI.login()
+        assert account() == 3
+        assert os.path.exists(os.path.join(AzureCLI.session_dir, "sub-1"))
+
+        monkeypatch.setattr(AzureCLI, "_logged_in", False)
+        AzureCLI.login()
+        assert account() == 3
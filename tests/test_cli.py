@@ -2,7 +2,11 @@
 
 from acs import __version__ as VERSION
 
-from subprocess import check_output
+from subprocess import PIPE, Popen, check_output
+import json
+import os
+import sys
+import time
 import pytest
 
 class TestCLI():
@@ -16,3 +20,66 @@ class TestCLI():
     def test_returns_version_informatio(self):
         output = check_output(['acs', '--version'])
         assert output.strip().decode("utf-8") == VERSION
+
+    def test_writes_trace(self, tmpdir):
+        path = str(tmpdir.join("trace.json"))
+        check_output([sys.executable, '-m', 'acs.cli', '--config-file=tests/test_dcos_cluster.ini',
+                      '--trace=' + path, 'service', 'show'])
+        with open(path) as trace_file:
+            events = json.load(trace_file)["traceEvents"]
+        assert {"name": "process_name", "ph": "M", "pid": events[0]["pid"], "tid": 0,
+                "args": {"name": "acs service show"}} in events
+
+class TestStartup():
+    """Startup time benchmarks. Scripts invoke `acs` many times, so
+    simple invocations must not import the libraries needed to talk
+    to the cluster."""
+
+    # seconds, override with ACS_STARTUP_BUDGET on slow machines
+    budget = float(os.environ.get("ACS_STARTUP_BUDGET", 1.0))
+
+    heavy_modules = ['paramiko', 'sshtunnel', 'scp', 'cryptography', 'urllib.request']
+
+    def imported_modules(self, argv):
+        """Run the CLI in a new interpreter and return the modules it imported."""
+        script = ("import sys\n"
+                  "sys.argv = " + repr(['acs'] + argv) + "\n"
+                  "from acs.cli import main\n"
+                  "try:\n"
+                  "    main()\n"
+                  "except SystemExit:\n"
+                  "    pass\n"
+                  "print()\n"
+                  "print(' '.join(sys.modules))\n")
+        p = Popen([sys.executable, '-c', script], stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        output, errors = p.communicate()
+        return output.splitlines()[-1].split()
+
+    def time_command(self, argv):
+        start = time.time()
+        check_output([sys.executable, '-m', 'acs.cli'] + argv)
+        return time.time() - start
+
+    @pytest.mark.parametrize("argv", [['--version'], ['--help'], ['service', '--help'], ['app', '--help']])
+    def test_does_not_import_cluster_libraries(self, argv):
+        modules = self.imported_modules(argv)
+        for module in self.heavy_modules:
+            assert module not in modules
+
+    def test_only_imports_chosen_command(self):
+        modules = self.imported_modules(['lb', '--help'])
+        assert 'acs.commands.lb' in modules
+        assert 'acs.commands.service' not in modules
+        assert 'acs.commands.afs' not in modules
+
+    def test_commands_are_reexported_on_use(self):
+        script = ("import sys, acs.commands as commands; "
+                  "assert 'acs.commands.lb' not in sys.modules; "
+                  "print(commands.Lb.__module__)")
+        assert check_output([sys.executable, '-c', script]).decode().strip() == 'acs.commands.lb'
+
+    @pytest.mark.parametrize("argv", [['--version'], ['service', '--help']])
+    def test_within_budget(self, argv):
+        self.time_command(argv)
+        elapsed = min(self.time_command(argv) for i in range(3))
+        assert elapsed < self.budget, " ".join(argv) + " took " + str(elapsed) + "s"
@@ -14,7 +14,7 @@ class TestDCOS():
     @slow
     def test_deployment(self, service):
         with open ('marathon-app.json', "r") as marathonfile:
-            data=marathonfile.read().replace('\n', '').replace("\"", "\\\"")
+            data = marathonfile.read()
         response = service.marathonCommand('groups', 'POST', data)
 
         url = "http://" + service.getAgentEndpoint()
@@ -0,0 +1,96 @@
+"""Tests for the Marathon REST client, run against a local fake Marathon."""
+
+from acs.Marathon import Marathon, MarathonError
+
+import pytest
+import time
+
+@pytest.fixture
+def marathon(marathon_server):
+    with Marathon(port = marathon_server.server_address[1]) as client:
+        yield client
+
+class TestMarathon():
+    def test_create_get_and_delete_app(self, marathon):
+        marathon.createApp({"id": "web", "cmd": "python -m http.server", "instances": 1})
+        assert marathon.getApp("/web")["cmd"] == "python -m http.server"
+        assert [app["id"] for app in marathon.getApps()] == ["/web"]
+        marathon.deleteApp("web")
+        assert marathon.getApps() == []
+
+    def test_error_response_raises(self, marathon):
+        marathon.createApp({"id": "web"})
+        with pytest.raises(MarathonError) as e:
+            marathon.createApp({"id": "web"})
+        assert e.value.status == 409
+        assert "already exists" in e.value.message
+
+        with pytest.raises(MarathonError) as e:
+            marathon.getApp("missing")
+        assert e.value.status == 404
+
+    def test_connection_is_reused(self, marathon, marathon_server):
+        for i in range(10):
+            marathon.createApp({"id": "app" + str(i)})
+        assert len(marathon.getApps()) == 10
+        assert marathon_server.connections == 1
+
+    def test_reconnects_after_server_closes_connection(self, marathon, marathon_server):
+        marathon_server.drop_connections = True
+        marathon.getApps()
+        marathon_server.drop_connections = False
+        assert marathon.getApps() == []
+        assert marathon_server.connections == 2
+
+    def test_wait_for_deployments_uses_events(self, marathon, marathon_server):
+        marathon_server.failing.add("/broken")
+        marathon_server.deployment_time = 0.5
+        ok = marathon.deploymentIds(marathon.createApp({"id": "web"}))
+        broken = marathon.deploymentIds(marathon.createApp({"id": "broken"}))
+        requests = marathon_server.requests
+
+        results = marathon.waitForDeployments(ok + broken, timeout = 5)
+        assert results == {ok[0]: "succeeded", broken[0]: "failed"}
+        # one check of the running deployments, the rest from events
+        assert marathon_server.requests == requests + 1
+
+    def test_wait_for_deployments_polls_without_events(self, marathon, marathon_server):
+        marathon_server.events_enabled = False
+        targets = marathon.deploymentTargets(marathon.updateApp("web", {"cmd": "run"}), app_id = "/web")
+        assert marathon.waitForDeployments(list(targets), 5, targets) == dict.fromkeys(targets, "succeeded")
+
+    def test_outcome_of_deployments_finished_before_waiting(self, marathon, marathon_server):
+        marathon_server.failing.add("/broken")
+        marathon.createApp({"id": "gone"})
+        targets = {}
+        targets.update(marathon.deploymentTargets(marathon.createApp({"id": "web"}), app_id = "/web"))
+        targets.update(marathon.deploymentTargets(marathon.createApp({"id": "broken"}), app_id = "/broken"))
+        targets.update(marathon.deploymentTargets(marathon.deleteApp("gone"), app_id = "/gone", removed = True))
+        unknown = marathon.deploymentIds(marathon.createApp({"id": "other"}))
+        while marathon_server.deployments:
+            time.sleep(0.01)
+
+        results = marathon.waitForDeployments(list(targets) + unknown, 5, targets)
+        assert sorted(results.values()) == ["failed", "succeeded", "succeeded", "unknown"]
+        assert results[unknown[0]] == "unknown"
+        assert [results[deployment_id] for deployment_id, target in targets.items() if target["app"] == "/broken"] == ["failed"]
+
+    def test_superseded_deployment_failed(self, marathon, marathon_server):
+        targets = marathon.deploymentTargets(marathon.createApp({"id": "web"}), app_id = "/web")
+        marathon.updateApp("web", {"cmd": "rolled back"})
+        while marathon_server.deployments:
+            time.sleep(0.01)
+        assert marathon.waitForDeployments(list(targets), 5, targets) == dict.fromkeys(targets, "failed")
+
+    def test_wait_for_deployments_times_out(self, marathon, marathon_server):
+        marathon_server.deployment_time = 10
+        ids = marathon.deploymentIds(marathon.createApp({"id": "slow"}))
+        assert marathon.waitForDeployments(ids, timeout = 0.2) == {ids[0]: "timed out"}
+
+    def test_wait_for_deployments_keeps_to_timeout(self, marathon, marathon_server):
+        marathon_server.deployment_time = 10
+        marathon_server.deployments_delay = 0.3
+        ids = marathon.deploymentIds(marathon.createApp({"id": "slow"}))
+        started = time.time()
+        assert marathon.waitForDeployments(ids, timeout = 0.5) == {ids[0]: "timed out"}
+        assert time.time() - started < 0.7
@@ -0,0 +1,36 @@
+"""Tests for running a list of commands as a single remote script."""
+
+from acs.RemoteScript import RemoteScript
+
+import subprocess
+
+import pytest
+
+class TestRemoteScript():
+    def run(self, script):
+        p = subprocess.Popen(["bash", "-s"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = p.communicate(script.render().encode("utf-8"))
+        return p.returncode, output.decode("utf-8")
+
+    def test_reports_each_step(self):
+        script = RemoteScript(["echo one", "echo two >&2", "echo 'it''s quoted'"])
+        status, output = self.run(script)
+        results = script.parse(output)
+
+        assert status == 0
+        assert len(results) == 3
+        assert results[0].stdout == "one\n"
+        assert results[1].stderr == "two\n"
+        assert results[2].stdout == "its quoted\n"
+        assert all(result.succeeded() for result in results)
+        assert all(result.duration >= 0 for result in results)
+
+    def test_stops_on_first_failure(self):
+        script = RemoteScript(["echo before", "exit 3", "echo after"])
+        status, output = self.run(script)
+        results = script.parse(output)
+
+        assert status == 3
+        assert len(results) == 2
+        assert results[-1].status == 3
+        assert not results[-1].succeeded()
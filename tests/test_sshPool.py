@@ -0,0 +1,254 @@
+"""Tests for the pooled SSH connections."""
+
+from acs.SSHPool import Cancellation, CommandCancelled, CommandStream, CommandTimeout, SSHConnection, SSHPool
+
+import io
+import os
+import paramiko
+import pytest
+import threading
+import time
+
+class TestSSHPool():
+    def test_get_returns_same_connection(self):
+        first = SSHPool.get("master.example.com", 2200, "azureuser", "~/.ssh/id_rsa")
+        second = SSHPool.get("master.example.com", 2200, "azureuser", "~/.ssh/id_rsa")
+        assert first is second
+        assert not first.isActive()
+
+    def test_connections_are_per_cluster(self):
+        first = SSHPool.get("one.example.com", 2200, "azureuser", "~/.ssh/id_rsa")
+        second = SSHPool.get("two.example.com", 2200, "azureuser", "~/.ssh/id_rsa")
+        assert first is not second
+
+    def test_closeAll_empties_pool(self):
+        SSHPool.get("master.example.com", 2200, "azureuser", "~/.ssh/id_rsa")
+        SSHPool.closeAll()
+        assert SSHPool.connections() == []
+
+class FakeChannel():
+    """Replays a list of ("stdout" | "stderr", bytes) chunks."""
+    def __init__(self, chunks, status = 0):
+        self.stdout = [chunk for name, chunk in chunks if name == "stdout"]
+        self.stderr = [chunk for name, chunk in chunks if name == "stderr"]
+        self.status = status
+        self.eof_received = True
+        self.closed = False
+
+    def recv_ready(self):
+        return len(self.stdout) > 0
+
+    def recv_stderr_ready(self):
+        return len(self.stderr) > 0
+
+    def recv(self, size):
+        return self.stdout.pop(0)
+
+    def recv_stderr(self, size):
+        return self.stderr.pop(0)
+
+    def exit_status_ready(self):
+        return True
+
+    def recv_exit_status(self):
+        return self.status
+
+    def close(self):
+        self.closed = True
+
+class HungChannel():
+    """A channel for a command that never produces output or exits."""
+    def __init__(self):
+        self.status_event = threading.Event()
+        self.eof_received = False
+        self.closed = False
+        # something select() can wait on that never becomes readable
+        self.pipe = os.pipe()
+
+    def recv_ready(self):
+        return False
+
+    def recv_stderr_ready(self):
+        return False
+
+    def exit_status_ready(self):
+        return self.closed
+
+    def fileno(self):
+        return self.pipe[0]
+
+    def close(self):
+        self.closed = True
+        self.status_event.set()
+
+class LateOutputChannel(FakeChannel):
+    """A channel whose exit status arrives before the last of its output."""
+    def __init__(self, chunks, late_chunks, status = 0):
+        FakeChannel.__init__(self, chunks, status)
+        self.late_chunks = late_chunks
+        self.eof_received = False
+        self.pipe = os.pipe()
+
+    def fileno(self):
+        return self.pipe[0]
+
+    def finish(self):
+        self.stdout.extend(chunk for name, chunk in self.late_chunks if name == "stdout")
+        self.stderr.extend(chunk for name, chunk in self.late_chunks if name == "stderr")
+        self.eof_received = True
+        os.write(self.pipe[1], b"x")
+
+class TestSSHConnection():
+    def test_connect_retries_transient_failures(self, monkeypatch):
+        connection = SSHConnection("master.example.com", 2200, "azureuser", "~/.ssh/id_rsa")
+        connection.retry_delay = 0.01
+        failures = [ConnectionResetError("reset during handshake"), paramiko.SSHException("Error reading SSH protocol banner")]
+        def connect():
+            if failures:
+                raise failures.pop(0)
+            return "transport"
+        monkeypatch.setattr(connection, "_connect", connect)
+        assert connection.connect() == "transport"
+        assert failures == []
+
+    def test_connect_gives_up(self, monkeypatch):
+        connection = SSHConnection("master.example.com", 2200, "azureuser", "~/.ssh/id_rsa")
+        connection.retry_delay = 0.01
+        attempts = []
+        def connect():
+            attempts.append(1)
+            raise ConnectionResetError("reset during handshake")
+        monkeypatch.setattr(connection, "_connect", connect)
+        with pytest.raises(ConnectionResetError):
+            connection.connect()
+        assert len(attempts) == connection.connect_attempts
+
+    def test_authentication_failure_is_not_retried(self, monkeypatch):
+        connection = SSHConnection("master.example.com", 2200, "azureuser", "~/.ssh/id_rsa")
+        attempts = []
+        def connect():
+            attempts.append(1)
+            raise paramiko.AuthenticationException("Authentication failed")
+        monkeypatch.setattr(connection, "_connect", connect)
+        with pytest.raises(paramiko.AuthenticationException):
+            connection.connect()
+        assert len(attempts) == 1
+
+    def test_openSession_does_not_retry_failed_connect(self, monkeypatch):
+        connection = SSHConnection("master.example.com", 2200, "azureuser", "~/.ssh/id_rsa")
+        connection.retry_delay = 0.01
+        attempts = []
+        def connect():
+            attempts.append(1)
+            raise ConnectionResetError("reset during handshake")
+        monkeypatch.setattr(connection, "_connect", connect)
+        with pytest.raises(ConnectionResetError):
+            connection.openSession()
+        assert len(attempts) == connection.connect_attempts
+
+    def test_openSession_reconnects_dead_transport_once(self, monkeypatch):
+        connection = SSHConnection("master.example.com", 2200, "azureuser", "~/.ssh/id_rsa")
+        connection.retry_delay = 0.01
+        class DeadTransport():
+            def open_session(self, timeout = None):
+                raise EOFError()
+        attempts = []
+        def connect():
+            attempts.append(1)
+            if len(attempts) > 1:
+                raise ConnectionResetError("reset during handshake")
+            return DeadTransport()
+        monkeypatch.setattr(connection, "_connect", connect)
+        with pytest.raises(ConnectionResetError):
+            connection.openSession()
+        assert len(attempts) == 2
+
+    def test_execute_reads_output_sent_after_exit_status(self, monkeypatch):
+        connection = SSHConnection("master.example.com", 2200, "azureuser", "~/.ssh/id_rsa")
+        channel = LateOutputChannel([("stdout", b"first\n")], [("stdout", b"last\n"), ("stderr", b"done\n")])
+        monkeypatch.setattr(connection, "openSession", lambda cancellation = None: channel)
+        monkeypatch.setattr(channel, "exec_command", lambda cmd: None, raising = False)
+        monkeypatch.setattr(channel, "shutdown_write", lambda: None, raising = False)
+
+        threading.Timer(0.1, channel.finish).start()
+        assert connection.execute("echo first; echo last") == (0, "first\nlast\n", "done\n")
+
+    def test_cancel_closes_commands_in_flight(self, monkeypatch):
+        connection = SSHConnection("master.example.com", 2200, "azureuser", "~/.ssh/id_rsa")
+        channel = HungChannel()
+        monkeypatch.setattr(connection, "openSession", lambda cancellation = None: channel)
+        monkeypatch.setattr(channel, "exec_command", lambda cmd: None, raising = False)
+        monkeypatch.setattr(channel, "shutdown_write", lambda: None, raising = False)
+
+        threading.Timer(0.1, connection.cancel).start()
+        with pytest.raises(CommandCancelled):
+            connection.execute("sleep 3600")
+        assert channel.closed
+        assert connection._streams == set()
+
+    def test_cancellation_stops_copies(self, monkeypatch):
+        connection = SSHConnection("10.0.0.1", 22, "azureuser", "~/.ssh/id_rsa")
+        class Transport():
+            pass
+        class SFTP():
+            def __init__(self):
+                self.channel = HungChannel()
+                self.channel.settimeout = lambda timeout: None
+                self.started = threading.Event()
+            def get_channel(self):
+                return self.channel
+            def put(self, local_path, remote_path):
+                self.started.set()
+                self.channel.status_event.wait(10)
+                raise EOFError()
+            def close(self):
+                self.channel.close()
+        sftp = SFTP()
+        connects = []
+        monkeypatch.setattr(connection, "connect", lambda attempts = None, cancellation = None: connects.append(1) or Transport())
+        monkeypatch.setattr(paramiko.SFTPClient, "from_transport", lambda transport: sftp)
+
+        cancellation = Cancellation()
+        threading.Thread(target = lambda: sftp.started.wait(2) and cancellation.cancel()).start()
+        started = time.time()
+        with pytest.raises(CommandCancelled):
+            connection.put("image.tar", "image.tar", cancellation = cancellation)
+        assert time.time() - started < 1
+        assert connection._streams == set()
+
+        with pytest.raises(CommandCancelled):
+            connection.put("image.tar", "image.tar", cancellation = cancellation)
+        assert connects == [1]
+
+class TestCommandStream():
+    def test_lines_are_reassembled_across_chunks(self):
+        channel = FakeChannel([("stdout", b"one\ntw"), ("stderr", b"oops\n"), ("stdout", b"o\n\xc3"), ("stdout", b"\xa9")])
+        with CommandStream(channel) as stream:
+            lines = list(stream.lines())
+        assert ("stdout", "one") in lines
+        assert ("stdout", "two") in lines
+        assert ("stderr", "oops") in lines
+        assert ("stdout", "é") in lines
+        assert channel.closed
+
+    def test_copyTo_writes_output_and_returns_status(self):
+        channel = FakeChannel([("stdout", b"hello\n"), ("stderr", b"world\n")], status = 2)
+        out = io.StringIO()
+        err = io.StringIO()
+        status = CommandStream(channel).copyTo(out, err)
+        assert status == 2
+        assert out.getvalue() == "hello\n"
+        assert err.getvalue() == "world\n"
+
+    def test_timeout_closes_channel(self):
+        channel = HungChannel()
+        started = time.time()
+        with pytest.raises(CommandTimeout):
+            CommandStream(channel, deadline = time.time() + 0.2).wait()
+        assert channel.closed
+        assert time.time() - started < 1
+
+        channel = HungChannel()
+        with pytest.raises(CommandTimeout):
+            list(CommandStream(channel, deadline = time.time() + 0.2).chunks())
+        assert channel.closed
@@ -0,0 +1,63 @@
+"""Tests for tracing where the time goes."""
+
+from acs.Trace import Trace
+
+import json
+import threading
+
+import pytest
+
+@pytest.fixture
+def trace(tmpdir):
+    path = str(tmpdir.join("trace.json"))
+    Trace.start(path, "acs test")
+    yield path
+    Trace.stop()
+
+def read(path):
+    with open(path) as trace_file:
+        events = json.load(trace_file)["traceEvents"]
+    lanes = dict((event["tid"], event["args"]["name"]) for event in events if event["name"] == "thread_name")
+    spans = [event for event in events if event["ph"] == "X"]
+    return lanes, spans
+
+class TestTrace():
+    def test_disabled_spans_record_nothing(self):
+        assert not Trace.enabled
+        assert Trace.span("azure", "azure", args = "vmss list") is Trace.lane("agent 10.0.0.4")
+        with Trace.span("azure", "azure"):
+            pass
+        assert Trace.stop() is None
+
+    def test_spans_are_written_as_trace_events(self, trace):
+        with Trace.span("executeOnMaster", "ssh", cmd = "hostname"):
+            with Trace.span("ssh connect", "ssh", host = "master"):
+                pass
+        with pytest.raises(RuntimeError):
+            with Trace.span("azure vmss list", "azure"):
+                raise RuntimeError("not logged in")
+        assert Trace.stop() == trace
+
+        lanes, spans = read(trace)
+        assert [span["name"] for span in spans] == ["ssh connect", "executeOnMaster", "azure vmss list"]
+        outer, inner = spans[1], spans[0]
+        assert outer["args"] == {"cmd": "hostname"}
+        assert outer["ts"] <= inner["ts"] and inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]
+        assert spans[2]["args"]["error"] == "RuntimeError: not logged in"
+        assert lanes == {1: threading.current_thread().name}
+
+    def test_agents_have_their_own_lanes(self, trace, base, monkeypatch):
+        monkeypatch.setattr(base, "args", {"--parallel": "2"})
+        def run(ip):
+            with Trace.span("executeOnAgent", "ssh", host = ip):
+                return ip
+        base.forEachAgent(run, ["10.0.0.4", "10.0.0.5", "10.0.0.6"])
+        Trace.stop()
+
+        lanes, spans = read(trace)
+        assert sorted(lanes.values()) == ["MainThread", "agent 10.0.0.4", "agent 10.0.0.5", "agent 10.0.0.6"]
+        for span in spans:
+            if span["name"] == "executeOnAgent":
+                assert lanes[span["tid"]] == "agent " + span["args"]["host"]
+            else:
+                assert lanes[span["tid"]] == "MainThread"
@@ -0,0 +1,117 @@
+"""Tests for forwarding local ports through an SSH tunnel."""
+
+from acs.Tunnel import Tunnel
+
+import socket
+import socketserver
+import threading
+import pytest
+
+class EchoHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            data = self.request.recv(1024)
+            if not data:
+                return
+            self.request.sendall(self.server.prefix + data)
+
+class EchoServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class FakeTransport():
+    """Opens "channels" as plain sockets to local echo servers."""
+    def __init__(self, servers):
+        self.servers = servers
+        self.active = True
+        self.keepalive = None
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        self.keepalive = interval
+
+    def open_channel(self, kind, destination, origin):
+        assert kind == "direct-tcpip"
+        return socket.create_connection(self.servers[destination[1]].server_address)
+
+class FakeConnection():
+    host = "master.example.com"
+
+    def __init__(self, servers):
+        self.servers = servers
+        self.transport = None
+        self.handshakes = 0
+
+    def isActive(self):
+        return self.transport is not None and self.transport.is_active()
+
+    def connect(self):
+        if not self.isActive():
+            self.transport = FakeTransport(self.servers)
+            self.handshakes = self.handshakes + 1
+        return self.transport
+
+@pytest.fixture
+def servers():
+    servers = {}
+    for port, prefix in [(80, b"dcos:"), (2375, b"swarm:")]:
+        server = EchoServer(("127.0.0.1", 0), EchoHandler)
+        server.prefix = prefix
+        thread = threading.Thread(target = server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers[port] = server
+    yield servers
+    for server in servers.values():
+        server.shutdown()
+        server.server_close()
+
+def roundTrip(port, data):
+    with socket.create_connection(("127.0.0.1", port)) as client:
+        client.sendall(data)
+        return client.recv(1024)
+
+class TestTunnel():
+    def test_forwards_multiple_ports(self, servers):
+        tunnel = Tunnel(FakeConnection(servers), [(0, 80), (0, 2375)])
+        tunnel.start()
+        try:
+            dcos, swarm = tunnel.localPorts()
+            assert roundTrip(dcos, b"hello") == b"dcos:hello"
+            assert roundTrip(swarm, b"hello") == b"swarm:hello"
+            assert tunnel.connection.transport.keepalive == Tunnel.keepalive
+        finally:
+            tunnel.stop()
+
+    def test_reconnects_when_connection_drops(self, servers):
+        connection = FakeConnection(servers)
+        tunnel = Tunnel(connection, [(0, 80)])
+        tunnel.check_interval = 0.01
+        tunnel.start()
+        watcher = threading.Thread(target = tunnel.serve_forever)
+        watcher.start()
+        try:
+            connection.transport.active = False
+            for i in range(200):
+                if tunnel.reconnects:
+                    break
+                threading.Event().wait(0.01)
+            assert tunnel.reconnects == 1
+            assert connection.handshakes == 2
+            assert roundTrip(tunnel.localPorts()[0], b"again") == b"dcos:again"
+        finally:
+            tunnel.stop()
+            watcher.join()
+
+    def test_start_fails_if_port_in_use(self, servers):
+        first = Tunnel(FakeConnection(servers), [(0, 80)])
+        first.start()
+        try:
+            second = Tunnel(FakeConnection(servers), [(first.localPorts()[0], 80)])
+            with pytest.raises(OSError):
+                second.start()
+            assert second.listeners == []
+        finally:
+            first.stop()